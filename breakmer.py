@@ -56,16 +56,48 @@ RUN_PARSER.add_argument('-s', '--start_blat_server', dest='start_blat_server', d
 RUN_PARSER.add_argument('-k', '--keep_blat_server', dest='keep_blat_server', default=False, action='store_true', help='Keep the blat server alive. [default: %(default)s]')
 RUN_PARSER.add_argument('-p', '--port_number', dest='blat_port', default=None, type=int, help='The port number for the blat server. A random port number (8000-9500) will be used if not specified. [default: %(default)s]')
 RUN_PARSER.add_argument('-c', '--config', dest='config_fn', default=None, required=True, help='The configuration filename that contains additional parameters. [default: %(default)s]')
+RUN_PARSER.add_argument('--max_assembly_seeds', dest='max_assembly_seeds', default=None, type=int, help='Maximum number of seed kmers used to start contigs for a target. No limit if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--max_assembly_alignments', dest='max_assembly_alignments', default=None, type=int, help='Maximum number of read to contig alignments performed for a target. No limit if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--max_kmer_reads', dest='max_kmer_reads', default=None, type=int, help='Maximum number of reads considered for each kmer during assembly. No limit if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--max_assembly_time', dest='max_assembly_time', default=None, type=int, help='Maximum number of seconds spent assemblying contigs for a target. No limit if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--downsample_max_reads', dest='downsample_max_reads', default=None, type=int, help='Maximum number of tumor variant read pairs to keep in each genomic window of a target. Normal sample reads are not downsampled. No downsampling if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--downsample_window', dest='downsample_window', default=1000, type=int, help='Size of the genomic windows used for downsampling. [default: %(default)s]')
+RUN_PARSER.add_argument('--solid_kmer_min_count', dest='solid_kmer_min_count', default=None, type=int, help='Minimum count for a sample only kmer to be used in the assembly. All kmers are used if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--solid_kmer_depth_fraction', dest='solid_kmer_depth_fraction', default=None, type=float, help='Raise the minimum kmer count to this fraction of the median sample kmer count in the target. [default: %(default)s]')
+RUN_PARSER.add_argument('--solid_kmer_min_qual', dest='solid_kmer_min_qual', default=None, type=int, help='Only count kmers with all base qualities at or above this Phred value. [default: %(default)s]')
+RUN_PARSER.add_argument('--kmer_dust_thresh', dest='kmer_dust_thresh', default=None, type=float, help='Remove sample only kmers with a DUST low complexity score above this value. [default: %(default)s]')
+RUN_PARSER.add_argument('--mask_repeat_kmers', dest='mask_repeat_kmers', default=False, action='store_true', help='Remove sample only kmers only found in reads aligned within the repeat_mask_file regions. [default: %(default)s]')
+RUN_PARSER.add_argument('--native_gfclient', dest='native_gfclient', default=False, action='store_true', help='Query the gfServer directly over its socket protocol for genome realignment instead of running gfClient. Requires the 2bit file the gfServer was started with. [default: %(default)s]')
+RUN_PARSER.add_argument('--genome_realign_inflight', dest='genome_realign_inflight', default=None, type=int, help='Maximum number of concurrent genome realignment queries sent to the blat server per target. Queries are sent one at a time if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--realign_cache_dir', dest='realign_cache_dir', default=None, help='Directory of a realignment result cache shared across runs. Contigs with cached results for the same sequence, aligner settings and reference are not realigned. Caching is off if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--realign_cache_max_size', dest='realign_cache_max_size', default=None, type=int, help='Maximum size in megabytes of the realignment cache, least recently used entries are removed beyond it. [default: 1024]')
+RUN_PARSER.add_argument('--native_target_aligner', dest='native_target_aligner', default=False, action='store_true', help='Realign contigs to the target reference with the in-process seed and extend aligner instead of running blat. [default: %(default)s]')
+RUN_PARSER.add_argument('--target_ooc_repmatch', dest='target_ooc_repmatch', default=None, type=int, help='Number of occurrences above which a target reference 11-mer is written to the blat ooc file and not used as a seed in target realignment. The default is the blat threshold for the realignment tile and step sizes, so seeding is unchanged. [default: 1126]')
+RUN_PARSER.add_argument('--partial_genome_realign', dest='partial_genome_realign', default=False, action='store_true', help='Realign only the contig intervals not aligned to the target reference to the genome, and merge the records with the target records. [default: %(default)s]')
+RUN_PARSER.add_argument('--partial_genome_flank', dest='partial_genome_flank', default=None, type=int, help='Number of target aligned bases kept on either side of the intervals in partial genome realignment. [default: 20]')
+RUN_PARSER.add_argument('--partner_regions_bed', dest='partner_regions_bed', default=None, help='Bed file of known fusion partner regions. Contigs without a target alignment are realigned to these regions in process and only sent to the blat server if still not explained. [default: %(default)s]')
+RUN_PARSER.add_argument('--gfserver_instances', dest='gfserver_instances', default=None, type=int, help='Number of gfServer instances to start over the 2bit file, on consecutive ports from the blat port. With a running server on the blat port, the number of running instances to use. Genome queries are distributed across the instances. [default: 1]')
+RUN_PARSER.add_argument('--local_genome_index', dest='local_genome_index', default=False, action='store_true', help='Realign contigs to the genome with a memory mapped minimizer index of the reference fasta, built once in the reference data directory, instead of a blat server. [default: %(default)s]')
+RUN_PARSER.add_argument('--panel_blast_db', dest='panel_blast_db', default=False, action='store_true', help='Build one blast database of all the panel target sequences and realign each target batch of contigs against it with the worker share of the processors, keeping only the hits to the contig target. Requires the blast binary in the configuration. [default: %(default)s]')
+RUN_PARSER.add_argument('--dedup_contigs', dest='dedup_contigs', default=False, action='store_true', help='Realign and call each distinct contig sequence once per run. Contigs that match, reverse complement or are contained in a contig of another target are reported with the calls of that contig. [default: %(default)s]')
+RUN_PARSER.add_argument('--event_merge_distance', dest='event_merge_distance', default=None, type=int, help='Merge the events of a target that call the same breakpoints within this many base pairs into one event with the summed split read support, before filtering, annotation and plotting. Merging is off if not set. [default: %(default)s]')
+RUN_PARSER.add_argument('--single_contig_bam', dest='single_contig_bam', default=False, action='store_true', help='Write the reads of all the called contigs of a target to one sorted and indexed bam file, with the contig id in the ci tag, instead of one bam file per contig. [default: %(default)s]')
+RUN_PARSER.add_argument('--annotation_index', dest='annotation_index', default=False, action='store_true', help='Annotate breakpoints with the KNOWN transcripts of the gene annotation file loaded once per worker into sorted interval arrays, instead of bedtools intersect and closest pipelines for each contig. bedtools is not needed. [default: %(default)s]')
 
 # Server parser
 SERVER_PARSER.add_argument('-p', '--port_number', dest='blat_port', default=None, type=int, help='The port number for the blat server. A random port number (8000-9500) will be used if not specified. [default: %(default)s]')
 SERVER_PARSER.add_argument('--hostname', dest='blat_hostname', default='localhost', help='The hostname for the blat server. Localhost will be used if not specified. [default: %(default)s]')
 SERVER_PARSER.add_argument('-c', '--config', dest='config_fn', default=None, required=True, help='The configuration filename that contains additional parameters. [default: %(default)s]')
+SERVER_PARSER.add_argument('--gfserver_instances', dest='gfserver_instances', default=None, type=int, help='Number of gfServer instances to start over the 2bit file, on consecutive ports from the blat port. Genome queries are distributed across the instances. [default: 1]')
 
 # Setup reference parser
 REF_PARSER.add_argument('-g', '--gene_list', dest='gene_list', default=None, help='Gene list to consider for analysis. [default: %(default)s]')
 REF_PARSER.add_argument('-c', '--config', dest='config_fn', default=None, required=True, help='The configuration filename that contains additional parameters. [default: %(default)s]')
 REF_PARSER.add_argument('-n', '--nprocessors', dest='nprocs', default=1, type=int, help='The number of processors to use for analysis. [default: %(default)s]')
+REF_PARSER.add_argument('--target_ooc_repmatch', dest='target_ooc_repmatch', default=None, type=int, help='Number of occurrences above which a target reference 11-mer is written to the blat ooc file and not used as a seed in target realignment. The default is the blat threshold for the realignment tile and step sizes, so seeding is unchanged. [default: 1126]')
+REF_PARSER.add_argument('--partner_regions_bed', dest='partner_regions_bed', default=None, help='Bed file of known fusion partner regions to extract and index with the reference data. [default: %(default)s]')
+REF_PARSER.add_argument('--local_genome_index', dest='local_genome_index', default=False, action='store_true', help='Build the minimizer index of the reference fasta for genome realignment without a blat server. [default: %(default)s]')
+REF_PARSER.add_argument('--panel_blast_db', dest='panel_blast_db', default=False, action='store_true', help='Build the blast database of all the panel target sequences. [default: %(default)s]')
 
 # Start analysis
 RUN_TRACKER = breakmer_analysis.RunTracker(params.ParamManager(PARSER.parse_args()))
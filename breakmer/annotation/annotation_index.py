@@ -0,0 +1,338 @@
+#! /usr/bin/local/python
+# -*- coding: utf-8 -*-
+
+import os
+import array
+import bisect
+import marshal
+import tempfile
+import breakmer.utils as utils
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+# Annotation indexes loaded in this worker process, keyed by (annotation file, modification time).
+ANNOTATION_INDEXES = {}
+# Exon indexes opened in this worker process, keyed by (annotation file, modification time).
+EXON_INDEXES = {}
+
+# Bump to rebuild the exon index sidecar files when their format changes.
+EXON_INDEX_VERSION = 1
+EXON_INDEX_EXT = '.exons.idx'
+# Array type code of the packed exon coordinates.
+EXON_COORD_TYPE = 'i'
+
+
+def get_annotation_index(annotationFn):
+    """Return the transcript index of a gene annotation file loaded in this process,
+    loading it on first use.
+    Args:
+        annotationFn: String of the GTF gene annotation file.
+    Return:
+        TranscriptIndex object.
+    """
+    key = (os.path.abspath(annotationFn), os.path.getmtime(annotationFn))
+    if key not in ANNOTATION_INDEXES:
+        for cacheKey in [x for x in ANNOTATION_INDEXES if x[0] == key[0]]:
+            ANNOTATION_INDEXES.pop(cacheKey).close()
+        ANNOTATION_INDEXES[key] = TranscriptIndex(annotationFn)
+    return ANNOTATION_INDEXES[key]
+
+
+def get_exon_index(annotationFn):
+    """Return the exon index of a gene annotation file opened in this process, building
+    or opening its sidecar file on first use.
+    Args:
+        annotationFn: String of the GTF gene annotation file.
+    Return:
+        ExonIndex object.
+    """
+    key = (os.path.abspath(annotationFn), os.path.getmtime(annotationFn))
+    if key not in EXON_INDEXES:
+        for cacheKey in [x for x in EXON_INDEXES if x[0] == key[0]]:
+            EXON_INDEXES.pop(cacheKey).close()
+        EXON_INDEXES[key] = ExonIndex(annotationFn)
+    return EXON_INDEXES[key]
+
+
+def get_transcript_id(attributes):
+    """Return the transcript_id value of the GTF attributes column, None if it is missing."""
+    idx = attributes.find('transcript_id "')
+    if idx == -1:
+        return None
+    start = idx + len('transcript_id "')
+    return attributes[start:attributes.find('"', start)]
+
+
+def build_exon_index(annotationFn, indexFn):
+    """Write the exon index sidecar file of a gene annotation file.
+
+    The file holds a marshal header with the annotation file modification time and
+    size, and the chromosome, source, strand, offset and exon count of each transcript
+    id, followed by the packed start and stop of the exons of all the transcripts in
+    annotation file order. The file is written under a temporary name and renamed
+    into place.
+    Args:
+        annotationFn: String of the GTF gene annotation file.
+        indexFn:      String of the sidecar file to write.
+    Return: None
+    """
+    transcripts = {}
+    trxOrder = []
+    for line in open(annotationFn, 'rU'):
+        linesplit = line.rstrip('\n').split('\t')
+        if len(linesplit) < 9 or linesplit[2] != 'exon':
+            continue
+        trxId = get_transcript_id(linesplit[8])
+        if trxId is None:
+            continue
+        if trxId not in transcripts:
+            transcripts[trxId] = (linesplit[0], linesplit[1], linesplit[6], array.array(EXON_COORD_TYPE))
+            trxOrder.append(trxId)
+        transcripts[trxId][3].extend([int(linesplit[3]), int(linesplit[4])])
+
+    annotationStat = os.stat(annotationFn)
+    index = {}
+    coords = array.array(EXON_COORD_TYPE)
+    for trxId in trxOrder:
+        chrom, src, strand, exonCoords = transcripts[trxId]
+        index[trxId] = (chrom, src, strand, len(coords), len(exonCoords) / 2)
+        coords.extend(exonCoords)
+    header = {'version': EXON_INDEX_VERSION,
+              'mtime': annotationStat.st_mtime,
+              'size': annotationStat.st_size,
+              'index': index}
+    tmpIndexFn = '%s.%d.tmp' % (indexFn, os.getpid())
+    try:
+        indexFile = open(tmpIndexFn, 'wb')
+        marshal.dump(header, indexFile)
+        coords.tofile(indexFile)
+        indexFile.close()
+        os.rename(tmpIndexFn, indexFn)
+    finally:
+        if os.path.isfile(tmpIndexFn):
+            os.remove(tmpIndexFn)
+
+
+class ExonIndex:
+    """Transcript id to exon index of a gene annotation file, kept in a binary sidecar
+    file next to the annotation file. The sidecar is rebuilt when the annotation file
+    modification time or size differs from the values it was built from. If the
+    annotation directory is not writable the sidecar is written to a temporary file.
+
+    The transcript entries are loaded in memory and the exon coordinates are read
+    from the sidecar file for each transcript queried.
+    Attributes:
+        annotationFn: String of the GTF gene annotation file.
+        indexFn:      String of the sidecar file.
+        index:        Dictionary of transcript id to tuple with the chromosome, source,
+                      strand, coordinate offset and exon count.
+    """
+
+    def __init__(self, annotationFn):
+        self.loggingName = 'breakmer.annotation.annotation_index'
+        self.annotationFn = annotationFn
+        self.indexFn = annotationFn + EXON_INDEX_EXT
+        self.index = None
+        self.indexFile = None
+        self.coordOffset = None
+        self.tmpIndexFn = None
+        if not self.open_index():
+            self.build()
+
+    def open_index(self):
+        """Open the sidecar file, return False if it is missing or out of date."""
+        if not os.path.isfile(self.indexFn):
+            return False
+        annotationStat = os.stat(self.annotationFn)
+        indexFile = open(self.indexFn, 'rb')
+        try:
+            header = marshal.load(indexFile)
+        except (EOFError, ValueError, TypeError):
+            indexFile.close()
+            return False
+        if header.get('version') != EXON_INDEX_VERSION or header.get('mtime') != annotationStat.st_mtime or header.get('size') != annotationStat.st_size:
+            indexFile.close()
+            utils.log(self.loggingName, 'info', 'Exon index %s is out of date with %s' % (self.indexFn, self.annotationFn))
+            return False
+        self.index = header['index']
+        self.indexFile = indexFile
+        self.coordOffset = indexFile.tell()
+        utils.log(self.loggingName, 'info', 'Opened exon index %s with %d transcripts' % (self.indexFn, len(self.index)))
+        return True
+
+    def build(self):
+        """Build the sidecar file and open it."""
+        utils.log(self.loggingName, 'info', 'Building exon index %s from %s' % (self.indexFn, self.annotationFn))
+        try:
+            build_exon_index(self.annotationFn, self.indexFn)
+        except (IOError, OSError) as err:
+            # Annotation directory is not writable, use a temporary sidecar for this process.
+            fd, self.tmpIndexFn = tempfile.mkstemp(suffix=EXON_INDEX_EXT)
+            os.close(fd)
+            utils.log(self.loggingName, 'info', 'Unable to write exon index %s, %s. Using temporary file %s' % (self.indexFn, str(err), self.tmpIndexFn))
+            self.indexFn = self.tmpIndexFn
+            build_exon_index(self.annotationFn, self.indexFn)
+        if not self.open_index():
+            raise IOError('Unable to open exon index %s' % self.indexFn)
+
+    def close(self):
+        """ """
+        if self.indexFile is not None:
+            self.indexFile.close()
+            self.indexFile = None
+        if self.tmpIndexFn is not None and os.path.isfile(self.tmpIndexFn):
+            os.remove(self.tmpIndexFn)
+
+    def get_exons(self, trxId):
+        """Return the exon record values of a transcript, in annotation file order.
+        Args:
+            trxId: String of the transcript id.
+        Return:
+            List of lists with the chromosome, source, feature, start, stop, score,
+            strand, frame and attributes values of each exon.
+        """
+        if trxId not in self.index:
+            return []
+        chrom, src, strand, offset, nexons = self.index[trxId]
+        coords = array.array(EXON_COORD_TYPE)
+        self.indexFile.seek(self.coordOffset + offset * coords.itemsize)
+        coords.fromfile(self.indexFile, 2 * nexons)
+        exons = []
+        for i in range(nexons):
+            exons.append([chrom, src, 'exon', coords[2 * i], coords[2 * i + 1], '.', strand, '.', 'transcript_id "%s";' % trxId])
+        return exons
+
+
+class ChromTranscripts:
+    """Sorted interval arrays of the transcripts on one chromosome. Coordinates are
+    0-based and end exclusive, as bedtools reads GTF records.
+    Attributes:
+        starts:    Array of the transcript starts, sorted by start and file offset.
+        ends:      Array of the transcript ends, in the order of starts.
+        offsets:   Array of the file offsets of the transcript records, in the order of starts.
+        endOrder:  Array of the indexes into starts sorted by end and file offset.
+        sortedEnds: Array of the transcript ends in endOrder.
+        maxLen:    Integer of the longest transcript length.
+    """
+
+    def __init__(self, records):
+        records.sort()
+        self.starts = array.array('l', [x[0] for x in records])
+        self.ends = array.array('l', [x[1] for x in records])
+        self.offsets = array.array('l', [x[2] for x in records])
+        self.endOrder = array.array('l', sorted(range(len(records)), key=lambda i: (self.ends[i], self.offsets[i])))
+        self.sortedEnds = array.array('l', [self.ends[i] for i in self.endOrder])
+        self.maxLen = max([x[1] - x[0] for x in records])
+
+    def intersect(self, pos):
+        """Return the indexes of the transcripts containing a position."""
+        lo = bisect.bisect_right(self.starts, pos - self.maxLen)
+        hi = bisect.bisect_right(self.starts, pos)
+        return [i for i in range(lo, hi) if self.ends[i] > pos]
+
+    def upstream(self, pos):
+        """Return the indexes of the transcripts ending closest before a position, and the end."""
+        idx = bisect.bisect_right(self.sortedEnds, pos)
+        if idx == 0:
+            return [], None
+        end = self.sortedEnds[idx - 1]
+        lo = bisect.bisect_left(self.sortedEnds, end, 0, idx)
+        return [self.endOrder[i] for i in range(lo, idx)], end
+
+    def downstream(self, pos):
+        """Return the indexes of the transcripts starting closest after a position, and the start."""
+        idx = bisect.bisect_left(self.starts, pos + 1)
+        if idx == len(self.starts):
+            return [], None
+        start = self.starts[idx]
+        hi = bisect.bisect_right(self.starts, start, idx)
+        return range(idx, hi), start
+
+
+class TranscriptIndex:
+    """In-process replacement of the bedtools intersect and closest queries of the
+    breakpoints against the KNOWN transcripts of a GTF gene annotation file.
+
+    The annotation file is read once and the transcripts are held in per chromosome
+    sorted interval arrays with the file offset of each record. The records of the
+    transcripts hit by a query are read back from the file, so the GTF lines are not
+    kept in memory.
+    Attributes:
+        annotationFn: String of the GTF gene annotation file.
+        chroms:       Dictionary of chromosome name to ChromTranscripts object.
+    """
+
+    def __init__(self, annotationFn):
+        self.loggingName = 'breakmer.annotation.annotation_index'
+        self.annotationFn = annotationFn
+        self.chroms = {}
+        self.annotationFile = None
+        self.load()
+
+    def load(self):
+        """Read the transcript records of the KNOWN genes from the annotation file."""
+        records = {}
+        ntranscripts = 0
+        annotationFile = open(self.annotationFn, 'rb')
+        offset = 0
+        for line in annotationFile:
+            lineOffset = offset
+            offset += len(line)
+            # Same selection as awk '$3 == "transcript"' | grep 'gene_status "KNOWN"'.
+            if line.find('gene_status "KNOWN"') == -1:
+                continue
+            linesplit = line.split('\t')
+            if len(linesplit) < 9 or linesplit[2] != 'transcript':
+                continue
+            records.setdefault(linesplit[0], []).append((int(linesplit[3]) - 1, int(linesplit[4]), lineOffset))
+            ntranscripts += 1
+        annotationFile.close()
+        for chrom in records:
+            self.chroms[chrom] = ChromTranscripts(records[chrom])
+        utils.log(self.loggingName, 'info', 'Indexed %d transcripts on %d chromosomes from %s' % (ntranscripts, len(self.chroms), self.annotationFn))
+
+    def close(self):
+        """ """
+        if self.annotationFile is not None:
+            self.annotationFile.close()
+            self.annotationFile = None
+
+    def get_record(self, offset):
+        """Return the tab delimited values of the annotation record at a file offset."""
+        if self.annotationFile is None:
+            self.annotationFile = open(self.annotationFn, 'rb')
+        self.annotationFile.seek(offset)
+        return self.annotationFile.readline().rstrip('\n').split('\t')
+
+    def query(self, chrom, pos):
+        """Return the transcripts intersecting, upstream and downstream of a breakpoint,
+        as bedtools intersect -wo, closest -D a -id and closest -D a -iu report them
+        for the bed interval [pos, pos + 1). Distances follow bedtools, the overlap
+        length for intersecting transcripts and a 1-based distance, negative upstream,
+        for the closest transcripts.
+        Args:
+            chrom: String of the breakpoint chromosome.
+            pos:   Integer of the 0-based breakpoint position.
+        Return:
+            Dictionary of 'intersect', 'upstream' and 'downstream' to lists of tuples with
+            the annotation record values and the distance, in annotation file order.
+            None if the chromosome has no transcripts.
+        """
+        if chrom not in self.chroms:
+            return None
+        chromTrx = self.chroms[chrom]
+        hits = {'intersect': [], 'upstream': [], 'downstream': []}
+        for i in chromTrx.intersect(pos):
+            hits['intersect'].append((chromTrx.offsets[i], 1))
+        idxs, end = chromTrx.upstream(pos)
+        for i in idxs:
+            hits['upstream'].append((chromTrx.offsets[i], -(pos - end + 1)))
+        idxs, start = chromTrx.downstream(pos)
+        for i in idxs:
+            hits['downstream'].append((chromTrx.offsets[i], start - pos))
+        for key in hits:
+            hits[key] = [(self.get_record(offset), dist) for offset, dist in sorted(hits[key])]
+        return hits
@@ -5,6 +5,7 @@ import os
 import shutil
 import subprocess
 import breakmer.utils as utils
+import breakmer.annotation.annotation_index as annotation_index
 
 __author__ = "Ryan Abo"
 __copyright__ = "Copyright 2015, Ryan Abo"
@@ -41,6 +42,8 @@ class Transcript:
         self.geneStatus = ''
         self.len = 0
         self.exons = []
+        self.exonsLoaded = False
+        self.annotationFn = None
         self.set_values(values)
 
     def set_values(self, values):
@@ -55,17 +58,17 @@ class Transcript:
         self.geneStatus = meta[3].split(' ')[2].lstrip('"').rstrip('"')
         self.len = int(self.stop) - int(self.start)
 
-    def get_exons(self, annotationFn, tmpFilePath):
-        """ """
-        # Grep the exons and UTRs from the annotationFn
-        exonSelect = '$3 == "exon"' #' || $3 == "UTR")'
-        outFn = os.path.join(tmpFilePath, self.id + '.exons')
-        cmd = 'cat ' + annotationFn + " | awk '" + exonSelect + "' | grep '" + self.id + "' > " + os.path.join(tmpFilePath, self.id + '.exons')
-        os.system(cmd)
-        # ' 'bedtools multicov -bams ' + args.bam + ' -bed ' + args.intervals
-        for line in open(outFn, 'r'):
-            self.exons.append(Exon(line.strip().split('\t')))
-        os.remove(outFn)
+    def get_exons(self, annotationFn=None):
+        """Return the exons of the transcript from the exon index of the annotation file,
+        loading them on the first call. Later calls may leave out the annotation file.
+        """
+        if annotationFn is not None:
+            self.annotationFn = annotationFn
+        if not self.exonsLoaded and self.annotationFn is not None:
+            exonIndex = annotation_index.get_exon_index(self.annotationFn)
+            self.exons = [Exon(x) for x in exonIndex.get_exons(self.id)]
+            self.exonsLoaded = True
+        return self.exons
 
 
 def annotate_event(svEventResult, contigMeta):
@@ -84,10 +87,15 @@ def annotate_event(svEventResult, contigMeta):
         # Insertions have one breakpoint in reference.
         # Rearrangements have breakpoints for each segment that is rearranged.
         #  genomicBrkpts = svEventResult.get_genomic_brkpts()
-        bpMap = write_brkpt_bed_file(brkptBedFn, svEventResult.blatResults)
-        # print 'sv_annotation.py bpMap', bpMap
-        outputFiles = run_bedtools(bedtools, annotationFn, brkptBedFn, contigMeta.path)
-        trxMap = parse_bedtools_output(outputFiles)
+        if contigMeta.params.get_param('annotation_index'):
+            # Query the transcript intervals loaded once in this process.
+            bpMap, bpValues = get_brkpt_values(svEventResult.blatResults)
+            trxMap = query_annotation_index(annotation_index.get_annotation_index(annotationFn), bpValues)
+        else:
+            bpMap = write_brkpt_bed_file(brkptBedFn, svEventResult.blatResults)
+            # print 'sv_annotation.py bpMap', bpMap
+            outputFiles = run_bedtools(bedtools, annotationFn, brkptBedFn, contigMeta.path)
+            trxMap = parse_bedtools_output(outputFiles)
         store_annotations(svEventResult, bpMap, trxMap, annotationFn, contigMeta.params, contigMeta.path)
         # Remove temporary bedtools output files.
         # print 'annotate_event, sv_annotation.py', svEventResult
@@ -114,8 +122,8 @@ def store_annotations(svEventResult, bpMap, trxMap, annotationFn, params, tmpFil
             # print 'Upstream', upstream
             if intersect is not None:
                 trx, dist = intersect
-                if params.get_param('generate_image') or True:
-                    trx.get_exons(annotationFn, tmpFilePath)
+                if params.get_param('generate_image'):
+                    trx.get_exons(annotationFn)
                 # print blatResult, blatResult.get_sv_brkpts()
                 blatResult.get_sv_brkpts()[svBrkptIdx].store_annotation([trx], [dist], coordIdx)
             else:
@@ -129,18 +137,20 @@ def store_annotations(svEventResult, bpMap, trxMap, annotationFn, params, tmpFil
                     downTrx, downDist = downstream
                 # print 'Up', upTrx.id, upDist
                 # print 'Down', downTrx.id, downDist
-                if params.get_param('generate_image') or True:
+                if params.get_param('generate_image'):
                     if upTrx is not None:
-                        upTrx.get_exons(annotationFn, tmpFilePath)
+                        upTrx.get_exons(annotationFn)
                     if downTrx is not None:
-                        downTrx.get_exons(annotationFn, tmpFilePath)
+                        downTrx.get_exons(annotationFn)
                 blatResult.get_sv_brkpts()[svBrkptIdx].store_annotation([upTrx, downTrx], [upDist, downDist], coordIdx)
 
 
-def write_brkpt_bed_file(bpBedFn, blatResults):
-    """ """
+def get_brkpt_values(blatResults):
+    """Return the breakpoint map and the list of chromosome, position and key values of
+    the breakpoints in the realignment results.
+    """
     bpMap = {}
-    bpBedFile = open(bpBedFn, 'w')
+    bpValues = []
     bpIter = 1
     for queryStartCoord, blatResult in blatResults:
         svBreakpoints = blatResult.get_sv_brkpts()
@@ -154,12 +164,21 @@ def write_brkpt_bed_file(bpBedFn, blatResults):
             for coord in brkptCoords:
                 bpKey = chrom + ':' + str(coord) + '_BP' + str(bpIter) + '_' + str(svBrkptIdx)
                 # print 'write_brkpt_bed_file', bpKey
-                bpStr = [chrom, coord, int(coord) + 1, bpKey]
-                bpBedFile.write('\t'.join([str(x) for x in bpStr]) + '\n')
+                bpValues.append((chrom, int(coord), bpKey))
                 bpMap[bpKey] = (blatResult, svBrkptIdx, coordIdx)
                 coordIdx += 1
             svBrkptIdx += 1
         bpIter += 1
+    return bpMap, bpValues
+
+
+def write_brkpt_bed_file(bpBedFn, blatResults):
+    """ """
+    bpMap, bpValues = get_brkpt_values(blatResults)
+    bpBedFile = open(bpBedFn, 'w')
+    for chrom, coord, bpKey in bpValues:
+        bpStr = [chrom, coord, coord + 1, bpKey]
+        bpBedFile.write('\t'.join([str(x) for x in bpStr]) + '\n')
     bpBedFile.close()
     cmd = 'sort -k1,1 -k2,2n %s > %s' % (bpBedFn, bpBedFn + '.sorted')
     os.system(cmd)
@@ -200,18 +219,21 @@ def parse_bedtools_file(fn, fileKey, trxMap):
         if linesplit[4] == '.':
             return
 
-        if bpKey not in trxMap:
-            trxMap[bpKey] = {'intersect': None, 'upstream': None, 'downstream': None}
-        trx = Transcript(linesplit[4:])
-        dist = int(linesplit[-1])
-        checkStorage = ((fileKey != 'intersect') and (trxMap[bpKey]['intersect'] is None)) or (fileKey == 'intersect')
-        if checkStorage:
-            if trxMap[bpKey][fileKey] is None:
+        store_transcript(trxMap, bpKey, fileKey, Transcript(linesplit[4:]), int(linesplit[-1]))
+
+
+def store_transcript(trxMap, bpKey, fileKey, trx, dist):
+    """Store a transcript hit of a breakpoint, keeping the longest transcript of each hit type."""
+    if bpKey not in trxMap:
+        trxMap[bpKey] = {'intersect': None, 'upstream': None, 'downstream': None}
+    checkStorage = ((fileKey != 'intersect') and (trxMap[bpKey]['intersect'] is None)) or (fileKey == 'intersect')
+    if checkStorage:
+        if trxMap[bpKey][fileKey] is None:
+            trxMap[bpKey][fileKey] = [trx, dist]
+        else:
+            # Check if trx is longer (i.e. canonical) vs. current stored
+            if trx.len > trxMap[bpKey][fileKey][0].len:
                 trxMap[bpKey][fileKey] = [trx, dist]
-            else:
-                # Check if trx is longer (i.e. canonical) vs. current stored
-                if trx.len > trxMap[bpKey][fileKey][0].len:
-                    trxMap[bpKey][fileKey] = [trx, dist]
 
 
 def parse_bedtools_output(outputFileDict):
@@ -222,3 +244,27 @@ def parse_bedtools_output(outputFileDict):
     parse_bedtools_file(outputFileDict['upstream'], 'upstream', trxMap)
     parse_bedtools_file(outputFileDict['downstream'], 'downstream', trxMap)
     return trxMap
+
+
+def query_annotation_index(annotationIndex, bpValues):
+    """Map each breakpoint to its intersecting, or upstream and downstream, transcripts
+    with the in-process annotation index, as parse_bedtools_output() does with the
+    bedtools output.
+    Args:
+        annotationIndex: TranscriptIndex object.
+        bpValues:        List of tuples with the chromosome, position and key of each breakpoint.
+    Return:
+        trxMap: Dictionary of breakpoint key to the transcript hits.
+    """
+    trxMap = {}
+    bpHits = []
+    for chrom, coord, bpKey in sorted(bpValues):
+        hits = annotationIndex.query(chrom, coord)
+        if hits is not None:
+            bpHits.append((bpKey, hits))
+    # The intersecting transcripts are stored first, as the upstream and downstream hits are only kept without them.
+    for fileKey in ['intersect', 'upstream', 'downstream']:
+        for bpKey, hits in bpHits:
+            for values, dist in hits[fileKey]:
+                store_transcript(trxMap, bpKey, fileKey, Transcript(values + [str(dist)]), dist)
+    return trxMap
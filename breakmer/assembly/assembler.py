@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import re
+import time
 import logging
 from collections import OrderedDict
 import breakmer.assembly.contig as contig_assembler
@@ -13,17 +14,20 @@ __email__ = "ryanabo@gmail.com"
 __license__ = "MIT"
 
 
-def init_assembly(kmers, fqRecs, kmerLen, rcThresh, readLen):
+def init_assembly(kmers, fqRecs, kmerLen, rcThresh, readLen, budget=None):
     """Entry function for assemblying a contiguous sequence from
     a pool of sample only kmers and the reads that contain them.
     A kmer tracker object is instantiated containing all the kmer seqs and
     their associated counts. These are sorted by
+    If a budget is exceeded, no new contigs are seeded and the contigs
+    already in the buffer are completed with the reads assembled so far.
     Args:
         kmers: Dictionary of kmers only in the sample key = kmer, value = count in reads
         fqRecs: Dictionary with sequence values as keys and a list of fq_read objects.
         kmerLen: Integer of kmer size.
         rcThresh: Integer representing the minimum readcount threshold for keeping a contig.
         readLen: Integer of the read length.
+        budget: AssemblyBudget object limiting the work done for the target.
     Return:
         contigs: List of contig objects.
     """
@@ -40,12 +44,19 @@ def init_assembly(kmers, fqRecs, kmerLen, rcThresh, readLen):
     for kmer in kmers:
         kmerTracker.add_kmer(kmer, kmers[kmer])
 
+    if budget is None:
+        budget = AssemblyBudget()
+    budget.start()
+
     # While there are kmers to analyze continue to build contigs.
-    contigBuffer = ContigBuffer()
+    contigBuffer = ContigBuffer(budget)
     # Sort all the kmers by count and store in order.
     kmerTracker.set_all_kmer_values()
     # Check if there are any kmers left to seed the build process.
     while kmerTracker.has_mers():
+        if budget.exceeded():
+            logger.info('Assembly budget exceeded (%s), returning %d contigs built so far.' % (budget.get_tripped(), len(contigs)))
+            break
         # Update the set of kmers to consider for building.
         kmerTracker.update_kmer_set()
         # Get kmer seed for new contig.
@@ -54,6 +65,7 @@ def init_assembly(kmers, fqRecs, kmerLen, rcThresh, readLen):
         if kmer_count < 2:
             continue
         logger.info('Initiating kmer %s, found in %d reads' % (kmer, kmer_count))
+        budget.add_seed()
         setup_contigs(kmer, fqRecs, kmerLen, kmerTracker, contigBuffer)
 
         # Deal with buffered contig objects that need to be grown or completed.
@@ -69,6 +81,7 @@ def init_assembly(kmers, fqRecs, kmerLen, rcThresh, readLen):
         # Clean up the data to free up memory.
         contigBuffer.remove_kmers(kmerTracker)
         contigBuffer.remove_reads(fqRecs)
+    logger.info('Performed %d read alignments, skipped %d alignments with the kmer prefilter.' % (budget.alignments, budget.prefiltered))
     return contigs
 
 
@@ -93,7 +106,7 @@ def setup_contigs(kmerSeq, fqRecs, kmerLen, kmerTracker, contigBuffer):
     #   3. Boolean that a match was found.
     #   4. Length of the read sequence.
     #   5. Number of reads with this sequence.
-    kmerReads = assemblyUtils.find_reads(kmerSeq, fqRecs.items(), set())
+    kmerReads = contigBuffer.budget.limit_reads(assemblyUtils.find_reads(kmerSeq, fqRecs.items(), set()))
     contigBuffer.add_used_mer(kmerSeq)
     kmerObj = assemblyUtils.Kmer(kmerSeq, kmerTracker.get_count(kmerSeq), kmerTracker.kmerSeqs, kmerLen)
     for readVals in kmerReads:
@@ -108,22 +121,114 @@ def setup_contigs(kmerSeq, fqRecs, kmerLen, kmerTracker, contigBuffer):
             contigBuffer.add_contig(read, contig)
         # Check if read should be added to the existing contig.
         else:
-            contig.check_read(kmerObj, readAlignValues, 'setup')
+            contig.check_read(kmerObj, readAlignValues, 'setup', contigBuffer.budget)
     if contig:
         contig.finalize(fqRecs, kmerTracker, contigBuffer, 'setup')
 
 
+class AssemblyBudget:
+    """A class to limit the amount of assembly work performed for a single target.
+    A limit set to None (or 0) is not enforced. The first limit that is exceeded
+    is stored so that it can be reported for the target.
+    Attributes:
+        limits: Dictionary of the limit values keyed by budget name.
+        seeds: Integer of the number of kmers used to seed contigs.
+        alignments: Integer of the number of read-contig alignments performed.
+        prefiltered: Integer of the number of read-contig alignments skipped by the kmer prefilter.
+        startTime: Float of the time the assembly started.
+        tripped: String of the name of the first budget that was exceeded.
+    """
+    def __init__(self, maxSeeds=None, maxAlignments=None, maxKmerReads=None, maxTime=None):
+        self.limits = {'seeds': self.set_limit(maxSeeds),
+                       'alignments': self.set_limit(maxAlignments),
+                       'kmer_reads': self.set_limit(maxKmerReads),
+                       'time': self.set_limit(maxTime)}
+        self.seeds = 0
+        self.alignments = 0
+        self.prefiltered = 0
+        self.startTime = None
+        self.tripped = None
+
+    def set_limit(self, value):
+        """Return the limit as an integer or None if it is not set.
+        Args:
+            value: Integer, string or None value of the limit.
+        Return:
+            Integer limit value or None.
+        """
+        if value is None or str(value).strip() == '' or int(value) <= 0:
+            return None
+        return int(value)
+
+    def start(self):
+        """Set the start time of the assembly."""
+        self.startTime = time.time()
+
+    def add_seed(self):
+        """Increment the number of seed kmers used."""
+        self.seeds += 1
+
+    def add_alignment(self):
+        """Increment the number of alignments performed."""
+        self.alignments += 1
+
+    def add_prefiltered(self):
+        """Increment the number of alignments skipped by the kmer prefilter."""
+        self.prefiltered += 1
+
+    def limit_reads(self, kmerReads):
+        """Return the first N reads containing a kmer, N being the maximum reads per kmer.
+        Args:
+            kmerReads: List of tuples returned from assemblyUtils.find_reads.
+        Return:
+            kmerReads: List of tuples.
+        """
+        maxReads = self.limits['kmer_reads']
+        if maxReads is not None and len(kmerReads) > maxReads:
+            kmerReads = kmerReads[0:maxReads]
+        return kmerReads
+
+    def exceeded(self, checkSeeds=True):
+        """Check whether any of the limits have been exceeded.
+        Args:
+            checkSeeds: Boolean to indicate whether to check the seed limit. The seed limit
+                        only stops new contigs from being started, not contigs being grown.
+        Return:
+            True if a limit has been exceeded, False otherwise.
+        """
+        if self.tripped is not None:
+            return True
+        if checkSeeds and self.limits['seeds'] is not None and self.seeds >= self.limits['seeds']:
+            self.tripped = 'seeds'
+        elif self.limits['alignments'] is not None and self.alignments >= self.limits['alignments']:
+            self.tripped = 'alignments'
+        elif self.limits['time'] is not None and self.startTime is not None and (time.time() - self.startTime) >= self.limits['time']:
+            self.tripped = 'time'
+        return self.tripped is not None
+
+    def get_tripped(self):
+        """Return a string describing the limit that was exceeded or None."""
+        if self.tripped is None:
+            return None
+        usage = {'seeds': self.seeds,
+                 'alignments': self.alignments,
+                 'time': int(time.time() - self.startTime)}
+        return '%s limit %d reached (%d)' % (self.tripped, self.limits[self.tripped], usage[self.tripped])
+
+
 class ContigBuffer:
     """A class to track the used kmers and reads and their relation to contigs.
     Attributes:
         used_kmers: Set of kmer sequences that have been used to build contigs.
         used_reads: Set of read IDs that have been used to build contigs.
         contigs: OrderedDict to track reads and the contigs they contribute to.
+        budget: AssemblyBudget object to limit the assembly work.
     """
-    def __init__(self):
+    def __init__(self, budget=None):
         self.used_kmers = set()
         self.used_reads = set()
         self.contigs = OrderedDict()
+        self.budget = budget if budget is not None else AssemblyBudget()
 
     def add_contig(self, read, contig):
         """Add read to contigs dict with contig object it is connected to.
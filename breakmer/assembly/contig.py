@@ -11,6 +11,7 @@ import breakmer.assembly.utils as assemblyUtils
 import breakmer.realignment.realigner as realigner
 import breakmer.caller.sv_caller as sv_caller
 import breakmer.utils as utils
+import breakmer.processor.bam_handler as bam_handler
 import breakmer.annotation.sv_annotation as annotator
 import breakmer.plotting.sv_viz as svplotter
 
@@ -268,6 +269,7 @@ class Builder:
         kmerLen:        Integer of the kmer length.
         kmers:          List of kmer sequences that have contributed to building the contig.
         kmer_locs:      List of integers representing the positions of the kmers in the contig seq.
+        kmer_index:     Dictionary of kmer positions in the contig seq, reset when the seq changes.
     """
 
     def __init__(self, kmerObj, readAlignValues):
@@ -283,8 +285,9 @@ class Builder:
         self.kmerLen = kmerObj.kmerLen
         self.kmers = []
         self.kmer_locs = []
+        self.kmer_index = None
 
-    def check_read(self, kmerObj, readAlignValues, alignType):
+    def check_read(self, kmerObj, readAlignValues, alignType, budget=None):
         """Determine if the read should be added to the assembly or not.
         If the read aligns to the contig, set the fq_read status to used and indicate
         the AssemblyRead has been aligned. If the kmer is in more than 1 read and the
@@ -298,12 +301,13 @@ class Builder:
                          - 'align_pos': Integer position of kmer in read sequence
                          - 'nreads': Integer of number of reads with the same sequence.
             type: String indicating the state of this function.
+            budget: AssemblyBudget object to track the number of alignments performed.
         Return:
             hit: String value 'remove' or ''.
         """
         hit = ''
         self.read_batch.check_kmer_read(readAlignValues['align_pos'], readAlignValues['read'])
-        if self.check_align(kmerObj, readAlignValues, alignType):
+        if self.check_align(kmerObj, readAlignValues, alignType, budget):
             hit = 'remove'
             readAlignValues['read'].used = True
             self.read_batch.set_last_read_aligned()
@@ -313,7 +317,7 @@ class Builder:
             self.read_batch.delete.add(readAlignValues['read'])
         return hit
 
-    def check_align(self, kmerObj, readAlignValues, alignType='setup'):
+    def check_align(self, kmerObj, readAlignValues, alignType='setup', budget=None):
         """Check the alignment of the read sequence to the contig sequence.
         The read sequence must match at least 25% of the shortest sequence between
         the contig and the read and an identity at least 90%. If there is clear
@@ -330,6 +334,7 @@ class Builder:
                          - 'align_pos': Integer position of kmer in read sequence
                          - 'nreads': Integer of number of reads with the same sequence.
             type: String indicating the state of this function.
+            budget: AssemblyBudget object to track the number of alignments performed.
         Return:
             match: Boolean indicating if the read aligns sufficiently with the
                    contig sequence and will be added.
@@ -338,6 +343,13 @@ class Builder:
         queryRead = readAlignValues['read']
 
         minScore = float(min(len(self.seq), len(queryRead.seq))) / 4.0
+        # Skip the alignment if the read does not share enough kmers with the contig to meet the thresholds.
+        if not olcAssembly.kmer_diagonal_filter(self.get_kmer_index(), len(self.seq), queryRead.seq, self.kmerLen, minScore, 0.90):
+            if budget is not None:
+                budget.add_prefiltered()
+            return False
+        if budget is not None:
+            budget.add_alignment()
         alignManager = olcAssembly.AlignManager(self.seq, queryRead.seq, minScore, 0.90)
 
         if alignManager.check_align_thresholds():
@@ -383,6 +395,14 @@ class Builder:
             self.read_overlap_contig(alignManager.get_alignment(1), queryRead, readAlignValues['nreads'], kmerObj.kmerSeqSet, alignType)
         return match
 
+    def get_kmer_index(self):
+        """Return the kmer positions in the contig sequence, building them if the
+        sequence has changed.
+        """
+        if self.kmer_index is None:
+            self.kmer_index = olcAssembly.kmer_index(self.seq, self.kmerLen)
+        return self.kmer_index
+
     def set_superseq(self, read, nreads, start, end):
         """The read sequence contains the current contig sequence.
         Args:
@@ -393,6 +413,7 @@ class Builder:
         Return: None
         """
         self.seq = read.seq
+        self.kmer_index = None
         self.counts.set_superseq(read, nreads, start, end)
 
     def add_subseq(self, start, end, nreads, indel_only):
@@ -419,6 +440,7 @@ class Builder:
         Return: None
         """
         self.seq += post_seq
+        self.kmer_index = None
         self.counts.set_counts(start, end, nreads, indel_only)
         self.counts.extend_counts(len(post_seq), nreads, indel_only, 'post')
 
@@ -434,6 +456,7 @@ class Builder:
         Return: None
         """
         self.seq = pre_seq + self.seq
+        self.kmer_index = None
         self.counts.set_counts(start, end, nreads, indel_only)
         self.counts.extend_counts(len(pre_seq), nreads, indel_only, 'pre')
 
@@ -678,15 +701,12 @@ class Meta:
         bamOutFn = os.path.join(outputPath, self.id + "_reads.bam")
         utils.log(self.loggingName, 'info', 'Writing contig reads bam file %s' % bamOutFn)
         bam_out_sorted_fn = os.path.join(outputPath, self.id + "_reads.sorted.bam")
-        bamFile = pysam.Samfile(svBamReadsFn, 'rb')
+        bamFile = bam_handler.get_bam_file(svBamReadsFn)
         bam_out_f = pysam.Samfile(bamOutFn, 'wb', template=bamFile)
+        readKeys = get_read_keys(reads)
         for bam_read in bamFile.fetch():
-            for read in reads:
-                rid, idx = read.id.lstrip("@").split("/")
-                ridx, indel_only_read = idx.split("_")
-                if (bam_read.qname == rid) and ((ridx == '2' and bam_read.is_read2) or (ridx == '1' and bam_read.is_read1)):
-                    bam_out_f.write(bam_read)
-        bamFile.close()
+            if get_bam_read_key(bam_read) in readKeys:
+                bam_out_f.write(bam_read)
         bam_out_f.close()
         utils.log(self.loggingName, 'info', 'Sorting bam file %s to %s' % (bamOutFn, bam_out_sorted_fn))
         pysam.sort(bamOutFn, bam_out_sorted_fn.replace('.bam', ''))
@@ -695,6 +715,65 @@ class Meta:
         return bam_out_sorted_fn
 
 
+def get_read_keys(reads):
+    """Return the set of (read name, mate number) tuples of the assembled reads, with
+    read ids formatted as @<qname>/<1|2>_<indel_only>.
+    """
+    readKeys = set()
+    for read in reads:
+        rid, idx = read.id.lstrip("@").split("/")
+        ridx, indel_only_read = idx.split("_")
+        readKeys.add((rid, ridx))
+    return readKeys
+
+
+def get_bam_read_key(bamRead):
+    """Return the (read name, mate number) tuple of a bam read, None for unpaired reads."""
+    if bamRead.is_read1:
+        return (bamRead.qname, '1')
+    elif bamRead.is_read2:
+        return (bamRead.qname, '2')
+    return None
+
+
+def write_contigs_bam(outputPath, targetName, svBamReadsFn, contigs):
+    """Write the reads of all the contigs of a target to one sorted and indexed bam
+    file, with the contig id set in the CONTIG_TAG tag of each read. A read used by
+    several contigs is written once for each.
+    Args:
+        outputPath:   String of the target output directory.
+        targetName:   String of the target name.
+        svBamReadsFn: String of the sorted bam file of the target variant reads.
+        contigs:      List of Contig objects.
+    Return:
+        String of the sorted bam file name.
+    """
+    loggingName = 'breakmer.assembly.contig'
+    bamOutFn = os.path.join(outputPath, targetName + "_contig_reads.bam")
+    bamOutSortedFn = os.path.join(outputPath, targetName + "_contig_reads.sorted.bam")
+    utils.log(loggingName, 'info', 'Writing reads of %d contigs to bam file %s' % (len(contigs), bamOutFn))
+    readContigs = {}
+    for contig in contigs:
+        for readKey in get_read_keys(contig.reads):
+            readContigs.setdefault(readKey, []).append(contig.get_id())
+    bamFile = bam_handler.get_bam_file(svBamReadsFn)
+    bamOutFile = pysam.Samfile(bamOutFn, 'wb', template=bamFile)
+    for bamRead in bamFile.fetch():
+        readKey = get_bam_read_key(bamRead)
+        if readKey not in readContigs:
+            continue
+        tags = [x for x in bamRead.tags if x[0] != bam_handler.CONTIG_TAG]
+        for contigId in readContigs[readKey]:
+            bamRead.tags = tags + [(bam_handler.CONTIG_TAG, contigId)]
+            bamOutFile.write(bamRead)
+    bamOutFile.close()
+    utils.log(loggingName, 'info', 'Sorting bam file %s to %s' % (bamOutFn, bamOutSortedFn))
+    pysam.sort(bamOutFn, bamOutSortedFn.replace('.bam', ''))
+    utils.log(loggingName, 'info', 'Indexing bam file %s' % bamOutSortedFn)
+    pysam.index(bamOutSortedFn)
+    return bamOutSortedFn
+
+
 class Contig:
     """Interface class to assemble a contig and store data all the relevant data
     for the assembly.
@@ -722,7 +801,7 @@ class Contig:
         self.svEventResult = None
         self.realignment = None
 
-    def check_read(self, kmerObj, readAlignValues, fncType='setup'):
+    def check_read(self, kmerObj, readAlignValues, fncType='setup', budget=None):
         """Check if the read passed in can be added to the current contig.
         Wrapper function to Builder class check_read function.
         Args:
@@ -732,12 +811,13 @@ class Contig:
                          - 'align_pos': Integer position of kmer in read sequence
                          - 'nreads': Integer of number of reads with the same sequence.
             fncType: String indicating the state of this function.
+            budget: AssemblyBudget object to track the number of alignments performed.
         Return:
             String containing 'hit' or '' indicating that read matched contig seq
             or did not, respectively.
         """
         self.buffer.add(readAlignValues['read'].id)
-        return self.builder.check_read(kmerObj, readAlignValues, fncType)
+        return self.builder.check_read(kmerObj, readAlignValues, fncType, budget)
 
     def check_invalid(self, read_count_thresh, read_len):
         """Determine if the finished contig sequence meets minimum requirements for
@@ -831,7 +911,8 @@ class Contig:
         """Iterates through new sample only kmers in a contig assembly and tries to
         add more relevant reads to extend the contig assembly sequence.
         For each 'new' kmer, assess the reads that have the kmer. When this function
-        is complete, the contig is done assemblying.
+        is complete, the contig is done assemblying. If the assembly budget is exceeded
+        the contig is completed with the reads that have been added so far.
         Args:
             fqRecs:         Dictionary of fq_read objects key = sequence, value = list of fq_reads
             kmerTracker:    KmerTracker object containing all the kmer sequences.
@@ -842,12 +923,15 @@ class Contig:
         logger = logging.getLogger('breakmer.assembly.contig')
         if not self.setup:
             self.set_kmers(kmerTracker.kmerSeqs)
+        budget = contigBuffer.budget
         newKmers = self.refresh_kmers()
         while len(newKmers) > 0:
             iter = 0
             for kmer_lst in newKmers:
+                if budget.exceeded(False):
+                    break
                 kmerSeq, kmerPos, lessThanHalf, dist_half, order = kmer_lst
-                reads = self.get_kmer_reads(kmer_lst, fqRecs.items())
+                reads = budget.limit_reads(self.get_kmer_reads(kmer_lst, fqRecs.items()))
                 contigBuffer.add_used_mer(kmerSeq)
                 kmerObj = assemblyUtils.Kmer(kmerSeq, kmerTracker.get_count(kmerSeq), kmerTracker.kmerSeqs, kmerLen)
                 for read_lst in reads:
@@ -856,12 +940,15 @@ class Contig:
                     readAlignValues = {'read': read,
                                        'align_pos': kmerPos,
                                        'nreads': nreads}
-                    hit = self.check_read(kmerObj, readAlignValues, 'grow')
+                    hit = self.check_read(kmerObj, readAlignValues, 'grow', budget)
                     if hit == 'remove':
                         contigBuffer.remove_contig(read.id)
                 self.finalize(fqRecs, kmerTracker, contigBuffer, 'grow')
                 self.builder.checked_kmers.append(kmerSeq)
                 iter += 1
+            if budget.exceeded(False):
+                logger.info('Assembly budget exceeded (%s), stopping contig extension.' % budget.get_tripped())
+                break
             newKmers = self.refresh_kmers()
             logger.debug("%d kmers left to check" % len(newKmers))
         self.set_kmer_locs()
@@ -900,6 +987,14 @@ class Contig:
         self.realignment = realigner.RealignManager(self.meta.params, targetRefFns)
         self.realignment.realign(self)
 
+    def set_realignment(self, realignManager):
+        """Set the realignment manager for a contig realigned as part of a batch.
+        Args:
+            realignManager: RealignManager object.
+        Return: None
+        """
+        self.realignment = realignManager
+
     def make_calls(self):
         """
         """
@@ -915,17 +1010,28 @@ class Contig:
 
     def annotate_calls(self):
         """ """
-        if self.svEventResult and self.meta.params.get_param('gene_annotation_file') and self.meta.params.get_param('bedtools'):
+        if self.svEventResult and self.meta.params.get_param('gene_annotation_file') and (self.meta.params.get_param('bedtools') or self.meta.params.get_param('annotation_index')):
             annotator.annotate_event(self.svEventResult, self.meta)
 
-    def output_calls(self, outputPath, svReadsBamFn):
-        """ """
+    def output_calls(self, outputPath, svReadsBamFn, contigsBamFn=None):
+        """Write the call result, the contig reads and the pileup image.
+        Args:
+            outputPath:   String of the target output directory.
+            svReadsBamFn: String of the sorted bam file of the target variant reads.
+            contigsBamFn: String of the target bam file of all the contig reads, from
+                          write_contigs_bam(). A bam file of the contig reads is written
+                          if None.
+        Return: None
+        """
         if self.svEventResult:
             self.meta.write_result(self.svEventResult, outputPath)
-            readBamFn = self.meta.write_bam(outputPath, svReadsBamFn, self.reads)
+            if contigsBamFn is None:
+                readBamFn = self.meta.write_bam(outputPath, svReadsBamFn, self.reads)
+            else:
+                readBamFn = contigsBamFn
             if self.meta.params.get_param('generate_image') and not self.svEventResult.is_filtered():
                 # Generate image if option is set and the result is not being filtered out.
-                svplotter.generate_pileup_img(self.svEventResult, readBamFn, outputPath, self.get_id())
+                svplotter.generate_pileup_img(self.svEventResult, readBamFn, outputPath, self.get_id(), contigsBamFn is not None)
 
     def get_total_read_support(self):
         """Return the total read count supporting assembly."""
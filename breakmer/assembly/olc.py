@@ -107,6 +107,53 @@ def nw(seq1, seq2):
     return (align1, align2, prej, j, prei, i, max_i)
 
 
+def kmer_index(seq, kmerLen):
+    """Return a dictionary with the kmer sequences in seq as keys and a list
+    of their start positions as values.
+    """
+    index = {}
+    for i in range(len(seq) - kmerLen + 1):
+        index.setdefault(seq[i:i + kmerLen], []).append(i)
+    return index
+
+
+def kmer_diagonal_filter(seq1Index, seq1Len, seq2, kmerLen, scoreThresh, identThresh):
+    """Check whether seq2 shares enough kmers with seq1 on any diagonal to possibly
+    align with a score above scoreThresh and identity above identThresh.
+
+    The diagonals are the offsets between the positions of the kmers shared by the
+    two sequences. An alignment with E errors between overlapping sequences of length L
+    on a diagonal shares at least (L - E) - kmerLen + 1 - kmerLen * E kmers within E
+    diagonals of it (q-gram lemma). The maximum number of errors is limited by the
+    identity threshold, each error costs at least the mismatch/gap penalty.
+    Args:
+        seq1Index: Dictionary of kmer positions in seq1 from kmer_index().
+        seq1Len: Integer length of seq1.
+        seq2: String sequence to check against seq1.
+        kmerLen: Integer kmer length used to build seq1Index.
+        scoreThresh: Float minimum alignment score.
+        identThresh: Float minimum alignment identity.
+    Return:
+        Boolean, False if seq2 cannot align to seq1 meeting the thresholds.
+    """
+    # Identity values are rounded to two decimals in the Align class.
+    errorRate = (1.0 - (identThresh - 0.005)) / abs(min(mismatch_penalty, gap_penalty))
+    diagCounts = {}
+    for i in range(len(seq2) - kmerLen + 1):
+        for pos in seq1Index.get(seq2[i:i + kmerLen], []):
+            diagCounts[pos - i] = diagCounts.get(pos - i, 0) + 1
+    for diag in diagCounts:
+        overlap = min(seq1Len, diag + len(seq2)) - max(0, diag)
+        maxErrors = int(overlap * errorRate)
+        if (overlap + maxErrors) < scoreThresh:
+            continue
+        minShared = (overlap - maxErrors) - kmerLen + 1 - (kmerLen * maxErrors)
+        shared = sum([diagCounts.get(x, 0) for x in range(diag - maxErrors, diag + maxErrors + 1)])
+        if shared >= minShared:
+            return True
+    return False
+
+
 class Align:
     """
     """
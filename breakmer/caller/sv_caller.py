@@ -4,7 +4,6 @@
 import sys
 import os
 import math
-import pysam
 import breakmer.utils as utils
 
 __author__ = "Ryan Abo"
@@ -13,6 +12,28 @@ __email__ = "ryanabo@gmail.com"
 __license__ = "MIT"
 
 
+def merge_events(svEvents, maxDistance):
+    """Merge the events that call the same breakpoints, within a distance, into one
+    event. The event with the most split read support is kept and the read support
+    of the others is added to it.
+    Args:
+        svEvents:    List of SVEvent objects.
+        maxDistance: Integer of the maximum base pair distance between matching breakpoints.
+    Return:
+        mergedEvents: List of the distinct SVEvent objects, in the order of the input.
+    """
+    order = dict([(id(x), i) for i, x in enumerate(svEvents)])
+    mergedEvents = []
+    for svEvent in sorted(svEvents, key=lambda x: (-x.get_total_splitread_count(), -len(x.get_contig_seq()), order[id(x)])):
+        for mergedEvent in mergedEvents:
+            if mergedEvent.matches(svEvent, maxDistance):
+                mergedEvent.merge(svEvent)
+                break
+        else:
+            mergedEvents.append(svEvent)
+    return sorted(mergedEvents, key=lambda x: order[id(x)])
+
+
 class FilterValues:
     """
     """
@@ -32,6 +53,8 @@ class FilterValues:
         self.maxRealignmentGap = None
         self.deletedSeqs = None
         self.insertedSeqs = None
+        self.downsampleFactor = None
+        self.scaledSplitReadCounts = None
 
     def set_indel_values(self, blatResult, brkptCoverages):
         """ """
@@ -73,9 +96,18 @@ class FilterValues:
         self.maxSegmentOverlap = max(blatResult.seg_overlap)
         self.realignFreq = svEvent.get_realign_freq()
 
+    def set_downsample_values(self, downsampleFactor, splitReadCounts):
+        """Store the read downsampling factor and the split read counts scaled by it."""
+        if downsampleFactor > 1.0:
+            self.downsampleFactor = round(downsampleFactor, 2)
+            self.scaledSplitReadCounts = [int(round(x * downsampleFactor)) for x in splitReadCounts]
+
     def get_formatted_output_values(self, svType, svSubtype):
         """ """
         outputValues = {}
+        if self.downsampleFactor is not None:
+            outputValues['downsampleFactor'] = self.downsampleFactor
+            outputValues['scaledSplitReadCounts'] = ",".join([str(x) for x in self.scaledSplitReadCounts])
         if svType == 'indel':
             outputValues['maxeventSize'] = self.maxEventSize
             outputValues['realignFreq'] = self.realignFreq
@@ -158,6 +190,7 @@ class SVResult:
                 contigBrkpts.append(bp)
         self.splitReadCount = [contigCountTracker.get_counts(x, x, 'indel') for x in contigBrkpts]
         self.filterValues.set_indel_values(blatResult, self.splitReadCount)
+        self.filterValues.set_downsample_values(svEvent.get_downsample_factor(), self.splitReadCount)
 
     def format_rearrangement_values(self, svEvent):
         """ """
@@ -210,6 +243,7 @@ class SVResult:
         self.targetBreakpointStr = svEvent.get_brkpt_str('target')
         self.breakpointCoverageDepth = svEvent.get_brkpt_depths()
         self.splitReadCount = svEvent.get_splitread_count()
+        self.filterValues.set_downsample_values(svEvent.get_downsample_factor(), self.splitReadCount)
         self.contigSeq = svEvent.get_contig_seq()
         self.contigId = svEvent.get_contig_id()
 
@@ -218,6 +252,23 @@ class SVResult:
         self.filtered['status'] = True
         self.filtered['reason'].append(filterReason)
 
+    def merge(self, svResult, downsampleFactor):
+        """Add the read support of a result for the same breakpoints from another contig.
+        Contigs are assembled from distinct reads, so the split read counts are summed.
+        The discordant read pairs are counted from the target reads, so the larger count
+        is kept.
+        """
+        if len(self.splitReadCount) == len(svResult.splitReadCount):
+            self.splitReadCount = [x + y for x, y in zip(self.splitReadCount, svResult.splitReadCount)]
+            self.filterValues.set_downsample_values(downsampleFactor, self.splitReadCount)
+        if self.discReadCount is not None and svResult.discReadCount is not None:
+            self.discReadCount = max(self.discReadCount, svResult.discReadCount)
+        if self.svType == 'indel':
+            self.filterValues.brkptCoverages = [min(self.splitReadCount), max(self.splitReadCount)]
+        elif self.filterValues.brkptCoverages is not None and svResult.filterValues.brkptCoverages is not None:
+            # The sum of the minimum coverages is a lower bound of the merged minimum.
+            self.filterValues.brkptCoverages = [x + y for x, y in zip(self.filterValues.brkptCoverages, svResult.filterValues.brkptCoverages)]
+
     def get_old_formatted_output_values(self):
         """ """
         headerStr = ['genes',
@@ -448,21 +499,25 @@ class SVBreakpoints:
                 brkptStr.append(chrom + ':' + '-'.join([str(x) for x in bps]))
             return ','.join(brkptStr)
 
-    def get_brkpt_depths(self, sampleBamFn):
-        """ """
-        depths = []
-        bamfile = pysam.Samfile(sampleBamFn, 'rb')
+    def get_depth_positions(self):
+        """Return the list of chromosome and position tuples the breakpoint depths are reported for."""
+        positions = []
         for genomicBrkpt in self.genomicBrkpts['all']:
             chrom = genomicBrkpt[0].strip('chr')
-            bps = genomicBrkpt[1:]
-            for bp in bps:
-                alignedDepth = 0
-                alignedReads = bamfile.fetch(str(chrom), int(bp), int(bp) + 1)
-                for alignedRead in alignedReads:
-                    if alignedRead.is_duplicate or alignedRead.is_qcfail or alignedRead.is_unmapped or alignedRead.mapq < 10:
-                        continue
-                    alignedDepth += 1
-                depths.append(alignedDepth)
+            for bp in genomicBrkpt[1:]:
+                positions.append((str(chrom), int(bp)))
+        return positions
+
+    def get_brkpt_depths(self, coverage):
+        """Return the read depth at each breakpoint from the target region coverage, None
+        for the breakpoints outside the target region.
+        """
+        depths = []
+        for chrom, bp in self.get_depth_positions():
+            depth = None
+            if coverage is not None:
+                depth = coverage.get_depth(chrom, bp)
+            depths.append(depth)
         return depths
 
     def get_splitread_count(self):
@@ -514,6 +569,7 @@ class SVEvent:
         self.brkpts = SVBreakpoints()
         self.rearrDesc = None
         self.resultValues = SVResult()
+        self.mergedEvents = []
         self.add(blatResult)
 
     def add(self, blatResult):
@@ -632,12 +688,39 @@ class SVEvent:
     def get_brkpt_depths(self):
         """
         """
-        return self.brkpts.get_brkpt_depths(self.contig.get_sample_bam_fn())
+        return self.brkpts.get_brkpt_depths(self.contig.get_var_reads('sv').coverage)
+
+    def get_missing_depth_positions(self):
+        """Return the breakpoint positions without a depth from the target region coverage."""
+        positions = self.brkpts.get_depth_positions()
+        depths = self.resultValues.breakpointCoverageDepth
+        return [x for x, y in zip(positions, depths) if y is None]
+
+    def set_missing_depths(self, depths):
+        """Set the breakpoint depths that are outside the target region coverage.
+        Args:
+            depths: Dictionary of (chrom, position) tuples to read depth.
+        Return: None
+        """
+        positions = self.brkpts.get_depth_positions()
+        brkptDepths = self.resultValues.breakpointCoverageDepth
+        for i, position in enumerate(positions):
+            if brkptDepths[i] is None:
+                brkptDepths[i] = depths[position]
 
     def get_splitread_count(self):
         """ """
         return self.brkpts.get_splitread_count()
 
+    def get_downsample_factor(self):
+        """Return the factor the split read counts should be scaled by if the
+        variant reads in the target region were downsampled.
+        """
+        positions = []
+        for genomicBrkpt in self.get_genomic_brkpts()['target']:
+            positions.extend(genomicBrkpt[1:])
+        return self.contig.get_var_reads('sv').get_downsample_factor(positions)
+
     def set_filtered(self, filterReason):
         """ """
         self.resultValues.set_filtered(filterReason)
@@ -825,6 +908,44 @@ class SVEvent:
         """ """
         self.annotated = True
 
+    def get_brkpt_positions(self):
+        """Return the sorted list of chromosome and position tuples of the genomic breakpoints."""
+        positions = []
+        genomicBrkpts = self.get_genomic_brkpts()
+        for targetKey in ['target', 'other']:
+            for genomicBrkpt in genomicBrkpts[targetKey]:
+                for bp in genomicBrkpt[1:]:
+                    positions.append((str(genomicBrkpt[0]), int(bp)))
+        return sorted(positions)
+
+    def get_total_splitread_count(self):
+        """ """
+        return sum(self.resultValues.splitReadCount)
+
+    def matches(self, svEvent, maxDistance):
+        """Return True if the event has the same type and breakpoints as this event, within maxDistance."""
+        if (self.resultValues.svType, self.resultValues.svSubtype) != (svEvent.resultValues.svType, svEvent.resultValues.svSubtype):
+            return False
+        positions = self.get_brkpt_positions()
+        otherPositions = svEvent.get_brkpt_positions()
+        if len(positions) == 0 or len(positions) != len(otherPositions):
+            return False
+        for (chrom, bp), (otherChrom, otherBp) in zip(positions, otherPositions):
+            if chrom != otherChrom or abs(bp - otherBp) > maxDistance:
+                return False
+        return True
+
+    def merge(self, svEvent):
+        """Merge an event for the same breakpoints from another contig into this event."""
+        utils.log(self.loggingName, 'info', 'Merging event of contig %s into event of contig %s' % (svEvent.get_contig_id(), self.get_contig_id()))
+        self.resultValues.merge(svEvent.resultValues, self.get_downsample_factor())
+        self.mergedEvents.append(svEvent)
+        self.mergedEvents.extend(svEvent.mergedEvents)
+
+    def get_merged_contig_ids(self):
+        """ """
+        return [x.get_contig_id() for x in self.mergedEvents]
+
     def set_failed_annotation(self):
         """ """
         self.failed_annotation = True
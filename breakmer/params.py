@@ -6,10 +6,12 @@ import sys
 import logging
 import random
 import subprocess
-import time
 import pysam
 import shutil
 import breakmer.utils as utils
+import breakmer.realignment.realigner as realigner
+import breakmer.realignment.gf_server as gf_server
+import breakmer.realignment.genome_index as genome_index
 import breakmer.caller.filter as resultfilter
 
 __author__ = "Ryan Abo"
@@ -74,6 +76,9 @@ class ParamManager:
         self.set_targets()
         self.paths['ref_data'] = os.path.abspath(os.path.normpath(self.opts['reference_data_dir']))  # Path to target reference sequence fast files.
         self.set_param('reference_fasta_dir', os.path.split(self.opts['reference_fasta'])[0])  # Path to genome fasta file.
+        self.set_partner_regions()
+        self.set_genome_index()
+        self.set_panel_blast_db()
 
         # If only preseting the reference data no need to continue.
         if self.fncCmd == 'prepare_reference_data':
@@ -95,6 +100,8 @@ class ParamManager:
             if not os.path.exists(self.paths[path]):
                 os.makedirs(self.paths[path])
 
+        self.set_contig_registry()
+
         # If starting the blat server then return.
         if self.fncCmd == 'start_blat_server':
             utils.log(self.loggingName, 'info', 'Starting the blat server.')
@@ -192,6 +199,8 @@ class ParamManager:
                     'fatotwobit', 
                     'cutadapt', 
                     'jellyfish')
+        if self.get_param('genome_index') is not None:  # No blat server is used with the local genome index.
+            binaries = ('blat', 'cutadapt', 'jellyfish')
         for binaryName in binaries:
             binaryPath = self.get_param(binaryName)
             if binaryPath is not None:
@@ -316,11 +325,114 @@ class ParamManager:
         # print 'Targets', self.targets
         utils.log(self.loggingName, 'info', '%d targets' % len(self.targets))
 
-    def check_blat_server(self):
-        """Run a test query on the specified blat server to make sure it is running. 
+    def set_partner_regions(self):
+        """Extract and index the fusion partner regions, if a partner regions bed file is
+        provided. Contigs without a target alignment are realigned to these regions
+        before the genome.
+
+        The partner region sequences are written to the reference data directory with
+        the seed index used by the in-process aligner. Both are reused by later runs
+        until the bed file changes.
+
+        Args:
+            None
+        Returns:
+            None
+        """
+
+        bedFn = self.get_param('partner_regions_bed')
+        if bedFn is None:
+            return
+        partnerPath = os.path.join(self.paths['ref_data'], 'partner_regions')
+        faFn = utils.setup_partner_regions(bedFn, self.get_param('reference_fasta'), partnerPath)
+        realigner.index_partner_regions(faFn)
+        self.set_param('partner_regions_fa', faFn)
+
+    def set_genome_index(self):
+        """Build the local genome minimizer index, if it is used for genome realignment
+        in place of the blat server. The index is written once to the reference data
+        directory and reused by later runs.
+
+        Args:
+            None
+        Returns:
+            None
+        """
+
+        if not self.get_param('local_genome_index'):
+            return
+        indexPath = os.path.join(self.paths['ref_data'], 'genome_index')
+        if not os.path.exists(indexPath):
+            os.makedirs(indexPath)
+        refFastaName = os.path.basename(self.get_param('reference_fasta').split(".fa")[0])
+        indexFn = os.path.join(indexPath, refFastaName + '.mzi')
+        if os.path.isfile(indexFn) and os.path.getmtime(indexFn) >= os.path.getmtime(self.get_param('reference_fasta')):
+            utils.log(self.loggingName, 'info', 'Genome index %s exists already' % indexFn)
+        else:
+            utils.log(self.loggingName, 'info', 'Building genome index %s from %s' % (indexFn, self.get_param('reference_fasta')))
+            genome_index.build_index(self.get_param('reference_fasta'), indexFn)
+        self.set_param('genome_index', indexFn)
+
+    def set_panel_blast_db(self):
+        """Build one blast database of the reference sequences of all the panel targets,
+        if blast target realignment is used with the panel database option. The workers
+        search their contig batches against this database in place of the per-target
+        databases.
 
         Args:
             None
+        Returns:
+            None
+        """
+
+        if not self.get_param('panel_blast_db') or self.get_param('blast') is None:
+            return
+        panelPath = os.path.join(self.paths['ref_data'], 'panel_blast_db')
+        dbFn = utils.setup_panel_blast_db(self.targets, self.get_param('reference_fasta'), panelPath, self.get_param('blast'))
+        if dbFn is None:
+            utils.log(self.loggingName, 'info', 'Panel blast database not available, using the per-target blast databases')
+            return
+        self.set_param('panel_blast_db_fn', dbFn)
+
+    def set_contig_registry(self):
+        """Set up an empty contig registry in the analysis directory, if contig deduplication
+        is on. Contigs with a sequence registered by another contig of the run are not
+        realigned or called.
+
+        Args:
+            None
+        Returns:
+            None
+        """
+
+        if not self.get_param('dedup_contigs') or self.fncCmd != 'run':
+            return
+        registryPath = os.path.join(self.paths['analysis'], 'contig_registry')
+        if os.path.exists(registryPath):
+            shutil.rmtree(registryPath)
+        os.makedirs(registryPath)
+        self.set_param('contig_registry_dir', registryPath)
+
+    def get_blat_ports(self):
+        """Get the ports of the gfServer instances, consecutive ports from the blat port
+        for the number of gfserver_instances.
+
+        Args:
+            None
+        Returns:
+            List of integer ports.
+        """
+
+        ninstances = 1
+        if self.get_param('gfserver_instances') is not None:
+            ninstances = max(1, int(self.get_param('gfserver_instances')))
+        return [int(self.get_param('blat_port')) + i for i in range(ninstances)]
+
+    def check_blat_server(self, port=None):
+        """Run a test query on the specified blat server to make sure it is running. 
+
+        Args:
+            port (int): Port of the gfServer instance to test, the blat port if None.
         Returns:
             serverSuccess (boolean): Indicates whether the test ran without errors.
         Raises:
@@ -335,8 +447,10 @@ class ParamManager:
         testFa.write('>test\nCCAAGGGAGACTTCAAGCAGAAAATCTTTAAGGGACCCTTGCATAGCCAGAAGTCCTTTTCAGGCTGATGTACATAAAATATTTAGTAGCCAGGACAGTAGAAGGACTGAAGAGTGAGAGGAGCTCCCAGGGCCTGGAAAGGCCACTTTGTAAGCTCATTCTTG')
         testFa.close()
 
-        resultFn = os.path.join(testDir, 'blatserver_test.psl')
-        cmd = '%s -t=dna -q=dna -out=psl -minScore=20 -nohead %s %d %s %s %s' % (self.get_param('gfclient'), self.get_param('blat_hostname'), self.get_param('blat_port'), self.get_param('reference_fasta_dir'), testFaFn, resultFn)
+        if port is None:
+            port = self.get_param('blat_port')
+        resultFn = os.path.join(testDir, 'blatserver_test_%d.psl' % port)
+        cmd = '%s -t=dna -q=dna -out=psl -minScore=20 -nohead %s %d %s %s %s' % (self.get_param('gfclient'), self.get_param('blat_hostname'), port, self.get_param('reference_fasta_dir'), testFaFn, resultFn)
         utils.log(self.loggingName, 'info', 'Blat server test system command %s' % cmd)
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
         output, errors = p.communicate()
@@ -352,8 +466,8 @@ class ParamManager:
         The required files to start a blat server are first checked and created, if
         necessary. These include a genome-wide reference fasta file and a 2bit
         file generated from that fasta file. The faToTwoBit program is used if the
-        2bit file needs to be generated on the fly. The gfServer is started and
-        we wait while the server is successfully started.
+        2bit file needs to be generated on the fly. The gfServer instances are started
+        and we wait until each one answers a test query.
 
         Args:
             None
@@ -363,6 +477,9 @@ class ParamManager:
 
         if self.fncCmd == 'prepare_reference_data':  # Do not start blat server for this function.
             return
+        elif self.get_param('genome_index') is not None:  # Genome realignment uses the local index.
+            utils.log(self.loggingName, 'info', 'Using genome index %s for genome realignment, no blat server started.' % self.get_param('genome_index'))
+            return
         elif self.fncCmd == 'start_blat_server':
             port = self.get_param('blat_port')
             hostname = self.get_param('blat_hostname')
@@ -380,12 +497,16 @@ class ParamManager:
                 if port is None:  # No port is specified for a server that should be running. It will start a new one on a random numbered port.
                     utils.log(self.loggingName, 'debug', 'BreaKmer set to run and start_blat_server is set to False, but no blat server port is specified. Setting blat port to random value and starting blat server.')
                     self.set_param('blat_port', random.randint(8000, 9500))
-                else:  # Blat server is already running in this instance. Check it to make sure with a test blat.
+                else:  # Blat server is already running in this instance. Check each instance to make sure with a test blat.
                     self.set_param('blat_port', int(self.get_param('blat_port')))
-                    if self.check_blat_server():  # Both port and hostname are specified. Check that the server is running.
+                    ports = self.get_blat_ports()
+                    failedPorts = [x for x in ports if not self.check_blat_server(x)]
+                    if len(failedPorts) == 0:  # Both port and hostname are specified. Check that the servers are running.
+                        self.set_param('blat_ports', ports)
+                        utils.log(self.loggingName, 'info', 'Using %d running gfServer instances on ports %s' % (len(ports), ','.join([str(x) for x in ports])))
                         return
                     else:
-                        utils.log(self.loggingName, 'debug', 'Blat server with port %d and hostname %s did not pass test query. Please check specifications.' % (self.get_param('blat_port'), self.get_param('blat_hostname')))
+                        utils.log(self.loggingName, 'debug', 'Blat server with ports %s and hostname %s did not pass test query. Please check specifications.' % (','.join([str(x) for x in failedPorts]), self.get_param('blat_hostname')))
 
         self.set_param('reference_fasta_dir', os.path.split(self.get_param('reference_fasta'))[0])
         refFastaName = os.path.basename(self.get_param('reference_fasta').split(".fa")[0])
@@ -400,24 +521,34 @@ class ParamManager:
             output, errors = p.communicate()
             os.chdir(curdir)
 
-        curdir = os.getcwd()
-        os.chdir(self.get_param('reference_fasta_dir'))
-        # Start gfServer, change dir to 2bit file, gfServer start localhost 8000 .2bit
-        self.set_param('gfserver_log', os.path.join(self.paths['output'], 'gfserver_%d.log' % self.get_param('blat_port')))
-        cmd = '%s -canStop -log=%s -stepSize=5 start %s %d %s &' % (self.get_param('gfserver'), self.get_param('gfserver_log'), self.get_param('blat_hostname'), self.get_param('blat_port'), refFastaName + ".2bit")
-        utils.log(self.loggingName, 'info', "Starting gfServer %s" % cmd)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        startTime = time.time()
-        while not utils.server_ready(self.get_param('gfserver_log')):  # Wait for the blat server to initiate. Timeout if it has not started in 15 minutes.
-            newTime = time.time()
-            waitTime = newTime - startTime
-            if waitTime > 1000:
-                utils.log(self.loggingName, 'error', 'gfServer wait time exceeded ~15 minutes, exiting')
-                sys.exit(1)
-            utils.log(self.loggingName, 'info', 'Waiting for blat gfServer to load reference seq')
-            time.sleep(60)
-        utils.log(self.loggingName, 'info', 'Server ready!')
-        os.chdir(curdir)
+        # Start the gfServer instances on consecutive ports from the 2bit file directory.
+        ports = self.get_blat_ports()
+        self.set_param('blat_ports', ports)
+        self.set_param('gfserver_log', os.path.join(self.paths['output'], 'gfserver_%d.log' % ports[0]))
+        serverPool = gf_server.GfServerPool(self.get_param('gfserver'), self.get_param('blat_hostname'), ports, self.get_param('blat_2bit'), self.paths['output'])
+        if not serverPool.start():  # Wait for the instances to answer a test query. Timeout if they have not started in ~15 minutes.
+            serverPool.stop()
+            utils.log(self.loggingName, 'error', 'gfServer instances failed to start, exiting')
+            sys.exit(1)
+        utils.log(self.loggingName, 'info', 'Server ready! %d gfServer instances on ports %s' % (len(ports), ','.join([str(x) for x in ports])))
+
+    def stop_blat_server(self):
+        """Stop the gfServer instances used for the analysis. Instances started by this
+        run are shut down with their processes, otherwise the stop command is sent
+        to the server port.
+
+        Args:
+            None
+        Return:
+            None
+        """
+
+        if self.get_param('genome_index') is not None:
+            return
+        ports = self.get_param('blat_ports')
+        if ports is None:
+            ports = self.get_blat_ports()
+        gf_server.stop_servers(self.get_param('blat_hostname'), ports)
 
     def get_target_names(self):
         """Get a list of target names.
@@ -4,7 +4,6 @@
 import os
 import sys
 import re
-import pysam
 from math import log
 import matplotlib
 matplotlib.use('Agg')
@@ -12,6 +11,7 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib import patches
 import breakmer.assembly.olc as olcAssembly
+import breakmer.processor.bam_handler as bam_handler
 
 __author__ = "Ryan Abo"
 __copyright__ = "Copyright 2015, Ryan Abo"
@@ -258,12 +258,20 @@ class AlignSegments:
         return colors
 
 
-def generate_pileup_img(svEventResult, bamReadsFn, outPath, contigId):
-    """ """
+def generate_pileup_img(svEventResult, bamReadsFn, outPath, contigId, contigTagged=False):
+    """Plot the contig reads pileup. If contigTagged is True, the bam file holds the reads
+    of all the target contigs and only the reads tagged with the contig id are plotted.
+    """
     segmentManager = AlignSegments(svEventResult)
     # print 'sv_viz.py svEvent output', svEventResult.get_formatted_output_values()
-    bamFile = pysam.Samfile(bamReadsFn, "rb")
-    segmentManager.set_orderedseqs(pile_reads(bamFile.fetch(), svEventResult.contig.seq))
+    bamFile = bam_handler.get_bam_file(bamReadsFn)
+    reads = bamFile.fetch()
+    if contigTagged:
+        reads = [x for x in reads if dict(x.tags).get(bam_handler.CONTIG_TAG) == contigId]
+    segmentManager.set_orderedseqs(pile_reads(reads, svEventResult.contig.seq))
+    if not contigTagged:
+        # The contig read bam is only plotted once.
+        bam_handler.release_bam_file(bamReadsFn)
     plot_pileup(segmentManager, os.path.join(outPath, contigId))
 
 
@@ -819,7 +827,7 @@ def plot_global_trx_track(ax, yCoord, xOffset, segmentManager):
                 trx = segTrx.trx
                 # print 'Trx', trx
                 brkpts = segTrx.brkpts
-                exons = sorted(trx.exons, key=lambda x: x.start)
+                exons = sorted(trx.get_exons(), key=lambda x: x.start)
                 # print 'Exons', exons
 
                 parsedExons = []
@@ -1005,7 +1013,7 @@ def plot_annotation_track(ax, yCoord, xOffset, segmentManager):
 
                 # Sort the exons increasing in genome coordinate if the transcript is coded on the + strand.
                 # Sort in decreasing order if the transcript is coded on the - strand.
-                exons = sorted(trx.exons, key=lambda x: x.start, reverse=trx_reverse)
+                exons = sorted(trx.get_exons(), key=lambda x: x.start, reverse=trx_reverse)
 
                 # for brkpt in brkpts:
                 #     print 'SV breakpoints for segTrx', brkpt.dist, brkpt.svBrkpt.chrom, brkpt.svBrkpt.svType, brkpt.svBrkpt.genomicCoords[brkpt.brkptIdx], brkpt.brkptIdx, segment.strand
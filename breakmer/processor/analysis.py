@@ -69,7 +69,7 @@ def analyze_targets(targetList):
         None
     """
 
-    aggregateResults = {'contigs': [], 'discreads': []}  # Formatted output strings for contig based calls and discordant read calls are different.
+    aggregateResults = {'contigs': [], 'discreads': [], 'duplicates': [], 'merged': []}  # Formatted output strings for contig based calls and discordant read calls are different.
     for targetRegion in targetList:
         # print 'Analyzing', targetRegion.name
         utils.log('breakmer.processor.analysis', 'info', 'Analyzing %s' % targetRegion.name)
@@ -80,6 +80,8 @@ def analyze_targets(targetList):
             continue
         targetRegion.compare_kmers()  # Perform kmer subtraction.
         targetRegion.resolve_sv()  # Assemble extracted reads and make calls.
+        aggregateResults['duplicates'].extend(targetRegion.duplicates)
+        aggregateResults['merged'].extend(targetRegion.mergedContigs)
         if targetRegion.has_results():
             outputs = targetRegion.get_formatted_output()
             for key in outputs:
@@ -126,7 +128,7 @@ class RunTracker:
 
         targetAnalysisList = self.create_targets()
 
-        aggResults = {'contigs': [], 'discreads': []}  # Buffer the formatted output strings for each target to write out in batch.
+        aggResults = {'contigs': [], 'discreads': [], 'duplicates': [], 'merged': []}  # Buffer the formatted output strings for each target to write out in batch.
         nprocs = int(self.params.get_param('nprocs'))
         if nprocs > 1:  # Make use of multiprocessing by mapping targets to n jobs.
             utils.log(self.loggingName, 'info', 'Creating all reference data.')
@@ -139,6 +141,8 @@ class RunTracker:
                 a = multiprocResult.get()
                 aggResults['contigs'].extend(a['contigs'])
                 aggResults['discreads'].extend(a['discreads'])
+                aggResults['duplicates'].extend(a['duplicates'])
+                aggResults['merged'].extend(a['merged'])
         else:
             aggResults = analyze_targets(targetAnalysisList)
 
@@ -146,12 +150,12 @@ class RunTracker:
             print 'Reference data setup!'
             return
 
+        self.add_duplicate_results(aggResults)
         self.write_aggregated_output(aggResults)
         utils.log(self.loggingName, 'info', 'Analysis complete in %s' % str(time.clock() - startTime))
 
         if not self.params.get_param('keep_blat_server'):  # Keep blat server is specified.
-            cmd = '%s stop %s %d' % (self.params.get_param('gfserver'), self.params.get_param('blat_hostname'), int(self.params.get_param('blat_port')))
-            os.system(cmd)
+            self.params.stop_blat_server()
         print 'Analysis complete!'
 
     def create_targets(self):
@@ -206,6 +210,52 @@ class RunTracker:
                 trgtGroups.append(trgtGroup)
         return trgtGroups
 
+    def add_duplicate_results(self, aggregateResults):
+        """Report the calls of the contigs that were skipped as duplicates for the targets
+        that assembled them. The calls of the owner contig are copied with the target name
+        of the duplicate, added to the aggregated results and to the duplicate target
+        result file.
+
+        Args:
+            aggregateResults (dict): A dictionary containing the formatted output string values.
+        Returns:
+            None
+        """
+
+        if len(aggregateResults['duplicates']) == 0 or len(aggregateResults['contigs']) == 0:
+            return
+        ownerResults = {}
+        for headerStr, formattedResultValuesStr in aggregateResults['contigs']:
+            contigIdx = headerStr.split('\t').index('Contig_ID')
+            contigId = formattedResultValuesStr.split('\t')[contigIdx]
+            ownerResults.setdefault(contigId, []).append((headerStr, formattedResultValuesStr))
+
+        # Owner contigs with an event merged into the event of another contig report that contig's calls.
+        mergedContigIds = dict(aggregateResults['merged'])
+        targetResults = {}
+        for targetName, contigId, ownerTargetName, ownerContigId in aggregateResults['duplicates']:
+            ownerContigId = mergedContigIds.get(ownerContigId, ownerContigId)
+            for headerStr, formattedResultValuesStr in ownerResults.get(ownerContigId, []):
+                resultValues = formattedResultValuesStr.split('\t')
+                resultValues[0] = targetName
+                targetResults.setdefault(targetName, []).append((headerStr, '\t'.join(resultValues)))
+
+        for targetName in sorted(targetResults):
+            utils.log(self.loggingName, 'info', 'Adding %d calls of duplicate contigs to target %s' % (len(targetResults[targetName]), targetName))
+            aggregateResults['contigs'].extend(targetResults[targetName])
+            outputPath = os.path.join(self.params.paths['output'], targetName)
+            if not os.path.exists(outputPath):
+                os.makedirs(outputPath)
+            resultFn = os.path.join(outputPath, targetName + "_svs.out")
+            writeHeader = not os.path.isfile(resultFn)
+            resultFile = open(resultFn, 'a')
+            for headerStr, formattedResultValuesStr in targetResults[targetName]:
+                if writeHeader:
+                    resultFile.write(headerStr + '\n')
+                    writeHeader = False
+                resultFile.write(formattedResultValuesStr + '\n')
+            resultFile.close()
+
     def write_aggregated_output(self, aggregateResults):
         """Write the SV calls to a top level file in the specified output directory.
         Header is written at the top of the file if option to remove is not
@@ -6,6 +6,10 @@
 This module contains the classes and functions to handle the
 """
 
+import os
+import zlib
+import array
+import bisect
 import pysam
 
 __author__ = "Ryan Abo"
@@ -13,6 +17,14 @@ __copyright__ = "Copyright 2015, Ryan Abo"
 __email__ = "ryanabo@gmail.com"
 __license__ = "MIT"
 
+# Bam files opened in this worker process, keyed by path with the modification time
+# and the open pysam bam file object. Handles are not shared with forked processes.
+BAM_FILES = {}
+BAM_FILES_PID = [None]
+
+# Bam tag holding the contig id of the reads in a target contig read bam file.
+CONTIG_TAG = 'ci'
+
 
 def trim_qual(read, min_qual, min_len):
     qual_str = read.qual
@@ -195,9 +207,46 @@ def pe_meta(read):
     return properMap, overlapReads
 
 
+def get_bam_file(bamFile):
+    """Return the open bam file object for a path, opening it on first use in this
+    process so the header and index are loaded once. A file modified since it was
+    opened is reopened. Callers borrow the handle and must not close it.
+
+    Args:
+        bamFile (str): Bam file full path, index must be in the same location
+    Return:
+        bamF (pysam bam object): Open pysam bam file object.
+    """
+
+    if BAM_FILES_PID[0] != os.getpid():
+        BAM_FILES.clear()
+        BAM_FILES_PID[0] = os.getpid()
+    key = os.path.abspath(bamFile)
+    mtime = os.path.getmtime(bamFile)
+    if key in BAM_FILES and BAM_FILES[key][0] != mtime:
+        release_bam_file(bamFile)
+    if key not in BAM_FILES:
+        BAM_FILES[key] = (mtime, pysam.Samfile(bamFile, 'rb'))
+    return BAM_FILES[key][1]
+
+
+def release_bam_file(bamFile):
+    """Close the bam file object for a path if it is open in this process.
+
+    Args:
+        bamFile (str): Bam file full path.
+    Return:
+        None
+    """
+
+    key = os.path.abspath(bamFile)
+    if BAM_FILES_PID[0] == os.getpid() and key in BAM_FILES:
+        BAM_FILES.pop(key)[1].close()
+
+
 def get_region_reads(bamFile, chrom, start, end):
-    """Open BAM file using pysam and fetch aligned reads in the
-    specified region.
+    """Fetch aligned reads in the specified region from the bam file
+    object borrowed from this process's open bam files.
 
     Args:
         bamFile (str): Bam file full path, index must be in the same location
@@ -209,7 +258,7 @@ def get_region_reads(bamFile, chrom, start, end):
         bamF (pysam bam object): Open pysam bam file object.
     """
 
-    bamF = pysam.Samfile(bamFile, 'rb')
+    bamF = get_bam_file(bamFile)
     reads = bamF.fetch(chrom, start, end)
     return (reads, bamF)
 
@@ -233,7 +282,9 @@ def get_variant_reads(bamFile, chrom, start, end, insertSizeThresh):
 
     reads, bamF = get_region_reads(bamFile, chrom, start, end)
     varReadTracker = VariantReadTracker(bamF, insertSizeThresh)
+    varReadTracker.coverage = RegionCoverage(chrom, start, end)
     for read in reads:
+        varReadTracker.coverage.add_read(read)
         skip = False
         if read.mate_is_unmapped or read.rnext == -1:
             read.mate_is_unmapped = True
@@ -248,6 +299,45 @@ def get_variant_reads(bamFile, chrom, start, end, insertSizeThresh):
     return varReadTracker
 
 
+def is_depth_read(read):
+    """Return True if the read is counted in the breakpoint read depth."""
+    return not (read.is_duplicate or read.is_qcfail or read.is_unmapped or read.mapq < 10)
+
+
+def get_brkpt_depths(bamFile, positions, maxGap=1000):
+    """Count the read depth at a list of genomic positions with one sweep over the
+    sorted positions. Positions within maxGap of each other are counted from a single
+    fetch of the reads spanning them.
+
+    Args:
+        bamFile (str):      Path to the indexed bam file.
+        positions (list):   List of (chrom, position) tuples.
+        maxGap (int):       Largest distance between positions counted from one fetch.
+    Return:
+        depths (dict): Dictionary with (chrom, position) tuples as keys and read depth as values.
+    """
+
+    depths = dict([(x, 0) for x in positions])
+    bamF = get_bam_file(bamFile)
+    groups = []
+    for chrom, pos in sorted(depths):
+        if len(groups) > 0 and groups[-1][0] == chrom and (pos - groups[-1][1][-1]) <= maxGap:
+            groups[-1][1].append(pos)
+        else:
+            groups.append((chrom, [pos]))
+    for chrom, groupPositions in groups:
+        counts = [0] * len(groupPositions)
+        for read in bamF.fetch(str(chrom), groupPositions[0], groupPositions[-1] + 1):
+            if not is_depth_read(read):
+                continue
+            # Count the read at each position within its aligned span.
+            for i in range(bisect.bisect_left(groupPositions, read.pos), bisect.bisect_left(groupPositions, read.aend)):
+                counts[i] += 1
+        for pos, count in zip(groupPositions, counts):
+            depths[(chrom, pos)] = count
+    return depths
+
+
 def get_strand_str(isReverseBoolean):
     strand = '+'
     if isReverseBoolean:
@@ -575,6 +665,193 @@ class discReads:
         return discReadCount
 
 
+class ReadDownsampler:
+    """A class to cap the number of variant reads kept in each genomic window
+    of a target region.
+
+    The reads kept are selected from a hash of the read name so the selection is
+    deterministic between runs and both reads of a pair are kept or dropped
+    together. The fraction of reads kept in a window adapts to the number of
+    candidate reads in that window, windows with fewer reads than the cap are
+    not downsampled.
+
+    Attributes:
+        maxReads (int):     Maximum number of read pairs to keep in a window.
+        windowSize (int):   Size of the genomic windows in base pairs.
+        windows (dict):     Dictionary with window index as key and a dictionary with
+                            'total', 'kept' and 'dropped' read counts as value.
+    """
+
+    def __init__(self, maxReads, windowSize):
+        """
+        """
+
+        self.maxReads = int(maxReads)
+        self.windowSize = max(1, int(windowSize))
+        self.windows = {}
+        self.keepFractions = {}
+
+    def get_window(self, read):
+        """Return the window index for a read. The leftmost position of the read pair
+        is used when both reads are mapped to the same chromosome so that both reads
+        fall into the same window.
+
+        Args:
+            read (pysam read obj): Aligned sequence read.
+        Return:
+            Integer window index.
+        """
+
+        pos = read.pos
+        if read.is_unmapped:
+            pos = read.mpos
+        elif not read.mate_is_unmapped and read.tid == read.rnext:
+            pos = min(read.pos, read.mpos)
+        return pos / self.windowSize
+
+    def get_hash_fraction(self, qname):
+        """Return a value between 0 and 1 determined from the read name.
+
+        Args:
+            qname (str): Read name.
+        Return:
+            Float value between 0 and 1.
+        """
+
+        return float(zlib.crc32(qname) & 0xffffffff) / 4294967296.0
+
+    def set_windows(self, reads):
+        """Count the number of read pairs in each window and determine the fraction of
+        the pairs to keep.
+
+        Args:
+            reads (list): List of pysam read objects that are candidates to keep.
+        Return:
+            None
+        """
+
+        windowReads = {}
+        for read in reads:
+            windowReads.setdefault(self.get_window(read), set()).add(read.qname)
+        for window in windowReads:
+            total = len(windowReads[window])
+            self.windows[window] = {'total': total, 'kept': 0, 'dropped': 0}
+            self.keepFractions[window] = min(1.0, float(self.maxReads) / float(total))
+            for qname in windowReads[window]:
+                if self.check_keep(qname, window):
+                    self.windows[window]['kept'] += 1
+                else:
+                    self.windows[window]['dropped'] += 1
+
+    def check_keep(self, qname, window):
+        """Determine if a read pair in a window is kept."""
+
+        return self.get_hash_fraction(qname) < self.keepFractions[window]
+
+    def keep(self, read):
+        """Determine if a read is kept.
+
+        Args:
+            read (pysam read obj): Aligned sequence read.
+        Return:
+            Boolean indicating whether the read is kept.
+        """
+
+        window = self.get_window(read)
+        if window not in self.keepFractions:
+            return True
+        return self.check_keep(read.qname, window)
+
+    def get_dropped_count(self):
+        """Return the total number of read pairs dropped."""
+
+        return sum([self.windows[x]['dropped'] for x in self.windows])
+
+    def get_total_count(self):
+        """Return the total number of candidate read pairs."""
+
+        return sum([self.windows[x]['total'] for x in self.windows])
+
+    def get_scale_factor(self, pos):
+        """Return the factor to scale read counts by for reads in the window
+        containing the genomic position.
+
+        Args:
+            pos (int): Genomic position.
+        Return:
+            Float of the total read pairs divided by the kept read pairs.
+        """
+
+        window = int(pos) / self.windowSize
+        if window not in self.windows or self.windows[window]['kept'] == 0:
+            return 1.0
+        return float(self.windows[window]['total']) / float(self.windows[window]['kept'])
+
+
+class RegionCoverage:
+    """Read depth over a region, accumulated from the reads of the extraction scan.
+    Only the reads counted for breakpoint depth are added, see is_depth_read().
+
+    Attributes:
+        chrom (str):        Chromosome of the region.
+        start (int):        Region start position.
+        end (int):          Region end position.
+        diffs (array):      Change in depth at each position of the region.
+        depths (array):     Depth at each position of the region, set on first lookup.
+    """
+
+    def __init__(self, chrom, start, end):
+        """
+        """
+
+        self.chrom = str(chrom)
+        self.start = int(start)
+        self.end = max(int(end), self.start)
+        self.diffs = array.array('l', [0] * (self.end - self.start + 1))
+        self.depths = None
+
+    def add_read(self, read):
+        """Add the aligned span of a read within the region to the depth.
+
+        Args:
+            read (pysam read obj): Aligned sequence read.
+        Return:
+            None
+        """
+
+        if not is_depth_read(read) or read.aend is None:
+            return
+        readStart = max(read.pos, self.start)
+        readEnd = min(read.aend, self.end)
+        if readEnd <= readStart:
+            return
+        self.diffs[readStart - self.start] += 1
+        self.diffs[readEnd - self.start] -= 1
+        self.depths = None
+
+    def covers(self, chrom, pos):
+        """Return True if the position is within the region."""
+        return str(chrom) == self.chrom and self.start <= pos < self.end
+
+    def get_depth(self, chrom, pos):
+        """Return the read depth at a position in the region, None if it is outside the region.
+
+        Args:
+            chrom (str):    Chromosome name.
+            pos (int):      Genomic position.
+        Return:
+            Integer read depth or None.
+        """
+
+        if not self.covers(chrom, pos):
+            return None
+        if self.depths is None:
+            self.depths = array.array('l', self.diffs)
+            for i in range(1, len(self.depths)):
+                self.depths[i] += self.depths[i - 1]
+        return self.depths[pos - self.start]
+
+
 class VariantReadTracker:
     """A class to track the reads that are identified to be 'misaligned' to
     the reference sequence.
@@ -595,6 +872,9 @@ class VariantReadTracker:
                               suggestive of some uncategorized event.
         sv (dict):            Dictionary
         bam (str):            Bam file source the reads came from.
+        downsampler (ReadDownsampler): Object tracking the reads dropped by downsampling, None if
+                                       downsampling is not performed.
+        coverage (RegionCoverage):     Read depth over the extracted region.
     """
 
     def __init__(self, bamFile, insertSizeThresh):
@@ -608,6 +888,8 @@ class VariantReadTracker:
         self.unmapped_keep = []
         self.sv = {}
         self.bam = bamFile
+        self.downsampler = None
+        self.coverage = None
 
     def check_read(self, read):
         """Stores all reads in the self.pair_indices dictionary if it is
@@ -712,6 +994,68 @@ class VariantReadTracker:
         if final_add:
             self.sv[get_seq_readname(read)] = (read, clip_seqs, new_clip_coords, indel_only)
 
+    def downsample(self, maxReads, windowSize):
+        """Limit the number of variant read pairs kept in each genomic window.
+
+        The candidate reads are the reads with softclipped sequences stored in self.sv
+        and the unmapped reads with a mapped mate in the region. Reads that are not
+        selected are removed from both.
+
+        Args:
+            maxReads (int):     Maximum number of read pairs to keep in a window.
+            windowSize (int):   Size of the genomic windows in base pairs.
+        Return:
+            None
+        """
+
+        self.downsampler = ReadDownsampler(maxReads, windowSize)
+        candidates = [self.sv[x][0] for x in self.sv]
+        candidates.extend([self.unmapped[x] for x in self.unmapped_keep if x in self.unmapped])
+        self.downsampler.set_windows(candidates)
+        for name in self.sv.keys():
+            if not self.downsampler.keep(self.sv[name][0]):
+                del self.sv[name]
+        self.unmapped_keep = [x for x in self.unmapped_keep if x not in self.unmapped or self.downsampler.keep(self.unmapped[x])]
+
+    def get_repeat_reads(self, repeatIntervals):
+        """Return the names of the stored variant reads whose aligned sequence is
+        mostly within the repeat intervals.
+
+        Args:
+            repeatIntervals (list): List of (start, end) tuples of repeat masked regions.
+        Return:
+            repeatReads (set): Set of read names, formatted by get_seq_readname.
+        """
+
+        repeatReads = set()
+        for name in self.sv:
+            read = self.sv[name][0]
+            start = read.pos
+            end = read.pos + 1
+            if not read.is_unmapped and read.aend is not None:
+                end = read.aend
+            for rStart, rEnd in repeatIntervals:
+                overlap = min(end, rEnd) - max(start, rStart)
+                if overlap > 0 and overlap >= ((end - start) / 2.0):
+                    repeatReads.add(name)
+                    break
+        return repeatReads
+
+    def get_downsample_factor(self, positions):
+        """Return the largest factor to scale read counts by at the genomic positions.
+
+        Args:
+            positions (list): List of integer genomic positions.
+        Return:
+            Float scaling factor, 1.0 if no downsampling was performed.
+        """
+
+        factor = 1.0
+        if self.downsampler is not None:
+            for pos in positions:
+                factor = max(factor, self.downsampler.get_scale_factor(pos))
+        return factor
+
     def write_seqs(self, clipped_fa, reads_fq, sv_bam, kmer_size):
         """
         """
@@ -733,7 +1077,6 @@ class VariantReadTracker:
             if clip_seqs:
                 for clip in clip_seqs['buffered']:
                     clipped_fa.write(">" + name + "\n" + clip + "\n")
-        self.bam.close()
 
     def clear_sv_reads(self):
         """
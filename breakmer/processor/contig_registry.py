@@ -0,0 +1,178 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import bisect
+import hashlib
+import threading
+import breakmer.realignment.local_aligner as local_aligner
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+# Registry instances kept for the life of a worker process, keyed by registry directory.
+REGISTRIES = {}
+REGISTRIES_LOCK = threading.Lock()
+# Log of the registered owners in the registry directory, appended to by each worker.
+REGISTRY_LOG = 'registry.log'
+
+
+def get_registry(params):
+    """Return the run contig registry set in the parameters, None if deduplication is off.
+    Args:
+        params: Param object.
+    Return:
+        ContigRegistry object or None.
+    """
+    registryDir = params.get_param('contig_registry_dir')
+    if registryDir is None:
+        return None
+    with REGISTRIES_LOCK:
+        if registryDir not in REGISTRIES:
+            REGISTRIES[registryDir] = ContigRegistry(registryDir)
+    return REGISTRIES[registryDir]
+
+
+def get_canonical_seq(seq):
+    """Return the lesser of the sequence and its reverse complement, upper case."""
+    seq = seq.upper()
+    return min(seq, local_aligner.reverse_complement(seq))
+
+
+class ContigRegistry:
+    """Run level registry of the assembled contig sequences shared by the worker processes.
+
+    The first contig registered with a sequence owns it. A later contig with the same
+    sequence, its reverse complement, or a sequence contained in a registered contig
+    is a duplicate of the owner, and is neither realigned nor called. The owner calls
+    are reported for the duplicate target at the end of the run.
+
+    Each owner is a file in the registry directory named with the hash of the canonical
+    sequence and created exclusively, so only one worker owns a sequence. The files
+    hold the owner target, contig id and sequence. The owner then appends its entry to
+    the registry log, and each worker reads only the log lines added since its last
+    refresh. A sequence or its reverse complement is matched by its hash, and only the
+    owners at least as long are scanned for a containing sequence.
+    Attributes:
+        path:       String of the registry directory.
+        seqs:       Dictionary of registry file name to tuple with the owner target, contig id
+                    and canonical sequence, for the entries read so far.
+        seqLengths: Sorted list of tuples with the sequence length and registry file name
+                    of the entries read so far.
+        logOffset:  Integer of the registry log bytes read so far.
+    """
+
+    def __init__(self, path):
+        self.loggingName = 'breakmer.processor.contig_registry'
+        self.path = path
+        self.logFn = os.path.join(path, REGISTRY_LOG)
+        self.seqs = {}
+        self.seqLengths = []
+        self.logOffset = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Created by another worker.
+                pass
+
+    def add_entry(self, fn, values):
+        """ """
+        if fn not in self.seqs:
+            self.seqs[fn] = values
+            bisect.insort(self.seqLengths, (len(values[2]), fn))
+
+    def refresh(self):
+        """Read the registry log lines appended by the other workers since the last refresh.
+        A line still being written is read on a later refresh.
+        """
+        if not os.path.isfile(self.logFn):
+            return
+        logFile = open(self.logFn, 'r')
+        logFile.seek(self.logOffset)
+        data = logFile.read()
+        logFile.close()
+        data = data[:data.rfind('\n') + 1]
+        self.logOffset += len(data)
+        for line in data.splitlines():
+            values = line.split('\t')
+            if len(values) == 4:
+                self.add_entry(values[0], tuple(values[1:]))
+
+    def read_entry(self, fn):
+        """Read a registry file created by another worker that is not in the log yet."""
+        try:
+            entryFile = open(os.path.join(self.path, fn), 'r')
+            values = entryFile.read().rstrip('\n').split('\t')
+            entryFile.close()
+        except IOError:
+            return
+        if len(values) == 3:
+            self.add_entry(fn, tuple(values))
+
+    def append_log(self, fn, values):
+        """Append an owner entry to the registry log with a single write."""
+        logFd = os.open(self.logFn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(logFd, '\t'.join((fn,) + values) + '\n')
+        finally:
+            os.close(logFd)
+
+    def find_owner(self, seq, fn):
+        """Return the owner target and contig id of a registered contig that has the
+        sequence, its reverse complement or contains either, None if there is none.
+        Args:
+            seq: String of the canonical contig sequence.
+            fn:  String of the registry file name of the sequence.
+        Return:
+            Tuple with the owner target and contig id or None.
+        """
+        if fn in self.seqs:
+            return self.seqs[fn][0:2]
+        revSeq = local_aligner.reverse_complement(seq)
+        for seqLen, ownerFn in self.seqLengths[bisect.bisect_left(self.seqLengths, (len(seq), '')):]:
+            targetName, contigId, ownerSeq = self.seqs[ownerFn]
+            if seq in ownerSeq or revSeq in ownerSeq:
+                return (targetName, contigId)
+        return None
+
+    def register(self, targetName, contigId, seq):
+        """Register a contig sequence or find the contig that owns it.
+        Args:
+            targetName: String of the target that assembled the contig.
+            contigId:   String of the contig id.
+            seq:        String of the contig sequence.
+        Return:
+            Tuple with the owner target and contig id if the contig is a duplicate,
+            None if the contig owns its sequence.
+        """
+        canonicalSeq = get_canonical_seq(seq)
+        fn = hashlib.sha1(canonicalSeq).hexdigest() + '.txt'
+        with self.lock:
+            self.refresh()
+            owner = self.find_owner(canonicalSeq, fn)
+            if owner is not None:
+                return owner
+            entryFn = os.path.join(self.path, fn)
+            tmpFn = '%s.%d.tmp' % (entryFn, os.getpid())
+            tmpFile = open(tmpFn, 'w')
+            tmpFile.write('\t'.join([targetName, contigId, canonicalSeq]) + '\n')
+            tmpFile.close()
+            try:
+                # A hard link fails if the entry exists, so only one worker owns the sequence
+                # and readers never see a partial entry.
+                os.link(tmpFn, entryFn)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+                os.remove(tmpFn)
+                self.read_entry(fn)
+                return self.find_owner(canonicalSeq, fn)
+            os.remove(tmpFn)
+            self.append_log(fn, (targetName, contigId, canonicalSeq))
+            self.add_entry(fn, (targetName, contigId, canonicalSeq))
+        return None
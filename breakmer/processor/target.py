@@ -2,12 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import math
 import pysam
 import shutil
 import subprocess
 import breakmer.utils as utils
 import breakmer.processor.bam_handler as bam_handler
 import breakmer.assembly.assembler as assembly
+import breakmer.realignment.realigner as realigner
+import breakmer.processor.contig_registry as contig_registry
+import breakmer.caller.sv_caller as sv_caller
+import breakmer.assembly.contig as assembly_contig
 
 __author__ = "Ryan Abo"
 __copyright__ = "Copyright 2015, Ryan Abo"
@@ -56,6 +61,8 @@ class Variation:
         results (list):
         discReadClusters (dict):
         discReadFormatted (list):
+        repeatMask (list):          List of (start, end) tuples of the repeat masked regions in the target.
+        repeatReads (set):          Names of the variant reads that are aligned within repeat masked regions.
     """
 
     def __init__(self, params):
@@ -70,6 +77,25 @@ class Variation:
         # self.svs = {}
         self.discReadClusters = {}
         self.discReadFormatted = []
+        self.repeatMask = None
+        self.repeatReads = set()
+
+    def set_repeat_mask(self, repeatMaskFn):
+        """Store the repeat masked intervals for the target.
+
+        Args:
+            repeatMaskFn (str): Bed file containing the repeat masked regions for the target.
+        Returns:
+            None
+        Raises:
+            None
+        """
+
+        self.repeatMask = []
+        for line in open(repeatMaskFn, 'rU'):
+            linesplit = line.strip().split('\t')
+            if len(linesplit) >= 3:
+                self.repeatMask.append((int(linesplit[1]), int(linesplit[2])))
 
     def setup_cleaned_reads(self, sampleType):
         """Initiate the cleaned_read_recs dictionary for sample or normal data.
@@ -146,11 +172,17 @@ class Variation:
         # Iterate through reads that are not perfectly aligned and store necessary information for downstream analysis.
         # Store the reads with softclipped sequences that are high quality in VariantReadTracker.sv dictionary.
         self.var_reads[sampleType].check_clippings(self.params.get_kmer_size(), start, end)
+        # Cap the number of tumor reads kept in each window of the target region. The normal
+        # reads are kept, all their kmers are needed to subtract from the tumor kmers.
+        if sampleType == 'sv' and self.params.get_param('downsample_max_reads'):
+            self.var_reads[sampleType].downsample(self.params.get_param('downsample_max_reads'), self.params.get_param('downsample_window'))
+            downsampler = self.var_reads[sampleType].downsampler
+            utils.log(self.loggingName, 'info', 'Downsampled %s reads, dropped %d of %d read pairs.' % (sampleType, downsampler.get_dropped_count(), downsampler.get_total_count()))
 
         # Write the bam, fastq, and fasta files with the extracted reads.
         svBam = None
         if sampleType == 'sv':
-            svBam = pysam.Samfile(self.files['sv_bam'], 'wb', template=pysam.Samfile(bamFile, 'rb'))
+            svBam = pysam.Samfile(self.files['sv_bam'], 'wb', template=bam_handler.get_bam_file(bamFile))
         readsFq = open(self.files['%s_fq' % sampleType], 'w')
         scFa = open(self.files['%s_sc_unmapped_fa' % sampleType], 'w')
         # Write all the stored sequences into files.
@@ -158,6 +190,11 @@ class Variation:
         readsFq.close()
         scFa.close()
 
+        # Track the reads aligned within repeats to mask their kmers.
+        if sampleType == 'sv' and self.repeatMask and self.params.get_param('mask_repeat_kmers'):
+            self.repeatReads = self.var_reads[sampleType].get_repeat_reads(self.repeatMask)
+            utils.log(self.loggingName, 'info', '%d variant reads aligned within repeat masked regions.' % len(self.repeatReads))
+
         # Close the bam file, sort and index.
         if sampleType == 'sv':
             svBam.close()
@@ -274,6 +311,11 @@ class Variation:
             normKmers = {}
             self.get_kmers(self.files['norm_cleaned_fq'], normKmers)
             sampleOnlyKmers = list(set(sampleOnlyKmers).difference(set(normKmers.keys())))
+        # Remove the kmers that are likely sequencing errors.
+        sampleOnlyKmers = self.filter_solid_kmers(sampleOnlyKmers)
+        # Remove low complexity kmers and kmers only found in reads aligned to repeats.
+        sampleOnlyKmers = self.filter_low_complexity_kmers(sampleOnlyKmers)
+        sampleOnlyKmers = self.filter_repeat_kmers(sampleOnlyKmers)
 
         # Write case only kmers out to file.
         self.files['sample_kmers'] = os.path.join(kmerPath, name + "_sample_kmers.out")
@@ -294,10 +336,134 @@ class Variation:
         self.files['kmer_clusters'] = os.path.join(kmerPath, name + "_sample_kmers_merged.out")
         utils.log(self.loggingName, 'info', 'Writing kmer clusters to file %s' % self.files['kmer_clusters'])
 
-        self.kmers['clusters'] = assembly.init_assembly(self.kmers['case_only'], self.cleaned_read_recs['sv'], self.params.get_kmer_size(), self.params.get_sr_thresh('min'), readLen)
+        budget = assembly.AssemblyBudget(self.params.get_param('max_assembly_seeds'), self.params.get_param('max_assembly_alignments'), self.params.get_param('max_kmer_reads'), self.params.get_param('max_assembly_time'))
+        self.kmers['clusters'] = assembly.init_assembly(self.kmers['case_only'], self.cleaned_read_recs['sv'], self.params.get_kmer_size(), self.params.get_sr_thresh('min'), readLen, budget)
+        if budget.tripped is not None:
+            utils.log(self.loggingName, 'info', 'Assembly for %s stopped early, %s. Reporting %d contigs assembled before the limit.' % (name, budget.get_tripped(), len(self.kmers['clusters'])))
         self.clear_cleaned_reads()
         self.kmers['case_only'] = {}
 
+    def get_solid_kmer_thresh(self):
+        """Determine the minimum count for a sample kmer to be used in the assembly.
+
+        The threshold is the solid_kmer_min_count parameter value. If the solid_kmer_depth_fraction
+        parameter is set, the threshold is raised to that fraction of the median count of all
+        the sample kmers, which tracks the read depth in the target region.
+
+        Args:
+            None
+        Returns:
+            thresh (int): Minimum kmer count.
+        """
+
+        thresh = 1
+        if self.params.get_param('solid_kmer_min_count'):
+            thresh = int(self.params.get_param('solid_kmer_min_count'))
+        depthFraction = self.params.get_param('solid_kmer_depth_fraction')
+        if depthFraction and len(self.kmers['case']) > 0:
+            kmerDepth = utils.median(self.kmers['case'].values())
+            thresh = max(thresh, int(math.ceil(float(depthFraction) * kmerDepth)))
+        return thresh
+
+    def get_quality_kmer_counts(self, kmerSeqs, minQual):
+        """Count the kmers in the cleaned sample reads, ignoring the kmers that overlap
+        bases with a Phred quality below minQual.
+
+        Args:
+            kmerSeqs (set): Kmer sequences to count.
+            minQual (int):  Minimum Phred quality value (offset 33) of the kmer bases.
+        Returns:
+            kmerCounts (dict): Kmer sequence as key and count as value.
+        """
+
+        kmerSize = self.params.get_kmer_size()
+        kmerCounts = {}
+        for seq in self.cleaned_read_recs['sv']:
+            for read in self.cleaned_read_recs['sv'][seq]:
+                # Position of the last low quality base seen.
+                lowQualPos = -1
+                for i in range(len(read.seq)):
+                    if (ord(read.qual[i]) - 33) < minQual:
+                        lowQualPos = i
+                    kmerStart = i - kmerSize + 1
+                    if kmerStart >= 0 and lowQualPos < kmerStart:
+                        mer = read.seq[kmerStart:(i + 1)]
+                        if mer in kmerSeqs:
+                            kmerCounts[mer] = kmerCounts.get(mer, 0) + 1
+        return kmerCounts
+
+    def filter_solid_kmers(self, sampleOnlyKmers):
+        """Remove the sample only kmers with counts below the solid kmer threshold.
+
+        If the solid_kmer_min_qual parameter is set, the kmers are counted from the
+        high quality bases in the cleaned reads and these counts are compared to the
+        threshold.
+
+        Args:
+            sampleOnlyKmers (list): List of sample only kmer sequences.
+        Returns:
+            solidKmers (list): List of kmer sequences that meet the threshold.
+        """
+
+        thresh = self.get_solid_kmer_thresh()
+        minQual = self.params.get_param('solid_kmer_min_qual')
+        kmerCounts = self.kmers['case']
+        if minQual:
+            kmerCounts = self.get_quality_kmer_counts(set(sampleOnlyKmers), int(minQual))
+        if thresh <= 1 and not minQual:
+            return sampleOnlyKmers
+        solidKmers = [x for x in sampleOnlyKmers if kmerCounts.get(x, 0) >= thresh]
+        utils.log(self.loggingName, 'info', 'Removed %d of %d sample-only kmers with counts below %d (minimum base quality %s).' % (len(sampleOnlyKmers) - len(solidKmers), len(sampleOnlyKmers), thresh, minQual))
+        return solidKmers
+
+    def filter_low_complexity_kmers(self, sampleOnlyKmers):
+        """Remove the sample only kmers with a DUST score above the kmer_dust_thresh
+        parameter value.
+
+        Args:
+            sampleOnlyKmers (list): List of sample only kmer sequences.
+        Returns:
+            List of kmer sequences below the low complexity threshold.
+        """
+
+        dustThresh = self.params.get_param('kmer_dust_thresh')
+        if not dustThresh:
+            return sampleOnlyKmers
+        complexKmers = [x for x in sampleOnlyKmers if utils.dust_score(x) <= float(dustThresh)]
+        utils.log(self.loggingName, 'info', 'Removed %d of %d sample-only kmers with DUST score above %s.' % (len(sampleOnlyKmers) - len(complexKmers), len(sampleOnlyKmers), dustThresh))
+        return complexKmers
+
+    def filter_repeat_kmers(self, sampleOnlyKmers):
+        """Remove the sample only kmers that are only found in reads aligned within
+        the repeat masked regions of the target.
+
+        Args:
+            sampleOnlyKmers (list): List of sample only kmer sequences.
+        Returns:
+            List of kmer sequences found in at least one read outside the repeat masked regions.
+        """
+
+        if len(self.repeatReads) == 0:
+            return sampleOnlyKmers
+        kmerSize = self.params.get_kmer_size()
+        kmerSeqs = set(sampleOnlyKmers)
+        nonRepeatKmers = set()
+        for seq in self.cleaned_read_recs['sv']:
+            for read in self.cleaned_read_recs['sv'][seq]:
+                # Read ids are formatted @<qname>/<1|2>_<indel_only>
+                readName = '_'.join(read.id.lstrip('@').split('_')[:-1])
+                if readName in self.repeatReads:
+                    continue
+                for i in range(len(read.seq) - kmerSize + 1):
+                    mer = read.seq[i:(i + kmerSize)]
+                    if mer in kmerSeqs:
+                        nonRepeatKmers.add(mer)
+                # The other reads with the same sequence contain the same kmers.
+                break
+        unmaskedKmers = [x for x in sampleOnlyKmers if x in nonRepeatKmers]
+        utils.log(self.loggingName, 'info', 'Removed %d of %d sample-only kmers only found in reads within repeat masked regions.' % (len(sampleOnlyKmers) - len(unmaskedKmers), len(sampleOnlyKmers)))
+        return unmaskedKmers
+
     def get_disc_reads(self):
         """
         """
@@ -391,6 +557,10 @@ class TargetManager(object):
         read_len (int):             Length of a single read.
         variation (Variation):      Stores data for variants identified within the target.
         regionBuffer (int):         Base pairs to add or subtract from the target region end and start locations.
+        duplicates (list):          Tuples with the target, contig id, owner target and owner contig id of the
+                                    contigs that duplicate a contig of another target in the run.
+        mergedContigs (list):       Tuples with the contig id of each event merged into another event and
+                                    the contig id of that event.
     """
 
     def __init__(self, name, params):
@@ -405,6 +575,8 @@ class TargetManager(object):
         self.readLen = int(params.get_param('readLen'))
         self.variation = Variation(params)
         self.regionBuffer = 200
+        self.duplicates = []
+        self.mergedContigs = []
         self.setup()
 
     @property
@@ -520,9 +692,22 @@ class TargetManager(object):
             utils.log(self.loggingName, 'info', 'Extracting refseq sequence and writing %s' % fn)
             utils.extract_refseq_fa(self.values, self.paths['ref_data'], self.params.get_param('reference_fasta'), direction, fn)
 
-        # If using blatn for target realignment, the db must be available.
+        # Write the blat overused tile file for the forward sequence used in target realignment.
+        if self.params.get_param('blast') is None:
+            repMatch = utils.BLAT_OOC_REPMATCH
+            if self.params.get_param('target_ooc_repmatch') is not None:
+                repMatch = int(self.params.get_param('target_ooc_repmatch'))
+            utils.make_blat_ooc(self.files['target_ref_fn'][0], self.params.get_param('blat'), repMatch)
+
+        # Extract the repeat masked regions for the target if a repeat mask file is provided.
+        repeatMaskFn = self.params.get_param('repeat_mask_file')
+        if repeatMaskFn:
+            self.files['rep_mask_fn'] = utils.setup_rmask(self.values, self.paths['ref_data'], repeatMaskFn)
+            self.variation.set_repeat_mask(self.files['rep_mask_fn'])
+
+        # If using blatn for target realignment, the db must be available, unless the panel db is used.
         blastn = self.params.get_param('blast')
-        if blastn is not None:
+        if blastn is not None and self.params.get_param('panel_blast_db_fn') is None:
             # Check if blast db files are available for each target.
             if not os.path.isfile(self.files['target_ref_fn'][0] + '.nin'):
                 makedb = os.path.join(os.path.split(blastn)[0], 'makeblastdb')  # Create blast db
@@ -616,22 +801,99 @@ class TargetManager(object):
             contigId = self.name + '_contig' + str(iter)
             utils.log(self.loggingName, 'info', 'Assessing contig %s, %s' % (contigId, contig.seq))
             contig.set_meta_information(contigId, self.params, self.values, self.paths['contigs'], self.variation.files['kmer_clusters'], self.variation)
-            contig.query_ref(self.files['target_ref_fn'])
+            iter += 1
+
+        # Skip the contigs with a sequence already assembled in this run, the owner calls are reported for this target.
+        registry = contig_registry.get_registry(self.params)
+        if registry is not None:
+            uniqueContigs = []
+            for contig in contigs:
+                owner = registry.register(self.name, contig.get_id(), contig.seq)
+                if owner is None:
+                    uniqueContigs.append(contig)
+                    continue
+                utils.log(self.loggingName, 'info', 'Contig %s is a duplicate of contig %s from target %s, skipping realignment.' % (contig.get_id(), owner[1], owner[0]))
+                if owner[0] != self.name:
+                    self.duplicates.append((self.name, contig.get_id(), owner[0], owner[1]))
+            contigs = uniqueContigs
+
+        # Realign all the target contigs with one aligner call per realignment scope, calling
+        # each contig as soon as its realignment is complete.
+        batchRealigner = realigner.BatchRealigner(self.params, self.files['target_ref_fn'], self.paths['contigs'], self.name)
+        calledContigs = []
+        for contig in batchRealigner.realign(contigs):
             contig.make_calls()
             if contig.svEventResult:
-                contig.filter_calls()
-                contig.annotate_calls()
-                contig.output_calls(self.paths['output'], self.variation.files['sv_bam_sorted'])
-                self.add_result(contig.svEventResult)
+                calledContigs.append(contig)
             else:
-                utils.log(self.loggingName, 'info', '%s has no structural variant result.' % contigId)
-            iter += 1
+                utils.log(self.loggingName, 'info', '%s has no structural variant result.' % contig.get_id())
+
+        if self.params.get_param('event_merge_distance') is not None:
+            calledContigs = self.merge_events(calledContigs, int(self.params.get_param('event_merge_distance')))
+        self.set_brkpt_depths(calledContigs)
+        for contig in calledContigs:
+            contig.filter_calls()
+            contig.annotate_calls()
+        contigsBamFn = None
+        if self.params.get_param('single_contig_bam') and len(calledContigs) > 0:
+            # One sorted bam of all the contig reads, tagged with the contig id.
+            contigsBamFn = assembly_contig.write_contigs_bam(self.paths['output'], self.name, self.variation.files['sv_bam_sorted'], calledContigs)
+            self.files['contigs_bam'] = contigsBamFn
+        for contig in calledContigs:
+            contig.output_calls(self.paths['output'], self.variation.files['sv_bam_sorted'], contigsBamFn)
+            self.add_result(contig.svEventResult)
         self.variation.cluster_discreads(self.name, self.chrom)  # Cluster discordant reads.
 
+    def set_brkpt_depths(self, contigs):
+        """Set the read depth at the event breakpoints outside the target region, which
+        are not covered by the extraction scan. All the breakpoints of the target are
+        counted with a single sorted pass over the sample bam file.
+
+        Args:
+            contigs (list): Contig objects with an SV event result.
+        Returns:
+            None
+        """
+
+        positions = set()
+        for contig in contigs:
+            positions.update(contig.svEventResult.get_missing_depth_positions())
+        if len(positions) == 0:
+            return
+        utils.log(self.loggingName, 'info', 'Counting read depth at %d breakpoints outside the target region.' % len(positions))
+        depths = bam_handler.get_brkpt_depths(self.params.get_param('sample_bam_file'), list(positions))
+        for contig in contigs:
+            contig.svEventResult.set_missing_depths(depths)
+
+    def merge_events(self, contigs, maxDistance):
+        """Merge the events of contigs that call the same breakpoints, so that each
+        distinct event is filtered, annotated and plotted once.
+
+        Args:
+            contigs (list):    Contig objects with an SV event result.
+            maxDistance (int): Maximum base pair distance between matching breakpoints.
+        Returns:
+            mergedContigs (list): Contig objects with a distinct SV event result.
+        """
+
+        contigEvents = dict([(id(x.svEventResult), x) for x in contigs])
+        mergedEvents = sv_caller.merge_events([x.svEventResult for x in contigs], maxDistance)
+        for svEvent in mergedEvents:
+            for contigId in svEvent.get_merged_contig_ids():
+                self.mergedContigs.append((contigId, svEvent.get_contig_id()))
+        utils.log(self.loggingName, 'info', 'Merged %d contig events into %d distinct events.' % (len(contigs), len(mergedEvents)))
+        return [contigEvents[id(x)] for x in mergedEvents]
+
     def complete_analysis(self):
         """
         """
 
+        # The target variant read bam is not used by later targets.
+        if 'sv_bam_sorted' in self.variation.files:
+            bam_handler.release_bam_file(self.variation.files['sv_bam_sorted'])
+        if 'contigs_bam' in self.files:
+            bam_handler.release_bam_file(self.files['contigs_bam'])
+
         if len(self.variation.results) > 0 or len(self.variation.discReadFormatted) > 0:
             self.variation.write_results(self.paths['output'], self.name)
         else:
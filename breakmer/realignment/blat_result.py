@@ -1,9 +1,9 @@
 #! /usr/bin/python
 # -*- coding: utf-8 -*-
 
-import math
 import sys
-from Bio import SeqIO
+import math
+import array
 import breakmer.utils as utils
 
 __author__ = "Ryan Abo"
@@ -77,7 +77,7 @@ class AlignFragments:
     """
     """
     def __init__(self, values):
-        self.blockSizes = [int(x) for x in values['blockSizes'].rstrip(",").split(",")]
+        self.blockSizes = values['blockSizes']
         self.ref = []
         self.query = []
         self.count = len(self.blockSizes)
@@ -85,9 +85,7 @@ class AlignFragments:
 
     def set_values(self, values):
         # print 'Set fragment values', values
-        refStarts = [int(x) for x in values['tStarts'].rstrip(",").split(",")]
-        queryStarts = [int(x) for x in values['qStarts'].rstrip(",").split(",")]
-        for qstart, tstart, blocksize in zip(queryStarts, refStarts, self.blockSizes):
+        for qstart, tstart, blocksize in zip(values['qStarts'], values['tStarts'], self.blockSizes):
             self.ref.append((tstart, tstart + blocksize))
             self.query.append((qstart, qstart + blocksize))
 
@@ -183,239 +181,246 @@ class AlignValues:
         return size
 
 
-class RealignValues:
-    def __init__(self, values, program, alignRefFn, querySeq, scope):
-        self.program = program
-        self.valueDict = {}
-        self.set_values(values, alignRefFn, querySeq, scope)
+PSL_KEYS = ['matches', 'mismatches', 'repmatches', 'ncount', 'qNumInsert', 'qBaseInsert', 'tNumInsert', 'tBaseInsert', 'strand', 'qName', 'qSize', 'qStart', 'qEnd', 'tName', 'tSize', 'tStart', 'tEnd', 'blockCount', 'blockSizes', 'qStarts', 'tStarts']
+
+
+class AlignRecord(object):
+    """Realignment values of a single psl or blast tabular record. The block sizes and
+    starts are parsed once into integer arrays.
+
+    BLAT values
+    1. matches - Number of matching bases that aren't repeats.
+    2. misMatches - Number of bases that don't match.
+    3. repMatches - Number of matching bases that are part of repeats.
+    4. nCount - Number of 'N' bases.
+    5. qNumInsert - Number of inserts in query.
+    6. qBaseInsert - Number of bases inserted into query.
+    7. tNumInsert - Number of inserts in target.
+    8. tBaseInsert - Number of bases inserted into target.
+    9. strand - defined as + (forward) or - (reverse) for query strand. In mouse, a second '+' or '-' indecates genomic strand.
+    10. qName - Query sequence name.
+    11. qSize - Query sequence size.
+    12. qStart - Alignment start position in query.
+    13. qEnd - Alignment end position in query.
+    14. tName - Target sequence name.
+    15. tSize - Target sequence size.
+    16. tStart - Alignment start position in query.
+    17. tEnd - Alignment end position in query.
+    18. blockCount - Number of blocks in the alignment.
+    19. blockSizes - Comma-separated list of sizes of each block.
+    20. qStarts - Comma-separated list of start position of each block in query.
+    21. tStarts - Comma-separated list of start position of each block in target.
+
+    BLAST  values
+    1. qName
+    2. tName
+    3. percentIdent
+    4. matches
+    5. misMatches
+    6. ngaps
+    7. qStart
+    8. qEnd
+    9. tStart
+    10. tEnd
+    11. evalue
+    12. bitScore
+    13. gapBp
+    14. strand
+    15. qSeq
+    16. tSeq
+    """
 
-    def set_values(self, values, alignRefFn, querySeq, scope):
-        """
-        BLAT values
-        1. matches - Number of matching bases that aren't repeats.
-        2. misMatches - Number of bases that don't match.
-        3. repMatches - Number of matching bases that are part of repeats.
-        4. nCount - Number of 'N' bases.
-        5. qNumInsert - Number of inserts in query.
-        6. qBaseInsert - Number of bases inserted into query.
-        7. tNumInsert - Number of inserts in target.
-        8. tBaseInsert - Number of bases inserted into target.
-        9. strand - defined as + (forward) or - (reverse) for query strand. In mouse, a second '+' or '-' indecates genomic strand.
-        10. qName - Query sequence name.
-        11. qSize - Query sequence size.
-        12. qStart - Alignment start position in query.
-        13. qEnd - Alignment end position in query.
-        14. tName - Target sequence name.
-        15. tSize - Target sequence size.
-        16. tStart - Alignment start position in query.
-        17. tEnd - Alignment end position in query.
-        18. blockCount - Number of blocks in the alignment.
-        19. blockSizes - Comma-separated list of sizes of each block.
-        20. qStarts - Comma-separated list of start position of each block in query.
-        21. tStarts - Comma-separated list of start position of each block in target.
-
-        BLAST  values
-        1. qName
-        2. tName
-        3. percentIdent
-        4. matches
-        5. misMatches
-        6. ngaps
-        7. qStart
-        8. qEnd
-        9. tStart
-        10. tEnd
-        11. evalue
-        12. bitScore
-        13. gapBp
-        14. strand
-        15. qSeq
-        16. tSeq
-        """
+    __slots__ = PSL_KEYS + ['percentIdent', 'bitscore', 'evalue', 'ngaps', 'gapBp', 'qSeq', 'tSeq', 'deletionSeqs', 'insertSeqs']
 
-        if self.program == 'blat':
-            self.valueDict = {'matches': int(values[0]),
-                              'mismatches': int(values[1]),
-                              'repmatches': int(values[2]),
-                              'ncount': int(values[3]),
-                              'qNumInsert': int(values[4]),
-                              'qBaseInsert': int(values[5]),
-                              'tNumInsert': int(values[6]),
-                              'tBaseInsert': int(values[7]),
-                              'strand': values[8],
-                              'qName': values[9],
-                              'qSize': int(values[10]),
-                              'qStart': int(values[11]),
-                              'qEnd': int(values[12]),
-                              'tName': values[13].replace('chr', ''),
-                              'tSize': int(values[14]),
-                              'tStart': int(values[15]),
-                              'tEnd': int(values[16]),
-                              'blockCount': int(values[17]),
-                              'blockSizes': values[18],
-                              'qStarts': values[19],
-                              'tStarts': values[20],
-                              'deletionSeqs': '',
-                              'insertSeqs': ''
-                              }
-
-            if scope == 'target':
-                alignRefSeq = open(alignRefFn, "rU")
-                record = SeqIO.read(alignRefSeq, "fasta")
-                ref_target_seq = str(record.seq)
-                insertSeqs = []
-                delSeqs = []
-                listIter = 0
-                for bSize, qStart, tStart in zip(self.valueDict['blockSizes'].split(','), self.valueDict['qStarts'].split(','), self.valueDict['tStarts'].split(',')):
-                    # print bSize, qStart, tStart
-                    if bSize == '' or qStart == '' or tStart == '':
-                        continue
-                    qEnd = int(qStart) + int(bSize)
-                    tEnd = int(tStart) + int(bSize)
-                    if listIter > 0:
-                        qDiff = int(qStart) - qPrev
-                        tDiff = int(tStart) - tPrev
-                        if qDiff > 0:
-                            # print qPrev, int(qStart)
-                            # print 'Insertion sequence', querySeq[qPrev:int(qStart)]
-                            insertSeqs.append(querySeq[qPrev:int(qStart)])
-                            # qDiffs.append(qDiff)
-                        if tDiff > 0:
-                            # print tPrev, int(tStart)
-                            # print 'Deleted sequence in ref', ref_target_seq[tPrev:int(tStart)]
-                            delSeqs.append(ref_target_seq[tPrev:int(tStart)])
-                            # tDiffs.append(tDiff)
-                    qPrev = int(qEnd)
-                    tPrev = int(tEnd)
-                    listIter += 1
-                self.valueDict['deletionSeqs'] = delSeqs
-                self.valueDict['insertSeqs'] = insertSeqs
-        elif self.program == 'blast':
-            self.valueDict = {'qName': values[0],
-                              'tName': values[1].replace('chr', ''),
-                              'percentIdent': float(values[2]),
-                              'qSize': values[3],
-                              'matches': int(values[4]),
-                              'mismatches': int(values[5]),
-                              'ngaps': int(values[6]),
-                              'qStart': int(values[7]) - 1,
-                              'qEnd': int(values[8]),
-                              'tStart': int(values[9]) - 1,
-                              'tEnd': int(values[10]),
-                              'evalue': float(values[11]),
-                              'bitscore': float(values[12]),
-                              'gapBp': int(values[13]),
-                              'strand': values[14],
-                              'qSeq': values[15],
-                              'tSeq': values[16],
-                              'repmatches': 0,
-                              'ncount': 0,
-                              'qNumInsert': None,
-                              'qBaseInsert': None,
-                              'tNumInsert': None,
-                              'tBaseInsert': None,
-                              'tSize': 0,
-                              'blockCount': None,
-                              'blockSizes': None,
-                              'qStarts': None,
-                              'tStarts': None,
-                              'deletionSeqs': '',
-                              'insertSeqs': ''
-                              }
-
-            if self.valueDict['strand'] == 'plus':
-                self.valueDict['strand'] = '+'
-            else:
-                self.valueDict['strand'] = '-'
-
-            blockSizes = []
-            blockCount = 0
-            blockSize = None
-            qStarts = []
-            tStarts = []
-            gap = None
-            previous = None
-            nucIter = 0
-            qIter = 0
-            tIter = self.valueDict['tStart']
-            qInserts = [0, 0]
-            tInserts = [0, 0]
-            insertSeqs = []
-            delSeqs = []
-            for qNuc, tNuc in zip(self.valueDict['qSeq'], self.valueDict['tSeq']):
-                # print qNuc, tNuc, blockSize, qStarts, tStarts, gap, previous, qIter, tIter
-                if qNuc != '-' and tNuc != '-':
-                    if blockSize is None:
-                        blockSize = 0
-                        qStarts.append(qIter)
-                        tStarts.append(tIter)
-                        gap = None
-                    blockSize += 1
-                    qIter += 1
-                    tIter += 1
-                elif qNuc == '-' or tNuc == '-':
-                    startOfGap = False
-                    if gap is None:
-                        gap = 0
-                        startOfGap = True
-                        if blockSize is not None:
-                            blockSizes.append(blockSize)
-                            blockSize = None
-                    if qNuc == '-':
-                        tIter += 1
-                        if startOfGap:
-                            tInserts[0] += 1
-                            delSeqs.append(tNuc)
-                        else:
-                            delSeqs[-1] += tNuc
-                        tInserts[1] += 1
-                    elif tNuc == '-':
-                        qIter += 1
-                        if startOfGap:
-                            qInserts[0] += 1
-                            insertSeqs.append(qNuc)
-                        else:
-                            insertSeqs[-1] += qNuc
-                        qInserts[1] += 1
-                    gap += 1
-            if blockSize is not None:
-                blockSizes.append(blockSize)
-            self.valueDict['blockCount'] = len(blockSizes)
-            self.valueDict['blockSizes'] = ','.join([str(x) for x in blockSizes]) + ','
-            self.valueDict['qStarts'] = ','.join([str(x) for x in qStarts]) + ','
-            self.valueDict['tStarts'] = ','.join([str(x) for x in tStarts]) + ','
-            self.valueDict['qNumInsert'] = qInserts[0]
-            self.valueDict['tNumInsert'] = tInserts[0]
-            self.valueDict['qBaseInsert'] = qInserts[1]
-            self.valueDict['tBaseInsert'] = tInserts[1]
-            self.valueDict['deletionSeqs'] = delSeqs
-            self.valueDict['insertSeqs'] = insertSeqs
+    def __init__(self):
+        for key in self.__slots__:
+            setattr(self, key, None)
+        self.deletionSeqs = []
+        self.insertSeqs = []
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def get_psl_values(self):
+        """Return the list of psl formatted values."""
+        values = []
+        for key in PSL_KEYS:
+            value = getattr(self, key)
+            if key in ('blockSizes', 'qStarts', 'tStarts'):
+                value = ''.join([str(x) + ',' for x in value])
+            values.append(str(value))
+        return values
+
+    def get_value_dict(self):
+        """Return a dictionary of the psl values with the block values as comma delimited strings."""
+        return dict(zip(PSL_KEYS, [getattr(self, key) for key in PSL_KEYS[:18]] + self.get_psl_values()[18:]))
+
+    def set_indel_seqs(self, querySeq, refSeq):
+        """Extract the inserted query and deleted reference sequences between the blocks."""
+        qEnds = [x + y for x, y in zip(self.qStarts, self.blockSizes)]
+        tEnds = [x + y for x, y in zip(self.tStarts, self.blockSizes)]
+        self.insertSeqs = [querySeq[x:y] for x, y in zip(qEnds[:-1], self.qStarts[1:]) if y > x]
+        self.deletionSeqs = [refSeq[x:y] for x, y in zip(tEnds[:-1], self.tStarts[1:]) if y > x]
 
     def adjust_values(self, refName, offset):
-        """
-
-        """
-        # Adjust values for targeted alignment
-        rName = self.valueDict['tName'].replace('chr', '')
+        """Set the reference name and shift the reference coordinates for a targeted alignment."""
+        rName = self.tName.replace('chr', '')
         if refName is not None:
             rName = refName
-        self.valueDict['tName'] = rName
-
-        coordOffset = 0
+        self.tName = rName
         if offset is not None:
-            coordOffset = offset
-        # print 'Offset', offset
-        self.valueDict['tStart'] = coordOffset + int(self.valueDict['tStart'])
-        self.valueDict['tEnd'] = coordOffset + int(self.valueDict['tEnd'])
+            self.tStart += offset
+            self.tEnd += offset
+            self.tStarts = array.array('l', [x + offset for x in self.tStarts])
 
-        tstarts = [coordOffset + int(x) for x in self.valueDict['tStarts'].rstrip(",").split(",")]
-        self.valueDict['tStarts'] = ",".join([str(x) for x in tstarts]) + ","
+    def shift_query(self, qName, qSize, offset):
+        """Set the query to a sequence containing the aligned query at offset, for a
+        record of a subsequence aligned in place of the full query sequence.
+        Args:
+            qName:  String of the full query name.
+            qSize:  Integer of the full query size.
+            offset: Integer of the start of the aligned subsequence in the full query.
+        Return: None
+        """
+        # Block starts of reverse strand records are in reverse complement coordinates.
+        blockOffset = offset
+        if self.strand == '-':
+            blockOffset = qSize - (offset + self.qSize)
+        self.qName = qName
+        self.qSize = qSize
+        self.qStart += offset
+        self.qEnd += offset
+        self.qStarts = array.array('l', [x + blockOffset for x in self.qStarts])
+
+
+def get_block_array(blockStr):
+    """Return an integer array of a comma delimited psl block list."""
+    return array.array('l', [int(x) for x in blockStr.split(',') if x != ''])
+
+
+def parse_psl_values(values):
+    """Return an AlignRecord from the split values of a psl line."""
+    record = AlignRecord()
+    record.matches, record.mismatches, record.repmatches, record.ncount, record.qNumInsert, record.qBaseInsert, record.tNumInsert, record.tBaseInsert = [int(x) for x in values[0:8]]
+    record.strand = values[8]
+    record.qName = values[9]
+    record.qSize, record.qStart, record.qEnd = [int(x) for x in values[10:13]]
+    record.tName = values[13].replace('chr', '')
+    record.tSize, record.tStart, record.tEnd, record.blockCount = [int(x) for x in values[14:18]]
+    record.blockSizes = get_block_array(values[18])
+    record.qStarts = get_block_array(values[19])
+    record.tStarts = get_block_array(values[20])
+    return record
+
+
+def parse_blast_values(values):
+    """Return an AlignRecord from the split values of a blast tabular line, with the
+    psl block values derived from the aligned query and subject sequences.
+    """
+    record = AlignRecord()
+    record.qName = values[0]
+    record.tName = values[1].replace('chr', '')
+    record.percentIdent = float(values[2])
+    record.qSize = int(values[3])
+    record.matches = int(values[4])
+    record.mismatches = int(values[5])
+    record.ngaps = int(values[6])
+    record.qStart = int(values[7]) - 1
+    record.qEnd = int(values[8])
+    record.tStart = int(values[9]) - 1
+    record.tEnd = int(values[10])
+    record.evalue = float(values[11])
+    record.bitscore = float(values[12])
+    record.gapBp = int(values[13])
+    record.strand = '+' if values[14] == 'plus' else '-'
+    record.qSeq = values[15]
+    record.tSeq = values[16]
+    record.repmatches = 0
+    record.ncount = 0
+    record.tSize = 0
+
+    blockSizes = []
+    qStarts = []
+    tStarts = []
+    qInserts = [0, 0]
+    tInserts = [0, 0]
+    qIter = 0
+    tIter = record.tStart
+    previous = None
+    for qNuc, tNuc in zip(record.qSeq, record.tSeq):
+        if qNuc != '-' and tNuc != '-':
+            if previous != 'M':
+                blockSizes.append(0)
+                qStarts.append(qIter)
+                tStarts.append(tIter)
+            blockSizes[-1] += 1
+            qIter += 1
+            tIter += 1
+            previous = 'M'
+        elif qNuc == '-':
+            if previous != 'D':
+                tInserts[0] += 1
+                record.deletionSeqs.append('')
+            record.deletionSeqs[-1] += tNuc
+            tInserts[1] += 1
+            tIter += 1
+            previous = 'D'
+        else:
+            if previous != 'I':
+                qInserts[0] += 1
+                record.insertSeqs.append('')
+            record.insertSeqs[-1] += qNuc
+            qInserts[1] += 1
+            qIter += 1
+            previous = 'I'
+    record.blockCount = len(blockSizes)
+    record.blockSizes = array.array('l', blockSizes)
+    record.qStarts = array.array('l', qStarts)
+    record.tStarts = array.array('l', tStarts)
+    record.qNumInsert, record.qBaseInsert = qInserts
+    record.tNumInsert, record.tBaseInsert = tInserts
+    return record
+
+
+def read_result_file(resultFn):
+    """Generator of the split values of each record line in a realignment result file."""
+    for line in open(resultFn, 'r'):
+        if line.find('#') > -1:
+            continue
+        line = line.strip()
+        if line == '':
+            continue
+        yield line.split('\t')
+
+
+def parse_records(resultRecords, program, querySeq=None, refSeq=None):
+    """Generator of AlignRecords from split result values, in a single pass.
+    Args:
+        resultRecords: Iterable of lists of split result values.
+        program:       String of the realignment program, 'blat' or 'blast'.
+        querySeq:      String of the query sequence, for the target indel sequences.
+        refSeq:        String of the target reference sequence, for the target indel sequences.
+    """
+    for values in resultRecords:
+        if program == 'blast':
+            yield parse_blast_values(values)
+        else:
+            record = parse_psl_values(values)
+            if refSeq is not None:
+                record.set_indel_seqs(querySeq, refSeq)
+            yield record
 
 
 class BlatResult:
     """
     """
-    def __init__(self, resultValues, refName, offset, programName, alignRefFn, querySeq, scope):
+    def __init__(self, resultValues, refName, offset, programName, alignRefFn, querySeq, scope, alignRefSeq=None):
         self.loggingName = 'breakmer.realignment.blat_result'
         self.realignProgram = programName
         self.resultValues = None
@@ -448,41 +453,47 @@ class BlatResult:
         self.indel_sizes = []
         self.indel_maxevent_size = [0, '']
         self.indel_flank_match = [0, 0]
-        self.set_values(resultValues, refName, offset, alignRefFn, querySeq, scope)
+        self.set_values(resultValues, refName, offset, alignRefFn, querySeq, scope, alignRefSeq)
 
-    def set_values(self, resultValues, refName, offset, alignRefFn, querySeq, scope):
+    def set_values(self, resultValues, refName, offset, alignRefFn, querySeq, scope, alignRefSeq=None):
         """Modify the blat values if refName and offset are not None
         Args:
-            resultValues:  List of values from a realignment program
+            resultValues:  AlignRecord or list of values from a realignment program
             refName:       String of chromosome AlignFragments
             offset:        Integer of genomic position for target alignment
+            alignRefSeq:   String of the target reference sequence, read from alignRefFn if None
         """
-        realignVals = RealignValues(resultValues, self.realignProgram, alignRefFn, querySeq, scope)
-        realignVals.adjust_values(refName, offset)
-        self.resultValues = realignVals.valueDict
-        self.values = realignVals.valueDict
+        record = resultValues
+        if not isinstance(record, AlignRecord):
+            if self.realignProgram == 'blat' and scope == 'target' and alignRefSeq is None:
+                alignRefSeq = utils.get_ref_seq(alignRefFn)
+            if scope != 'target':
+                alignRefSeq = None
+            record = parse_records([resultValues], self.realignProgram, querySeq, alignRefSeq).next()
+        record.adjust_values(refName, offset)
+        self.resultValues = record
+        self.values = record
         self.matches = Matches(self.values)
         self.gaps = Gaps(self.values)
         self.alignVals = AlignValues(self.values)
         self.fragments = AlignFragments(self.values)
-        self.strand = self.values['strand']
+        self.strand = self.values.strand
         self.breakpts = Breakpoints()
         # Sort results based on alignScore, percentIdent, number of gaps
-        self.perc_ident = 100.0 - self.calcMilliBad()
-        if 'percentIdent' not in realignVals.valueDict:
+        if record.percentIdent is None:
             self.perc_ident = 100.0 - self.calcMilliBad()
         else:
-            self.perc_ident = realignVals.valueDict['percentIdent']
+            self.perc_ident = record.percentIdent
 
-        if 'bitscore' not in realignVals.valueDict:
+        if record.bitscore is None:
             self.alignScore = self.get_nmatch_total() + (float(self.get_nmatch_total()) / float(self.get_seq_size('query')))
         else:
-            self.alignScore = realignVals.valueDict['bitscore']
+            self.alignScore = record.bitscore
 
-        if 'ngaps' not in realignVals.valueDict:
+        if record.ngaps is None:
             self.ngaps = self.get_total_num_gaps()
         else:
-            self.ngaps = realignVals.valueDict['ngaps']
+            self.ngaps = record.ngaps
 
         self.set_indel_locs()
 
@@ -490,9 +501,9 @@ class BlatResult:
         """ """
         # print self.values
         if seqType == 'del':
-            return ','.join(self.values['deletionSeqs'])
+            return ','.join(self.values.deletionSeqs)
         elif seqType == 'ins':
-            return ','.join(self.values['insertSeqs'])
+            return ','.join(self.values.insertSeqs)
 
     def set_sv_brkpt(self, coords, svType, targetKey):
         """ """
@@ -673,7 +684,7 @@ class BlatResult:
         return self.genes
 
     def get_blat_output(self):
-        return "\t".join([str(x) for x in self.values])
+        return "\t".join(self.values.get_psl_values())
 
     def get_len(self):
         return self.qend() - self.qstart()
@@ -0,0 +1,294 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import array
+import bisect
+import struct
+import marshal
+import tempfile
+import collections
+from Bio import SeqIO
+import breakmer.utils as utils
+import breakmer.realignment.local_aligner as local_aligner
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+INDEX_MAGIC = 'BKMRMZI1'
+BASE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+HASH_MULT = 0x9E3779B1
+# Number of high hash bits used to index the sorted minimizer entries.
+BUCKET_BITS = 16
+# Number of high hash bits used to split the entries into temporary files while building.
+BUILD_BUCKET_BITS = 8
+BUILD_FLUSH_SIZE = 1 << 16
+ENTRY_SIZE = struct.calcsize('=Q')
+# Array type code of the 8 byte unsigned entries.
+ENTRY_TYPE = 'L' if array.array('L').itemsize == ENTRY_SIZE else 'Q'
+POS_MASK = (1 << 32) - 1
+
+# Genome indexes mapped in this worker process, keyed by (index file, modification time).
+GENOME_INDEXES = {}
+
+
+def get_minimizers(seq, kmerSize, windowSize):
+    """Generate the (windowSize, kmerSize) minimizers of a sequence, the kmer with the
+    smallest hash value in each window of windowSize consecutive kmers. Kmers
+    containing bases other than A, C, G or T are skipped. The minimizers are
+    generated one at a time, so a chromosome is indexed without holding them all.
+    Args:
+        seq:        String of the upper case sequence.
+        kmerSize:   Integer of the kmer size.
+        windowSize: Integer of the number of kmers in a window.
+    Return:
+        Generator of tuples with the hash value and position of each minimizer.
+    """
+    mask = (1 << (2 * kmerSize)) - 1
+    window = collections.deque()
+    code = 0
+    nvalid = 0
+    lastPos = -1
+    for i, base in enumerate(seq):
+        baseCode = BASE_CODES.get(base)
+        if baseCode is None:
+            code = 0
+            nvalid = 0
+            window.clear()
+            continue
+        code = ((code << 2) | baseCode) & mask
+        nvalid += 1
+        if nvalid < kmerSize:
+            continue
+        pos = i - kmerSize + 1
+        kmerHash = ((code * HASH_MULT) ^ (code >> kmerSize)) & mask
+        while len(window) > 0 and window[-1][0] > kmerHash:
+            window.pop()
+        window.append((kmerHash, pos))
+        if window[0][1] <= pos - windowSize:
+            window.popleft()
+        if nvalid >= kmerSize + windowSize - 1 and window[0][1] != lastPos:
+            yield window[0]
+            lastPos = window[0][1]
+
+
+def build_index(faFn, indexFn, kmerSize=15, windowSize=10):
+    """Build the minimizer index of a genome reference fasta file.
+
+    The index file holds a header, the upper case reference sequences laid end to
+    end, the minimizer entries sorted by hash value and a table of the entry offsets
+    for each bucket of hash values. Each entry packs the minimizer hash with its
+    position in the concatenated sequence. The file is written under a temporary
+    name and renamed into place.
+    Args:
+        faFn:       String of the genome reference fasta file.
+        indexFn:    String of the index file to write.
+        kmerSize:   Integer of the minimizer kmer size.
+        windowSize: Integer of the number of kmers in a minimizer window.
+    Return: None
+    """
+    loggingName = 'breakmer.realignment.genome_index'
+    indexPath = os.path.dirname(os.path.abspath(indexFn))
+    hashBits = 2 * kmerSize
+    tmpFns = []
+
+    def open_tmp_file(suffix):
+        fd, fn = tempfile.mkstemp(suffix=suffix, dir=indexPath)
+        tmpFns.append(fn)
+        return os.fdopen(fd, 'wb')
+
+    seqFile = open_tmp_file('.seq')
+    seqFn = tmpFns[-1]
+    bucketFiles = []
+    bucketFns = []
+    bucketBuffers = []
+    for i in range(1 << BUILD_BUCKET_BITS):
+        bucketFiles.append(open_tmp_file('.bucket'))
+        bucketFns.append(tmpFns[-1])
+        bucketBuffers.append(array.array(ENTRY_TYPE))
+    try:
+        names = []
+        sizes = []
+        seqStart = 0
+        nentries = 0
+        faFile = open(faFn, 'rU')
+        for record in SeqIO.parse(faFile, 'fasta'):
+            seq = str(record.seq).upper()
+            if seqStart + len(seq) > POS_MASK:
+                raise ValueError('Genome reference %s is too large to index' % faFn)
+            utils.log(loggingName, 'info', 'Indexing minimizers of %s, %d bases' % (record.id, len(seq)))
+            seqFile.write(seq)
+            for kmerHash, pos in get_minimizers(seq, kmerSize, windowSize):
+                bucket = kmerHash >> (hashBits - BUILD_BUCKET_BITS)
+                bucketBuffers[bucket].append((kmerHash << 32) | (seqStart + pos))
+                if len(bucketBuffers[bucket]) >= BUILD_FLUSH_SIZE:
+                    bucketBuffers[bucket].tofile(bucketFiles[bucket])
+                    bucketBuffers[bucket] = array.array(ENTRY_TYPE)
+                nentries += 1
+            names.append(record.id)
+            sizes.append(len(seq))
+            seqStart += len(seq)
+        faFile.close()
+        seqFile.close()
+        for bucket in range(len(bucketFiles)):
+            bucketBuffers[bucket].tofile(bucketFiles[bucket])
+            bucketFiles[bucket].close()
+
+        header = marshal.dumps({'kmerSize': kmerSize,
+                                'windowSize': windowSize,
+                                'names': names,
+                                'sizes': sizes,
+                                'nentries': nentries})
+        tmpIndexFn = '%s.%d.tmp' % (indexFn, os.getpid())
+        tmpFns.append(tmpIndexFn)
+        indexFile = open(tmpIndexFn, 'wb')
+        indexFile.write(INDEX_MAGIC)
+        indexFile.write(struct.pack('=Q', len(header)))
+        indexFile.write(header)
+        seqFile = open(seqFn, 'rb')
+        while True:
+            chunk = seqFile.read(1 << 24)
+            if not chunk:
+                break
+            indexFile.write(chunk)
+        seqFile.close()
+
+        # Sort the entries of each temporary bucket and count them by index bucket.
+        bucketCounts = array.array(ENTRY_TYPE, [0] * ((1 << BUCKET_BITS) + 1))
+        for bucketFn in bucketFns:
+            entries = array.array(ENTRY_TYPE)
+            bucketSize = os.path.getsize(bucketFn) / ENTRY_SIZE
+            bucketIn = open(bucketFn, 'rb')
+            entries.fromfile(bucketIn, bucketSize)
+            bucketIn.close()
+            entries = array.array(ENTRY_TYPE, sorted(entries))
+            for entry in entries:
+                bucketCounts[(entry >> 32 >> (hashBits - BUCKET_BITS)) + 1] += 1
+            entries.tofile(indexFile)
+        for i in range(1, len(bucketCounts)):
+            bucketCounts[i] += bucketCounts[i - 1]
+        bucketCounts.tofile(indexFile)
+        indexFile.close()
+        os.rename(tmpIndexFn, indexFn)
+        utils.log(loggingName, 'info', 'Wrote genome index %s with %d sequences and %d minimizers' % (indexFn, len(names), nentries))
+    finally:
+        for fn in tmpFns:
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+
+def get_genome_index(indexFn):
+    """Return the genome index mapped in this process, opening it on first use.
+    Args:
+        indexFn: String of the index file.
+    Return:
+        GenomeIndex object.
+    """
+    key = (os.path.abspath(indexFn), os.path.getmtime(indexFn))
+    if key not in GENOME_INDEXES:
+        for cacheKey in [x for x in GENOME_INDEXES if x[0] == key[0]]:
+            GENOME_INDEXES.pop(cacheKey).close()
+        GENOME_INDEXES[key] = GenomeIndex(indexFn)
+    return GENOME_INDEXES[key]
+
+
+class IndexEntries:
+    """Sequence view of the sorted minimizer entries in a mapped index file, for bisect."""
+
+    def __init__(self, indexMap, offset, size):
+        self.indexMap = indexMap
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        return struct.unpack_from('=Q', self.indexMap, self.offset + idx * ENTRY_SIZE)[0]
+
+
+class GenomeIndex(local_aligner.WindowAligner):
+    """In-process genome realignment with a memory mapped minimizer index, producing psl
+    records in the gfClient output format without a blat server. Gapped alignments
+    are chained into one record as with gfClient, but the seeds and the local
+    alignment scoring are not blat's, so the records can differ from the gfClient
+    records at the alignment ends and for seeds missed by the minimizers.
+
+    The index file is mapped read only, so worker processes share the pages of the
+    file through the operating system cache.
+    Attributes:
+        kmerSize:      Integer of the minimizer kmer size.
+        windowSize:    Integer of the number of kmers in a minimizer window.
+        names:         List of the reference sequence names, in index order.
+        starts:        List of the index position of the first base of each sequence.
+        maxOccurrence: Integer of the most reference positions of a minimizer used as seeds.
+    """
+
+    def __init__(self, indexFn, minScore=20, minIdentity=90.0, maxOccurrence=100):
+        local_aligner.WindowAligner.__init__(self, minScore, minIdentity)
+        self.loggingName = 'breakmer.realignment.genome_index'
+        self.indexFile = open(indexFn, 'rb')
+        self.indexMap = mmap.mmap(self.indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.indexMap[0:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise IOError('%s is not a genome minimizer index' % indexFn)
+        headerSize = struct.unpack_from('=Q', self.indexMap, len(INDEX_MAGIC))[0]
+        headerOffset = len(INDEX_MAGIC) + 8
+        header = marshal.loads(self.indexMap[headerOffset:headerOffset + headerSize])
+        self.kmerSize = header['kmerSize']
+        self.windowSize = header['windowSize']
+        self.names = header['names']
+        self.sizes = dict(zip(header['names'], header['sizes']))
+        self.maxOccurrence = maxOccurrence
+        self.seqOffset = headerOffset + headerSize
+        self.starts = []
+        seqStart = 0
+        for size in header['sizes']:
+            self.starts.append(seqStart)
+            seqStart += size
+        self.seqStarts = dict(zip(self.names, self.starts))
+        entryOffset = self.seqOffset + seqStart
+        self.entries = IndexEntries(self.indexMap, entryOffset, header['nentries'])
+        bucketOffset = entryOffset + header['nentries'] * ENTRY_SIZE
+        self.buckets = array.array(ENTRY_TYPE)
+        self.buckets.fromstring(self.indexMap[bucketOffset:bucketOffset + ((1 << BUCKET_BITS) + 1) * ENTRY_SIZE])
+
+    def close(self):
+        """ """
+        self.indexMap.close()
+        self.indexFile.close()
+
+    def get_positions(self, kmerHash):
+        """Return the index positions of a minimizer, an empty list if it is overused."""
+        bucket = kmerHash >> (2 * self.kmerSize - BUCKET_BITS)
+        lo = self.buckets[bucket]
+        hi = self.buckets[bucket + 1]
+        start = bisect.bisect_left(self.entries, kmerHash << 32, lo, hi)
+        end = bisect.bisect_left(self.entries, (kmerHash + 1) << 32, start, hi)
+        if (end - start) > self.maxOccurrence:
+            return []
+        return [self.entries[i] & POS_MASK for i in range(start, end)]
+
+    def get_hits(self, qSeq):
+        """ """
+        hits = []
+        for kmerHash, qPos in get_minimizers(qSeq, self.kmerSize, self.windowSize):
+            for indexPos in self.get_positions(kmerHash):
+                seqIdx = bisect.bisect_right(self.starts, indexPos) - 1
+                hits.append((self.names[seqIdx], indexPos - self.starts[seqIdx] - qPos))
+        return hits
+
+    def get_seq(self, tName, start, end):
+        """ """
+        start = max(0, start)
+        end = min(self.sizes[tName], end)
+        if end <= start:
+            return ''
+        seqStart = self.seqOffset + self.seqStarts[tName]
+        return self.indexMap[seqStart + start:seqStart + end]
+
+    def get_size(self, tName):
+        """ """
+        return self.sizes[tName]
@@ -0,0 +1,215 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import socket
+import struct
+import threading
+import breakmer.realignment.local_aligner as local_aligner
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+# Signature prefixed to every gfServer command.
+GF_SIGNATURE = '0ddf270562684f29'
+TWOBIT_SIGNATURE = 0x1A412743
+TWOBIT_BASES = 'TCAG'
+
+# Client instances kept for the life of a worker process, keyed by (hostname, port, twoBitFn).
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(hostname, port, twoBitFn):
+    """Return the gfServer client for a server, creating it on first use in this process.
+    Args:
+        hostname: String of the gfServer host.
+        port:     Integer of the gfServer port.
+        twoBitFn: String of the 2bit file the gfServer was started with.
+    Return:
+        GfClient object.
+    """
+    key = (hostname, int(port), twoBitFn)
+    with CLIENTS_LOCK:
+        if key not in CLIENTS:
+            CLIENTS[key] = GfClient(hostname, int(port), twoBitFn)
+    return CLIENTS[key]
+
+
+class TwoBitFile:
+    """Random access reader for the sequences in a 2bit file.
+    Attributes:
+        fn:      String of the 2bit file name.
+        offsets: Dictionary of sequence name to file offset of the sequence record.
+        records: Dictionary of sequence name to tuple with the sequence size, list of
+                 N block intervals and the file offset of the packed bases.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.file = open(fn, 'rb')
+        self.byteOrder = '<'
+        self.offsets = {}
+        self.records = {}
+        self.baseTable = []
+        self.lock = threading.Lock()  # The file handle is shared by concurrent queries.
+        self.read_index()
+
+    def read_index(self):
+        """ """
+        signature = struct.unpack('<I', self.file.read(4))[0]
+        if signature != TWOBIT_SIGNATURE:
+            self.byteOrder = '>'
+        version, seqCount, reserved = struct.unpack(self.byteOrder + 'III', self.file.read(12))
+        offsetFormat = self.byteOrder + ('Q' if version == 1 else 'I')
+        offsetSize = struct.calcsize(offsetFormat)
+        for i in range(seqCount):
+            nameSize = ord(self.file.read(1))
+            name = self.file.read(nameSize)
+            self.offsets[name] = struct.unpack(offsetFormat, self.file.read(offsetSize))[0]
+        # Lookup table of the four bases packed in each byte.
+        for byte in range(256):
+            self.baseTable.append(''.join([TWOBIT_BASES[(byte >> shift) & 3] for shift in (6, 4, 2, 0)]))
+
+    def read_record(self, name):
+        """ """
+        with self.lock:
+            return self.read_record_values(name)
+
+    def read_record_values(self, name):
+        """ """
+        if name not in self.records:
+            self.file.seek(self.offsets[name])
+            dnaSize, nBlockCount = struct.unpack(self.byteOrder + 'II', self.file.read(8))
+            nStarts = struct.unpack(self.byteOrder + 'I' * nBlockCount, self.file.read(4 * nBlockCount))
+            nSizes = struct.unpack(self.byteOrder + 'I' * nBlockCount, self.file.read(4 * nBlockCount))
+            maskBlockCount = struct.unpack(self.byteOrder + 'I', self.file.read(4))[0]
+            # Skip the mask blocks and the reserved word.
+            dnaOffset = self.file.tell() + 8 * maskBlockCount + 4
+            self.records[name] = (dnaSize, zip(nStarts, nSizes), dnaOffset)
+        return self.records[name]
+
+    def has_seq(self, name):
+        """ """
+        return name in self.offsets
+
+    def get_size(self, name):
+        """ """
+        return self.read_record(name)[0]
+
+    def get_seq(self, name, start, end):
+        """Return the upper case sequence of name between start and end (0-based, end exclusive)."""
+        dnaSize, nBlocks, dnaOffset = self.read_record(name)
+        start = max(0, start)
+        end = min(dnaSize, end)
+        if end <= start:
+            return ''
+        with self.lock:
+            self.file.seek(dnaOffset + start / 4)
+            packed = self.file.read((end - 1) / 4 - start / 4 + 1)
+        seq = ''.join([self.baseTable[ord(x)] for x in packed])
+        seq = list(seq[start % 4:start % 4 + end - start])
+        for nStart, nSize in nBlocks:
+            nEnd = nStart + nSize
+            if nEnd <= start or nStart >= end:
+                continue
+            for i in range(max(nStart, start), min(nEnd, end)):
+                seq[i - start] = 'N'
+        return ''.join(seq)
+
+
+class GfClient(local_aligner.WindowAligner):
+    """Query a running gfServer over its socket protocol and align the query sequence
+    to the returned target ranges in process, producing psl records in the gfClient
+    output format. Gapped alignments are chained into one record as with gfClient,
+    but the local alignment scoring is not blat's, so alignment ends can differ from
+    the gfClient records by a few bases.
+
+    gfServer closes the connection after answering each query, so the reuse is of the
+    client object itself: the resolved server address and the open 2bit file are kept
+    for all the queries of a worker process.
+    Attributes:
+        family:  Integer of the socket address family of the server.
+        address: Tuple of the resolved gfServer address.
+        twoBit:  TwoBitFile object for the target sequences.
+    """
+
+    def __init__(self, hostname, port, twoBitFn, minScore=20, minIdentity=90.0):
+        local_aligner.WindowAligner.__init__(self, minScore, minIdentity)
+        self.loggingName = 'breakmer.realignment.gf_client'
+        self.family, sockType, proto, canonName, self.address = socket.getaddrinfo(hostname, port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+        self.twoBit = TwoBitFile(twoBitFn)
+
+    def connect(self):
+        """ """
+        conn = socket.socket(self.family, socket.SOCK_STREAM)
+        conn.connect(self.address)
+        return conn
+
+    def recv_bytes(self, conn, size):
+        """Read exactly size bytes from the connection, None if it is closed first."""
+        data = ''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def recv_string(self, conn):
+        """Read a length prefixed string sent by gfServer."""
+        size = self.recv_bytes(conn, 1)
+        if size is None:
+            return None
+        return self.recv_bytes(conn, ord(size))
+
+    def query(self, seq):
+        """Send a sequence query and return the hit ranges of the server.
+        Args:
+            seq: String of the query DNA sequence.
+        Return:
+            List of tuples with qStart, qEnd, tName, tStart, tEnd for each range.
+        Raise:
+            IOError if the server cannot be reached or does not complete the query.
+        """
+        ranges = []
+        conn = self.connect()
+        try:
+            conn.sendall('%squery %d' % (GF_SIGNATURE, len(seq)))
+            if self.recv_bytes(conn, 1) != 'Y':
+                raise IOError('gfServer at %s did not accept query' % str(self.address))
+            conn.sendall(seq)
+            while True:
+                msg = self.recv_string(conn)
+                if msg is None:
+                    raise IOError('gfServer at %s closed the connection before the end of the query' % str(self.address))
+                if msg == 'end':
+                    break
+                if msg.startswith('Error'):
+                    raise IOError('gfServer query error %s' % msg)
+                fields = msg.split()
+                if len(fields) < 6 or not fields[0].isdigit():
+                    continue
+                # Target names are reported as <2bit file>:<sequence name>.
+                tName = fields[2].split(':', 1)[-1]
+                ranges.append((int(fields[0]), int(fields[1]), tName, int(fields[3]), int(fields[4])))
+        finally:
+            conn.close()
+        return ranges
+
+    def get_hits(self, qSeq):
+        """Return the target name and diagonal of the gfServer hit ranges of a query strand."""
+        hits = []
+        for qStart, qEnd, tName, tStart, tEnd in self.query(qSeq):
+            if self.twoBit.has_seq(tName):
+                hits.append((tName, tStart - qStart))
+        return hits
+
+    def get_seq(self, tName, start, end):
+        """ """
+        return self.twoBit.get_seq(tName, start, end)
+
+    def get_size(self, tName):
+        """ """
+        return self.twoBit.get_size(tName)
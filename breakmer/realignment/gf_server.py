@@ -0,0 +1,174 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import socket
+import threading
+import subprocess
+import breakmer.utils as utils
+import breakmer.realignment.gf_client as gf_client
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+# Sequence queried to check that a gfServer has loaded the genome and answers queries.
+TEST_SEQ = 'CCAAGGGAGACTTCAAGCAGAAAATCTTTAAGGGACCCTTGCATAGCCAGAAGTCCTTTTCAGGCTGATGTACATAAAATATTTAGTAGCCAGGACAGTAGAAGGACTGAAGAGTGAGAGGAGCTCCCAGGGCCTGGAAAGGCCACTTTGTAAGCTCATTCTTG'
+
+# Server pools started by this process.
+POOLS = []
+
+
+def server_ready(hostname, port, twoBitFn):
+    """Return True if the gfServer answers a test query over its socket.
+    Args:
+        hostname: String of the gfServer host.
+        port:     Integer of the gfServer port.
+        twoBitFn: String of the 2bit file the gfServer was started with.
+    Return:
+        Boolean
+    """
+    try:
+        gf_client.GfClient(hostname, port, twoBitFn).query(TEST_SEQ)
+    except (IOError, socket.error):
+        return False
+    return True
+
+
+def stop_server(hostname, port):
+    """Send the stop command to a gfServer started with -canStop, as gfServer stop does.
+    Args:
+        hostname: String of the gfServer host.
+        port:     Integer of the gfServer port.
+    Return:
+        Boolean indicating whether the command was sent.
+    """
+    try:
+        conn = socket.create_connection((hostname, port), 10)
+        conn.sendall(gf_client.GF_SIGNATURE + 'quit')
+        conn.close()
+    except (IOError, socket.error):
+        return False
+    return True
+
+
+def stop_servers(hostname, ports):
+    """Stop the gfServers on the ports, shutting down the pools started by this process."""
+    ports = set(ports)
+    for pool in list(POOLS):
+        if pool.hostname == hostname and len(ports.intersection(pool.ports)) > 0:
+            pool.stop()
+            ports.difference_update(pool.ports)
+    for port in sorted(ports):
+        if not stop_server(hostname, port):
+            utils.log('breakmer.realignment.gf_server', 'info', 'Unable to stop gfServer %s:%d' % (hostname, port))
+
+
+class GfServerPool:
+    """Start and manage several gfServer instances over the same 2bit file, on
+    consecutive ports. The instances are checked with a test query over the socket
+    to detect that they are ready, instances that exit are restarted on the same
+    port by a monitor thread, and all the instances are stopped with the gfServer
+    stop command.
+    Attributes:
+        gfServer: String of the gfServer binary.
+        hostname: String of the server host.
+        ports:    List of integer ports, one per instance.
+        twoBitFn: String of the 2bit file.
+        logPath:  String of the directory for the gfServer logs.
+        procs:    Dictionary of port to the Popen object of the instance.
+    """
+
+    def __init__(self, gfServer, hostname, ports, twoBitFn, logPath):
+        self.loggingName = 'breakmer.realignment.gf_server'
+        self.gfServer = gfServer
+        self.hostname = hostname
+        self.ports = ports
+        self.twoBitFn = twoBitFn
+        self.logPath = logPath
+        self.procs = {}
+        self.restarts = 0
+        self.stopped = threading.Event()
+        self.monitor = None
+        POOLS.append(self)
+
+    def get_log_fn(self, port):
+        """ """
+        return os.path.join(self.logPath, 'gfserver_%d.log' % port)
+
+    def start_instance(self, port):
+        """Start the gfServer instance for a port, from the 2bit file directory."""
+        twoBitPath, twoBitName = os.path.split(self.twoBitFn)
+        cmd = [self.gfServer, '-canStop', '-log=%s' % self.get_log_fn(port), '-stepSize=5', 'start', self.hostname, str(port), twoBitName]
+        utils.log(self.loggingName, 'info', 'Starting gfServer %s' % ' '.join(cmd))
+        devnull = open(os.devnull, 'w')
+        self.procs[port] = subprocess.Popen(cmd, cwd=twoBitPath or None, stdout=devnull, stderr=devnull)
+        devnull.close()
+
+    def start(self, timeout=1000, checkInterval=5):
+        """Start all the instances and wait until each answers a test query.
+        Args:
+            timeout:       Integer of the seconds to wait for the instances to be ready.
+            checkInterval: Integer of the seconds between readiness checks.
+        Return:
+            Boolean indicating whether all the instances are ready.
+        """
+        for port in self.ports:
+            self.start_instance(port)
+        startTime = time.time()
+        waiting = list(self.ports)
+        while len(waiting) > 0:
+            for port in list(waiting):
+                if self.procs[port].poll() is not None:
+                    utils.log(self.loggingName, 'error', 'gfServer on port %d exited with code %d, see %s' % (port, self.procs[port].returncode, self.get_log_fn(port)))
+                    return False
+                if server_ready(self.hostname, port, self.twoBitFn):
+                    utils.log(self.loggingName, 'info', 'gfServer on port %d ready after %d seconds' % (port, int(time.time() - startTime)))
+                    waiting.remove(port)
+            if len(waiting) == 0:
+                break
+            if (time.time() - startTime) > timeout:
+                utils.log(self.loggingName, 'error', 'gfServer wait time exceeded %d seconds for ports %s' % (timeout, ','.join([str(x) for x in waiting])))
+                return False
+            utils.log(self.loggingName, 'info', 'Waiting for %d gfServer instances to load reference seq' % len(waiting))
+            time.sleep(checkInterval)
+        self.start_monitor()
+        return True
+
+    def start_monitor(self, interval=30):
+        """Start a thread that restarts instances that have exited."""
+        def monitor_instances():
+            while not self.stopped.wait(interval):
+                for port in self.ports:
+                    if self.stopped.is_set():
+                        break
+                    if self.procs[port].poll() is not None:
+                        utils.log(self.loggingName, 'info', 'gfServer on port %d exited with code %d, restarting' % (port, self.procs[port].returncode))
+                        self.restarts += 1
+                        self.start_instance(port)
+
+        self.monitor = threading.Thread(target=monitor_instances)
+        self.monitor.daemon = True
+        self.monitor.start()
+
+    def stop(self, timeout=30):
+        """Stop the monitor thread and all the instances, killing any that do not exit."""
+        self.stopped.set()
+        if self.monitor is not None:
+            self.monitor.join()
+        for port in self.ports:
+            stop_server(self.hostname, port)
+        endTime = time.time() + timeout
+        for port in self.ports:
+            proc = self.procs[port]
+            while proc.poll() is None and time.time() < endTime:
+                time.sleep(0.5)
+            if proc.poll() is None:
+                utils.log(self.loggingName, 'info', 'gfServer on port %d did not stop, killing process %d' % (port, proc.pid))
+                proc.kill()
+                proc.wait()
+        if self in POOLS:
+            POOLS.remove(self)
+        utils.log(self.loggingName, 'info', 'Stopped %d gfServer instances, %d restarts' % (len(self.ports), self.restarts))
@@ -0,0 +1,510 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect
+import marshal
+import string
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+# Scoring for the local alignments, a gap of length n costs GAP_OPEN + (n - 1) * GAP_EXTEND.
+MATCH = 1
+MISMATCH = -3
+GAP_OPEN = 5
+GAP_EXTEND = 1
+
+# Bump to invalidate seed index files written with RegionAligner.write_index().
+INDEX_VERSION = 1
+
+COMPLEMENT = string.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+def reverse_complement(seq):
+    """Return the reverse complement of a DNA sequence."""
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def local_align(qSeq, tSeq, dLo, dHi):
+    """Banded Smith-Waterman alignment with affine gaps of a query sequence against
+    a target sequence. Only cells with a diagonal (target index - query index)
+    between dLo and dHi are filled.
+    Args:
+        qSeq: String of the query sequence.
+        tSeq: String of the target sequence.
+        dLo:  Integer of the lowest diagonal in the band.
+        dHi:  Integer of the highest diagonal in the band.
+    Return:
+        Tuple containing the alignment score, query start, target start and the list
+        of alignment operations ('M' aligned base, 'I' query base inserted, 'D' target
+        base deleted), or None if there is no positive scoring alignment.
+    """
+    n = len(qSeq)
+    m = len(tSeq)
+    minusInf = -(n + m + 1) * (GAP_OPEN + GAP_EXTEND)
+    prevH = [0] * (m + 1)
+    prevF = [minusInf] * (m + 1)
+    traceback = [None] * (n + 1)
+    best = (0, 0, 0)
+    for i in range(1, n + 1):
+        curH = [0] * (m + 1)
+        curF = [minusInf] * (m + 1)
+        jStart = max(1, i + dLo)
+        jEnd = min(m, i + dHi)
+        rowTrace = {}
+        e = minusInf
+        qBase = qSeq[i - 1]
+        for j in range(jStart, jEnd + 1):
+            # Gap in the query, target base deleted.
+            eOpen = curH[j - 1] - GAP_OPEN
+            eExt = e - GAP_EXTEND
+            eFrom = 0
+            if eOpen >= eExt:
+                e = eOpen
+            else:
+                e = eExt
+                eFrom = 1
+            # Gap in the target, query base inserted.
+            fOpen = prevH[j] - GAP_OPEN
+            fExt = prevF[j] - GAP_EXTEND
+            fFrom = 0
+            if fOpen >= fExt:
+                f = fOpen
+            else:
+                f = fExt
+                fFrom = 1
+            curF[j] = f
+            if qBase == tSeq[j - 1] and qBase != 'N':
+                h = prevH[j - 1] + MATCH
+            else:
+                h = prevH[j - 1] + MISMATCH
+            hFrom = 1
+            if e > h:
+                h = e
+                hFrom = 2
+            if f > h:
+                h = f
+                hFrom = 3
+            if h <= 0:
+                h = 0
+                hFrom = 0
+            curH[j] = h
+            rowTrace[j] = hFrom | (eFrom << 2) | (fFrom << 3)
+            if h > best[0]:
+                best = (h, i, j)
+        traceback[i] = rowTrace
+        prevH = curH
+        prevF = curF
+
+    score, i, j = best
+    if score <= 0:
+        return None
+
+    ops = []
+    state = 1
+    while i > 0 and j > 0:
+        trace = traceback[i].get(j)
+        if trace is None:
+            break
+        if state == 1:
+            hFrom = trace & 3
+            if hFrom == 0:
+                break
+            elif hFrom == 1:
+                ops.append('M')
+                i -= 1
+                j -= 1
+            else:
+                state = hFrom
+        elif state == 2:
+            ops.append('D')
+            if not (trace >> 2) & 1:
+                state = 1
+            j -= 1
+        else:
+            ops.append('I')
+            if not (trace >> 3) & 1:
+                state = 1
+            i -= 1
+    ops.reverse()
+    return (score, i, j, ops)
+
+
+def get_psl_values(qName, qSeq, strand, tName, tSize, tOffset, tSeq, alignment):
+    """Format a local alignment into the 21 psl fields.
+    Args:
+        qName:     String of the query name.
+        qSeq:      String of the query sequence in the aligned orientation.
+        strand:    String '+' or '-' for the orientation of the query.
+        tName:     String of the target sequence name.
+        tSize:     Integer of the target sequence size.
+        tOffset:   Integer of the target position of the first base in tSeq.
+        tSeq:      String of the target sequence that was aligned, lower case bases are
+                   counted as repeat matches.
+        alignment: Tuple returned from local_align().
+    Return:
+        List of strings with the psl values.
+    """
+    return get_chain_psl_values(qName, qSeq, strand, tName, tSize, [(tName, tOffset, tSeq, alignment)])
+
+
+def get_segment_bounds(segment):
+    """Return the query start and end and the target start and end of an aligned segment,
+    a tuple with the target name, the target offset and sequence, and the local alignment
+    with the query position in the aligned query sequence.
+    """
+    tName, tOffset, tSeq, alignment = segment
+    score, qPos, tPos, ops = alignment
+    return (qPos, qPos + len(ops) - ops.count('D'), tOffset + tPos, tOffset + tPos + len(ops) - ops.count('I'))
+
+
+def trim_segment(segment, qEnd, tEnd):
+    """Remove the start of an aligned segment up to a query and a target position, so it
+    follows an alignment ending at these positions.
+    Args:
+        segment: Tuple of the aligned segment.
+        qEnd:    Integer of the query position the segment must start at or after.
+        tEnd:    Integer of the target position the segment must start at or after.
+    Return:
+        Tuple of the trimmed segment, None if no aligned base is left.
+    """
+    tName, tOffset, tSeq, alignment = segment
+    score, qPos, tPos, ops = alignment
+    i = 0
+    while i < len(ops) and (qPos < qEnd or tOffset + tPos < tEnd or ops[i] != 'M'):
+        if ops[i] != 'D':
+            qPos += 1
+        if ops[i] != 'I':
+            tPos += 1
+        i += 1
+    if 'M' not in ops[i:]:
+        return None
+    return (tName, tOffset, tSeq, (score, qPos, tPos, ops[i:]))
+
+
+def get_chain_psl_values(qName, qSeq, strand, tName, tSize, segments):
+    """Format a chain of aligned segments, in query and target order, into the 21 psl
+    fields of one gapped record. The query and target bases between consecutive
+    segments are counted as inserts.
+    Args:
+        qName:    String of the query name.
+        qSeq:     String of the query sequence in the aligned orientation.
+        strand:   String '+' or '-' for the orientation of the query.
+        tName:    String of the target sequence name.
+        tSize:    Integer of the target sequence size.
+        segments: List of tuples with the target name, the target position of the first
+                  base in the target sequence, the target sequence and the local alignment.
+    Return:
+        List of strings with the psl values.
+    """
+    qSize = len(qSeq)
+    matches = mismatches = repMatches = nCount = 0
+    qNumInsert = qBaseInsert = tNumInsert = tBaseInsert = 0
+    blockSizes = []
+    qStarts = []
+    tStarts = []
+    for segmentTName, tOffset, tSeq, alignment in segments:
+        score, qPos, tPos, ops = alignment
+        if len(qStarts) > 0:
+            qGap = qPos - (qStarts[-1] + blockSizes[-1])
+            tGap = tPos + tOffset - (tStarts[-1] + blockSizes[-1])
+            if qGap > 0:
+                qNumInsert += 1
+                qBaseInsert += qGap
+            if tGap > 0:
+                tNumInsert += 1
+                tBaseInsert += tGap
+        prevOp = None
+        for op in ops:
+            if op == 'M':
+                if prevOp != 'M':
+                    blockSizes.append(0)
+                    qStarts.append(qPos)
+                    tStarts.append(tPos + tOffset)
+                blockSizes[-1] += 1
+                qBase = qSeq[qPos].upper()
+                tBase = tSeq[tPos].upper()
+                if qBase == 'N' or tBase == 'N':
+                    nCount += 1
+                elif qBase == tBase:
+                    if tSeq[tPos].islower():
+                        repMatches += 1
+                    else:
+                        matches += 1
+                else:
+                    mismatches += 1
+                qPos += 1
+                tPos += 1
+            elif op == 'I':
+                if prevOp != 'I':
+                    qNumInsert += 1
+                qBaseInsert += 1
+                qPos += 1
+            else:
+                if prevOp != 'D':
+                    tNumInsert += 1
+                tBaseInsert += 1
+                tPos += 1
+            prevOp = op
+
+    qStart = qStarts[0]
+    qEnd = qPos
+    if strand == '-':
+        # psl stores the query coordinates in forward orientation and the block starts in reverse.
+        qStart, qEnd = qSize - qEnd, qSize - qStart
+    values = [matches, mismatches, repMatches, nCount, qNumInsert, qBaseInsert, tNumInsert, tBaseInsert, strand, qName, qSize, qStart, qEnd, tName, tSize, tStarts[0], tStarts[-1] + blockSizes[-1], len(blockSizes)]
+    values = [str(x) for x in values]
+    values.append(''.join([str(x) + ',' for x in blockSizes]))
+    values.append(''.join([str(x) + ',' for x in qStarts]))
+    values.append(''.join([str(x) + ',' for x in tStarts]))
+    return values
+
+
+def get_psl_score(values):
+    """Return the blat score of psl values, matches - mismatches - gap counts."""
+    return int(values[0]) + int(values[2]) - int(values[1]) - int(values[4]) - int(values[6])
+
+
+def get_psl_identity(values):
+    """Return the percent identity of the aligned bases in psl values."""
+    aligned = int(values[0]) + int(values[1]) + int(values[2])
+    if aligned == 0:
+        return 0.0
+    return 100.0 * float(int(values[0]) + int(values[2])) / float(aligned)
+
+
+class WindowAligner:
+    """Align query sequences to target windows around seed hit diagonals.
+
+    Gaps within a window are aligned in the band around its seed diagonals. The
+    segments aligned in separate windows of the same target and query strand are
+    then chained in query and target order into one gapped record, as blat reports
+    deletions and tandem duplications larger than the band. The scoring of the
+    local alignments is not blat's, so the alignment ends can differ from blat
+    records by a few bases.
+
+    Subclasses provide the seed hits of a query strand and access to the target
+    sequences with get_hits(), get_seq() and get_size().
+    Attributes:
+        minScore:       Integer of the minimum psl score to report an alignment.
+        minIdentity:    Float of the minimum percent identity to report an alignment.
+        minHits:        Integer of the minimum number of seed hits in a window to align to it.
+        flank:          Integer of the bases added to the band on either side of the seed diagonals.
+        maxDiagonalGap: Integer of the largest diagonal difference between seeds in the same window.
+        maxGap:         Integer of the largest query or target gap between chained segments,
+                        the blat -maxIntron default.
+    """
+
+    def __init__(self, minScore=20, minIdentity=90.0, minHits=1):
+        self.minScore = minScore
+        self.minIdentity = minIdentity
+        self.minHits = minHits
+        self.flank = 50
+        self.maxDiagonalGap = 100
+        self.maxGap = 750000
+
+    def align(self, qName, qSeq):
+        """Align both strands of a sequence and return the psl records of its alignments.
+        Args:
+            qName: String of the query name.
+            qSeq:  String of the query sequence.
+        Return:
+            List of psl value lists, as split from a psl file line.
+        """
+        qSeq = qSeq.upper()
+        records = []
+        for strand, strandSeq in (('+', qSeq), ('-', reverse_complement(qSeq))):
+            segments = []
+            for window in self.get_windows(self.get_hits(strandSeq)):
+                segments.extend(self.align_window(qName, strandSeq, strand, window, 0, len(strandSeq)))
+            for chain in self.chain_segments(segments):
+                records.append(get_chain_psl_values(qName, strandSeq, strand, chain[0][0], self.get_size(chain[0][0]), chain))
+        return records
+
+    def link_segment(self, prevSegment, segment):
+        """Return the gap size and the segment trimmed to follow the previous segment of
+        a chain, None if the segment is on another target, does not follow the previous
+        segment in query and target order or is too far from it.
+        """
+        if segment[0] != prevSegment[0]:
+            return None
+        prevQStart, prevQEnd, prevTStart, prevTEnd = get_segment_bounds(prevSegment)
+        segment = trim_segment(segment, prevQEnd, prevTEnd)
+        if segment is None:
+            return None
+        qStart, qEnd, tStart, tEnd = get_segment_bounds(segment)
+        qGap = qStart - prevQEnd
+        tGap = tStart - prevTEnd
+        if qGap > self.maxGap or tGap > self.maxGap:
+            return None
+        return (qGap + tGap, segment)
+
+    def chain_segments(self, segments):
+        """Chain the aligned segments of a query strand. Segments are added in query order
+        to the chain they follow with the smallest gap, or start a new chain.
+        Args:
+            segments: List of tuples of the aligned segments.
+        Return:
+            List of lists of the segments in each chain.
+        """
+        chains = []
+        for segment in sorted(segments, key=lambda x: (get_segment_bounds(x), x[0])):
+            best = None
+            for chain in chains:
+                link = self.link_segment(chain[-1], segment)
+                if link is not None and (best is None or link[0] < best[0]):
+                    best = (link[0], chain, link[1])
+            if best is None:
+                chains.append([segment])
+            else:
+                best[1].append(best[2])
+        return chains
+
+    def get_windows(self, hits):
+        """Group the seed hits, tuples of target name and diagonal, into target windows to align to."""
+        windows = []
+        for tName, diagonal in sorted(hits):
+            if len(windows) > 0 and windows[-1][0] == tName and (diagonal - windows[-1][2]) <= self.maxDiagonalGap:
+                windows[-1][2] = diagonal
+                windows[-1][3] += 1
+            else:
+                windows.append([tName, diagonal, diagonal, 1])
+        return [x[0:3] for x in windows if x[3] >= self.minHits]
+
+    def align_window(self, qName, qSeq, strand, window, qStart, qEnd):
+        """Align the query interval to a target window, then the query sequence left
+        unaligned on either side of the alignment.
+        Return:
+            List of tuples of the aligned segments.
+        """
+        segments = []
+        if (qEnd - qStart) < self.minScore:
+            return segments
+        tName, minDiagonal, maxDiagonal = window
+        tSize = self.get_size(tName)
+        tOffset = max(0, minDiagonal + qStart - self.flank)
+        tSeq = self.get_seq(tName, tOffset, maxDiagonal + qEnd + self.flank)
+        dLo = minDiagonal - tOffset - self.flank
+        dHi = maxDiagonal - tOffset + self.flank
+        alignment = local_align(qSeq[qStart:qEnd], tSeq.upper(), dLo + qStart, dHi + qStart)
+        if alignment is None:
+            return segments
+        score, alignQStart, alignTStart, ops = alignment
+        alignQStart += qStart
+        segment = (tName, tOffset, tSeq, (score, alignQStart, alignTStart, ops))
+        values = get_psl_values(qName, qSeq, strand, tName, tSize, tOffset, tSeq, segment[3])
+        if get_psl_score(values) < self.minScore or get_psl_identity(values) < self.minIdentity:
+            return segments
+        segments.append(segment)
+        alignQEnd = alignQStart + len([x for x in ops if x != 'D'])
+        segments.extend(self.align_window(qName, qSeq, strand, window, qStart, alignQStart))
+        segments.extend(self.align_window(qName, qSeq, strand, window, alignQEnd, qEnd))
+        return segments
+
+
+class RegionAligner(WindowAligner):
+    """In-process seed and extend aligner for a set of reference sequences.
+
+    Non-overlapping kmers are indexed every stepSize bases of each reference, similar
+    to the blat -stepSize tiling, and every kmer of the query is looked up. The index
+    positions are offsets into the sequences laid end to end. Windows with at least
+    minHits seed hits are aligned. Matches to lower case reference bases are reported
+    as repeat matches, as with blat -repeats=lower. Segments are chained across gaps
+    up to the length of the longest reference.
+    Attributes:
+        names:    List of the reference sequence names, in index order.
+        seqs:     Dictionary of reference sequence name to sequence.
+        starts:   List of the index position of the first base of each sequence.
+        kmerSize: Integer of the seed length.
+        index:    Dictionary of seed kmer to list of index positions.
+    """
+
+    def __init__(self, seqs, kmerSize=11, stepSize=10, minHits=2, maxOccurrence=64, index=None):
+        WindowAligner.__init__(self, minHits=minHits)
+        self.names = [x[0] for x in seqs]
+        self.seqs = dict(seqs)
+        self.kmerSize = kmerSize
+        self.stepSize = stepSize
+        self.maxOccurrence = maxOccurrence
+        self.maxGap = max([0] + [len(x[1]) for x in seqs])
+        self.starts = []
+        indexPos = 0
+        for name, seq in seqs:
+            self.starts.append(indexPos)
+            indexPos += len(seq)
+        self.index = index
+        if self.index is None:
+            self.index = {}
+            for seqStart, (name, seq) in zip(self.starts, seqs):
+                upperSeq = seq.upper()
+                for pos in range(0, len(upperSeq) - kmerSize + 1, stepSize):
+                    kmer = upperSeq[pos:pos + kmerSize]
+                    if kmer.find('N') > -1:
+                        continue
+                    self.index.setdefault(kmer, []).append(seqStart + pos)
+            # Drop overused seeds, as with a blat ooc file.
+            for kmer in [x for x in self.index if len(self.index[x]) > maxOccurrence]:
+                del self.index[kmer]
+
+    def get_hits(self, qSeq):
+        """ """
+        hits = []
+        for i in range(len(qSeq) - self.kmerSize + 1):
+            for indexPos in self.index.get(qSeq[i:i + self.kmerSize], []):
+                seqIdx = bisect.bisect_right(self.starts, indexPos) - 1
+                hits.append((self.names[seqIdx], indexPos - self.starts[seqIdx] - i))
+        return hits
+
+    def get_seq(self, tName, start, end):
+        """ """
+        return self.seqs[tName][max(0, start):end]
+
+    def get_size(self, tName):
+        """ """
+        return len(self.seqs[tName])
+
+    def get_index_header(self):
+        """Return the values identifying the sequences and settings of the seed index."""
+        return (INDEX_VERSION, self.kmerSize, self.stepSize, self.maxOccurrence, self.names, [len(self.seqs[x]) for x in self.names])
+
+    def write_index(self, fn):
+        """Write the seed index to a file, read back with read_index()."""
+        indexFile = open(fn, 'wb')
+        marshal.dump((self.get_index_header(), self.index), indexFile)
+        indexFile.close()
+
+
+def read_index(fn, seqs, kmerSize=11, stepSize=10, maxOccurrence=64):
+    """Read a seed index written with RegionAligner.write_index().
+    Args:
+        fn:   String of the index file name.
+        seqs: List of tuples with the name and sequence of the indexed references.
+    Return:
+        Dictionary of seed kmer to list of index positions, None if the index was
+        written for other sequences or settings.
+    """
+    indexFile = open(fn, 'rb')
+    try:
+        header, index = marshal.load(indexFile)
+    except (EOFError, ValueError, TypeError):
+        return None
+    finally:
+        indexFile.close()
+    if header != (INDEX_VERSION, kmerSize, stepSize, maxOccurrence, [x[0] for x in seqs], [len(x[1]) for x in seqs]):
+        return None
+    return index
+
+
+class TargetAligner(RegionAligner):
+    """In-process seed and extend aligner for a target reference sequence.
+    Attributes:
+        name: String of the reference sequence name.
+        seq:  String of the reference sequence.
+    """
+
+    def __init__(self, name, seq, kmerSize=11, stepSize=10, minHits=2, maxOccurrence=64):
+        RegionAligner.__init__(self, [(name, seq)], kmerSize, stepSize, minHits, maxOccurrence)
+        self.name = name
+        self.seq = seq
@@ -0,0 +1,181 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import fcntl
+import hashlib
+import threading
+import breakmer.utils as utils
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+# Bump to invalidate all existing cache entries when the stored record format changes.
+CACHE_VERSION = '1'
+# Query name placeholder for stored records, replaced with the contig id on retrieval.
+QNAME_PLACEHOLDER = '*'
+
+# Cache instances kept for the life of a worker process, keyed by cache directory.
+CACHES = {}
+CACHES_LOCK = threading.Lock()
+
+
+def get_cache(params):
+    """Return the realignment cache set in the parameters, None if caching is off.
+    Args:
+        params: Param object.
+    Return:
+        RealignCache object or None.
+    """
+    cacheDir = params.get_param('realign_cache_dir')
+    if cacheDir is None:
+        return None
+    maxSize = 1024
+    if params.get_param('realign_cache_max_size') is not None:
+        maxSize = int(params.get_param('realign_cache_max_size'))
+    with CACHES_LOCK:
+        if cacheDir not in CACHES:
+            CACHES[cacheDir] = RealignCache(cacheDir, maxSize * 1024 * 1024)
+    return CACHES[cacheDir]
+
+
+class RealignCache:
+    """On-disk cache of realignment records shared by runs and worker processes.
+
+    Entries are keyed by a hash of the contig sequence, the realignment scope and a
+    string identifying the aligner, its parameters and the reference. Each entry is
+    a file of tab delimited records written to a temporary file and renamed into
+    place, so readers never see a partial entry. Entry modification times are
+    updated on each hit and the least recently used entries are removed, under an
+    exclusive lock, when the cache grows beyond its maximum size.
+    Attributes:
+        path:    String of the cache directory.
+        maxSize: Integer of the maximum total bytes of the cache entries.
+    """
+
+    def __init__(self, path, maxSize):
+        self.loggingName = 'breakmer.realignment.realign_cache'
+        self.path = path
+        self.maxSize = maxSize
+        self.lockFn = os.path.join(self.path, '.lock')
+        self.checkInterval = 100  # Number of writes between cache size checks.
+        self.nwrites = 0
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Created by another worker.
+                pass
+
+    def get_key(self, seq, scope, alignValues):
+        """Return the cache key of a sequence realignment.
+        Args:
+            seq:         String of the query sequence.
+            scope:       String of the realignment scope.
+            alignValues: String identifying the aligner, its parameters and the reference.
+        Return:
+            String of the hex digest key.
+        """
+        return hashlib.sha1('\t'.join([CACHE_VERSION, seq.upper(), scope, alignValues])).hexdigest()
+
+    def get_entry_fn(self, key):
+        """ """
+        return os.path.join(self.path, key[0:2], key + '.txt')
+
+    def get(self, key, qName, qNameIdx):
+        """Return the cached records for a key with the query name set, None if not cached.
+        Args:
+            key:      String of the cache key.
+            qName:    String of the query name to set in the records.
+            qNameIdx: Integer index of the query name in the records.
+        Return:
+            List of lists with the record values, or None.
+        """
+        entryFn = self.get_entry_fn(key)
+        try:
+            entryFile = open(entryFn, 'r')
+            lines = entryFile.readlines()
+            entryFile.close()
+            os.utime(entryFn, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        records = []
+        for line in lines:
+            values = line.rstrip('\n').split('\t')
+            values[qNameIdx] = qName
+            records.append(values)
+        return records
+
+    def put(self, key, records, qNameIdx):
+        """Store the records of a realignment.
+        Args:
+            key:      String of the cache key.
+            records:  List of lists with the record values.
+            qNameIdx: Integer index of the query name in the records.
+        Return: None
+        """
+        entryFn = self.get_entry_fn(key)
+        entryPath = os.path.dirname(entryFn)
+        tmpFn = '%s.%d.%d.tmp' % (entryFn, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.exists(entryPath):
+                os.makedirs(entryPath)
+        except OSError:
+            pass
+        try:
+            tmpFile = open(tmpFn, 'w')
+            for values in records:
+                values = list(values)
+                values[qNameIdx] = QNAME_PLACEHOLDER
+                tmpFile.write('\t'.join(values) + '\n')
+            tmpFile.close()
+            os.rename(tmpFn, entryFn)
+        except (IOError, OSError) as err:
+            utils.log(self.loggingName, 'info', 'Unable to write realignment cache entry %s, %s' % (entryFn, str(err)))
+            return
+        self.nwrites += 1
+        if (self.nwrites - 1) % self.checkInterval == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries when the cache is larger than its maximum size."""
+        lockFile = open(self.lockFn, 'a')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            entries = []
+            totalSize = 0
+            for dirPath, dirNames, fileNames in os.walk(self.path):
+                for fn in fileNames:
+                    if not fn.endswith('.txt'):
+                        continue
+                    entryFn = os.path.join(dirPath, fn)
+                    try:
+                        entryStat = os.stat(entryFn)
+                    except OSError:
+                        continue
+                    entries.append((entryStat.st_mtime, entryStat.st_size, entryFn))
+                    totalSize += entryStat.st_size
+            if totalSize <= self.maxSize:
+                return
+            # Remove down to 90% of the maximum size so eviction is not run on every write.
+            targetSize = int(0.9 * self.maxSize)
+            nremoved = 0
+            for mtime, size, entryFn in sorted(entries):
+                if totalSize <= targetSize:
+                    break
+                try:
+                    os.remove(entryFn)
+                    totalSize -= size
+                    nremoved += 1
+                except OSError:
+                    pass
+            utils.log(self.loggingName, 'info', 'Removed %d least recently used entries from realignment cache %s' % (nremoved, self.path))
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
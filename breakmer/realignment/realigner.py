@@ -2,8 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import math
+import hashlib
+import threading
 import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import breakmer.realignment.blat_result as blat_result
+import breakmer.realignment.gf_client as gf_client
+import breakmer.realignment.genome_index as genome_index
+import breakmer.realignment.local_aligner as local_aligner
+import breakmer.realignment.realign_cache as realign_cache
 import breakmer.utils as utils
 
 __author__ = "Ryan Abo"
@@ -12,6 +21,272 @@ __email__ = "ryanabo@gmail.com"
 __license__ = "MIT"
 
 
+def get_align_cmd(alignParams, scope, queryFn, resultFn, port=None):
+    """Return the system command to realign the sequences in a fasta file.
+    Args:
+        alignParams: Tuple of aligner values from AlignParams.get_values().
+        scope:       String of the realignment scope, 'target' or 'genome'.
+        queryFn:     String of the fasta file with the query sequences.
+        resultFn:    String of the file to write the alignment results.
+        port:        Integer of the blat server port for the genome scope, the first
+                     server port if None.
+    Return:
+        cmd: String of the system command.
+    """
+    alignProgram, alignExt, alignBinary, binaryParams, alignRef = alignParams
+    if port is None and scope == 'genome':
+        port = binaryParams['port']
+    cmd = ''
+    if alignProgram == 'blast':
+        threadParam = ''
+        if binaryParams is not None and binaryParams.get('threads') is not None:
+            threadParam = '-num_threads %d ' % binaryParams['threads']
+        cmd = "%s -task 'blastn-short' -db %s -query %s -evalue 0.01 %s-out %s -outfmt '7 qseqid sseqid pident qlen length mismatch gapopen qstart qend sstart send evalue bitscore gaps sstrand qseq sseq'" % (alignBinary, alignRef, queryFn, threadParam, resultFn)
+    elif alignProgram == 'blat':
+        if scope == 'genome':
+            # all blat server
+            cmd = '%s -t=dna -q=dna -out=psl -minScore=20 -nohead %s %d %s %s %s' % (alignBinary, binaryParams['hostname'], port, alignRef, queryFn, resultFn)
+        elif scope == 'target':
+            # target
+            oocFn = utils.get_blat_ooc_fn(alignRef)
+            oocParam = ''
+            if os.path.isfile(oocFn):
+                # Overused tiles of the target written during reference preparation.
+                oocParam = '-ooc=%s ' % oocFn
+            cmd = '%s -t=dna -q=dna -out=psl -minScore=20 -stepSize=10 -minMatch=2 -repeats=lower %s-noHead %s %s %s' % (alignBinary, oocParam, alignRef, queryFn, resultFn)
+    return cmd
+
+
+# Number of genome queries sent by each worker process, used to spread the queries over the blat servers.
+SERVER_QUERIES = {}
+SERVER_QUERIES_LOCK = threading.Lock()
+
+
+def get_server_ports(binaryParams):
+    """Return the blat server ports in the order to try them for the next genome query.
+    Queries are distributed round robin over the servers, each worker process
+    starting at a different server.
+    """
+    ports = binaryParams['ports']
+    pid = os.getpid()
+    with SERVER_QUERIES_LOCK:
+        nqueries = SERVER_QUERIES.get(pid, pid)
+        SERVER_QUERIES[pid] = nqueries + 1
+    serverIdx = nqueries % len(ports)
+    return ports[serverIdx:] + ports[:serverIdx]
+
+
+def split_results(resultFn, alignProgram, realignments, filterSubject=False):
+    """Write the records of a multi-query result file to the result file of each contig.
+    Args:
+        resultFn:      String of the multi-query result file.
+        alignProgram:  String of the aligner used, 'blat' or 'blast'.
+        realignments:  List of Realignment objects with queries in the result file.
+        filterSubject: Boolean to keep only the blast records against the contig's own
+                       target sequence, for a panel-wide blast database.
+    Return: None
+    """
+    qNameIdx = get_qname_idx(alignProgram)
+    contigFiles = {}
+    queryFiles = {}
+    querySubjects = {}
+    for realignment in realignments:
+        contigFile = open(realignment.resultFn, 'w')
+        contigFiles[realignment.contig.get_id()] = contigFile
+        for queryName, querySeq in realignment.get_queries():
+            queryFiles[queryName] = contigFile
+            querySubjects[queryName] = realignment.contig.get_target_region_coordinates()[3]
+    filterSubject = filterSubject and alignProgram == 'blast'
+    for line in open(resultFn, 'r'):
+        if line.find('#') > -1:
+            continue
+        linesplit = line.strip().split('\t')
+        if len(linesplit) <= qNameIdx or linesplit[qNameIdx] not in queryFiles:
+            continue
+        # makeblastdb -parse_seqids may report the subject with a local id prefix.
+        if filterSubject and (len(linesplit) < 2 or linesplit[1].split('|')[-1] != querySubjects[linesplit[qNameIdx]]):
+            continue
+        queryFiles[linesplit[qNameIdx]].write(line)
+    for contigId in contigFiles:
+        contigFiles[contigId].close()
+
+
+def use_panel_db(alignParams, scope):
+    """Return True if the target realignment is against the panel-wide blast database."""
+    alignProgram, alignExt, alignBinary, binaryParams, alignRef = alignParams
+    return scope == 'target' and binaryParams is not None and bool(binaryParams.get('panel'))
+
+
+def get_qname_idx(alignProgram):
+    """Return the index of the query name in the blast tabular or the psl output values."""
+    return 0 if alignProgram == 'blast' else 9
+
+
+def use_native_client(alignParams, scope):
+    """Return True if the realignment is done in process, by querying gfServer directly
+    for the genome or with the seed and extend aligner for the target.
+    """
+    alignProgram, alignExt, alignBinary, binaryParams, alignRef = alignParams
+    return alignProgram == 'blat' and binaryParams is not None and bool(binaryParams['native'])
+
+
+# Target aligners built in this worker process, keyed by (reference fasta, modification time).
+TARGET_ALIGNERS = {}
+
+
+def get_target_aligner(refFn):
+    """Return the in-process aligner for a target reference fasta, indexing it on first use.
+    Args:
+        refFn: String of the target reference fasta file.
+    Return:
+        TargetAligner object.
+    """
+    key = (os.path.abspath(refFn), os.path.getmtime(refFn))
+    if key not in TARGET_ALIGNERS:
+        for cacheKey in [x for x in TARGET_ALIGNERS if x[0] == key[0]]:
+            del TARGET_ALIGNERS[cacheKey]
+        TARGET_ALIGNERS[key] = local_aligner.TargetAligner(os.path.basename(refFn), utils.get_ref_seq(refFn))
+    return TARGET_ALIGNERS[key]
+
+
+# Fusion partner aligners loaded in this worker process, keyed by (partner fasta, modification time).
+PARTNER_ALIGNERS = {}
+
+
+def get_partner_index_fn(faFn):
+    """Return the seed index file name of a partner region fasta."""
+    return faFn + '.idx'
+
+
+def index_partner_regions(faFn):
+    """Build the seed index of the fusion partner region sequences and write it next
+    to the fasta file, unless an index for the current sequences exists.
+    Args:
+        faFn: String of the partner region fasta file.
+    Return: None
+    """
+    indexFn = get_partner_index_fn(faFn)
+    seqs = utils.read_fasta_seqs(faFn)
+    if os.path.isfile(indexFn) and os.path.getmtime(indexFn) >= os.path.getmtime(faFn) and local_aligner.read_index(indexFn, seqs) is not None:
+        return
+    utils.log('breakmer.realignment.realigner', 'info', 'Indexing %d partner region sequences in %s' % (len(seqs), faFn))
+    local_aligner.RegionAligner(seqs).write_index(indexFn)
+
+
+def get_partner_aligner(faFn):
+    """Return the in-process aligner for the fusion partner regions, loading the seed
+    index written at reference preparation or indexing the sequences on first use.
+    Args:
+        faFn: String of the partner region fasta file.
+    Return:
+        RegionAligner object.
+    """
+    key = (os.path.abspath(faFn), os.path.getmtime(faFn))
+    if key not in PARTNER_ALIGNERS:
+        PARTNER_ALIGNERS.clear()
+        seqs = utils.read_fasta_seqs(faFn)
+        index = None
+        indexFn = get_partner_index_fn(faFn)
+        if os.path.isfile(indexFn) and os.path.getmtime(indexFn) >= key[1]:
+            index = local_aligner.read_index(indexFn, seqs)
+        PARTNER_ALIGNERS[key] = local_aligner.RegionAligner(seqs, index=index)
+    return PARTNER_ALIGNERS[key]
+
+
+def get_uncovered_intervals(covered, qSize, minSize):
+    """Return the query intervals of at least minSize bases not in any covered interval.
+    Args:
+        covered: List of tuples with the start and end of the aligned query intervals.
+        qSize:   Integer of the query size.
+        minSize: Integer of the minimum uncovered interval size to report.
+    Return:
+        List of tuples with the start and end of the uncovered intervals.
+    """
+    intervals = []
+    qPos = 0
+    for qStart, qEnd in sorted(covered) + [(qSize, qSize)]:
+        if (qStart - qPos) >= minSize:
+            intervals.append((qPos, qStart))
+        qPos = max(qPos, qEnd)
+    return intervals
+
+
+def in_record_span(record, records):
+    """Return True if an AlignRecord is within the reference span of any of the records."""
+    for spanRecord in records:
+        if record.tName == spanRecord.tName and record.tStart >= spanRecord.tStart and record.tEnd <= spanRecord.tEnd:
+            return True
+    return False
+
+
+def is_low_complexity(seq, dustThresh=5.0, window=64):
+    """Return True if more than half of the windows of a sequence have a DUST score
+    above dustThresh.
+    """
+    starts = range(0, max(1, len(seq) - window + 1), window / 2)
+    nlow = len([x for x in starts if utils.dust_score(seq[x:x + window].upper()) > dustThresh])
+    return 2 * nlow > len(starts)
+
+
+def get_query_overlap(record, otherRecord):
+    """Return the query overlap of two records as a fraction of the shorter record."""
+    overlap = min(record.qEnd, otherRecord.qEnd) - max(record.qStart, otherRecord.qStart)
+    shortest = min(record.qEnd - record.qStart, otherRecord.qEnd - otherRecord.qStart)
+    if overlap <= 0 or shortest <= 0:
+        return 0.0
+    return float(overlap) / float(shortest)
+
+
+def is_unique_partner_record(record, records, qSeq, maxRepFrac=0.5, minOverlap=0.5):
+    """Return True if a fusion partner record places its query interval unambiguously.
+    A record is not unique if most of its matches are repeat masked, if the aligned
+    query sequence is low complexity, or if another record at a different reference
+    location aligns most of the same query interval.
+    Args:
+        record:     AlignRecord of the partner alignment, in genome coordinates.
+        records:    List of the target and partner AlignRecords of the query.
+        qSeq:       String of the query sequence.
+        maxRepFrac: Float of the largest fraction of repeat matches.
+        minOverlap: Float of the query overlap fraction for two records to align the same interval.
+    Return:
+        Boolean
+    """
+    nmatches = record.matches + record.repmatches
+    if nmatches == 0 or float(record.repmatches) / float(nmatches) > maxRepFrac:
+        return False
+    if is_low_complexity(qSeq[record.qStart:record.qEnd]):
+        return False
+    for otherRecord in records:
+        if otherRecord is record:
+            continue
+        sameLocation = otherRecord.tName == record.tName and otherRecord.tStart < record.tEnd and record.tStart < otherRecord.tEnd
+        if not sameLocation and get_query_overlap(record, otherRecord) >= minOverlap:
+            return False
+    return True
+
+
+def run_align_cmd(loggingName, cmd, resultFn):
+    """Run a realignment system command.
+    Args:
+        loggingName: String of the logger name to report to.
+        cmd:         String of the system command.
+        resultFn:    String of the file the aligner writes the results to.
+    Return:
+        Boolean indicating whether the aligner exited cleanly and wrote the result file.
+        A partial result file of a failed command is removed.
+    """
+    utils.log(loggingName, 'info', 'Realignment system command %s' % cmd)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    output, errors = p.communicate()
+    utils.log(loggingName, 'info', 'Realignment output file %s' % resultFn)
+    if p.returncode != 0 or errors != '':
+        utils.log(loggingName, 'error', 'Realignment failed with exit code %d, errors %s' % (p.returncode, errors))
+        if os.path.isfile(resultFn):
+            os.remove(resultFn)
+        return False
+    return os.path.isfile(resultFn)
+
+
 class AlignParams:
     """
     """
@@ -22,6 +297,9 @@ class AlignParams:
         self.binary = {'target': None, 'genome': None}
         self.binaryParams = {'target': None, 'genome': None}
         self.ref = {'target': None, 'genome': None}
+        self.cacheValues = {}
+        self.partialFlank = None  # Flank of the uncovered query intervals in partial genome realignment.
+        self.partnerFn = None  # Fusion partner region fasta realigned to before the genome.
         self.set_values(params, targetRefFns)
 
     def set_values(self, params, targetRefFns):
@@ -33,17 +311,86 @@ class AlignParams:
             self.program['target'] = 'blast'
             self.binary['target'] = blast
             self.extension['target'] = 'txt'
+        self.binaryParams['target'] = {'native': params.get_param('native_target_aligner'),
+                                       'panel': False,
+                                       'threads': None}
+        self.targetRefFn = targetRefFns[0]
 
         self.binary['genome'] = params.get_param('gfclient')
         self.binaryParams['genome'] = {'hostname': params.get_param('blat_hostname'),
-                                       'port': int(params.get_param('blat_port'))}
+                                       'port': None,
+                                       'ports': params.get_param('blat_ports'),
+                                       'native': params.get_param('native_gfclient'),
+                                       'twobit': params.get_param('blat_2bit'),
+                                       'index': params.get_param('genome_index')}
+        if self.binaryParams['genome']['index'] is not None:
+            # Genome realignment with the local minimizer index, no blat server is running.
+            self.binaryParams['genome']['native'] = True
+        else:
+            self.binaryParams['genome']['port'] = int(params.get_param('blat_port'))
+        if self.binaryParams['genome']['ports'] is None:
+            self.binaryParams['genome']['ports'] = [self.binaryParams['genome']['port']]
+        if self.binaryParams['genome']['twobit'] is None:
+            refFastaName = os.path.basename(params.get_param('reference_fasta').split(".fa")[0])
+            self.binaryParams['genome']['twobit'] = os.path.join(params.get_param('reference_fasta_dir'), refFastaName + ".2bit")
         # Use the forward sequence for blatting targeted sequences
         self.ref['target'] = targetRefFns[0]
+        if blast is not None and params.get_param('panel_blast_db_fn') is not None:
+            # One blast database of all the panel targets, searched with the worker's share of the cpus.
+            self.ref['target'] = params.get_param('panel_blast_db_fn')
+            self.binaryParams['target']['panel'] = True
+            self.binaryParams['target']['threads'] = max(1, multiprocessing.cpu_count() / max(1, int(params.get_param('nprocs'))))
         self.ref['genome'] = params.get_param('reference_fasta_dir')
 
+        # Partial genome and partner realignment need the psl records of the target realignment.
+        if params.get_param('partner_regions_fa') is not None and self.program['target'] == 'blat':
+            self.partnerFn = params.get_param('partner_regions_fa')
+        if params.get_param('partial_genome_realign') and self.program['target'] == 'blat':
+            self.partialFlank = 20
+            if params.get_param('partial_genome_flank') is not None:
+                self.partialFlank = int(params.get_param('partial_genome_flank'))
+
     def get_values(self, type):
         return (self.program[type], self.extension[type], self.binary[type], self.binaryParams[type], self.ref[type])
 
+    def get_cache_values(self, scope):
+        """Return a string identifying the aligner, its parameters and the reference
+        of a realignment scope, used to key the realignment cache. Run specific paths,
+        the blat server host and port are left out so the values hold across runs.
+        """
+        if scope not in self.cacheValues:
+            alignProgram, alignExt, alignBinary, binaryParams, alignRef = self.get_values(scope)
+            cmd = ''
+            if scope != 'genome' or binaryParams['index'] is None:
+                cmd = get_align_cmd(self.get_values(scope), scope, '', '')
+            if alignRef:
+                cmd = cmd.replace(alignRef, '')
+            if alignBinary:
+                cmd = cmd.replace(alignBinary, os.path.basename(alignBinary))
+            if binaryParams is not None and binaryParams.get('threads') is not None:
+                cmd = cmd.replace('-num_threads %d ' % binaryParams['threads'], '')
+            if use_native_client(self.get_values(scope), scope):
+                cmd = 'native ' + cmd
+            if scope == 'genome' and binaryParams['index'] is not None:
+                cmd = 'native genome_index'
+                refValues = os.path.basename(binaryParams['index'])
+                if os.path.isfile(binaryParams['index']):
+                    refValues += ':%d' % os.path.getsize(binaryParams['index'])
+            elif scope == 'genome':
+                cmd = cmd.replace('%s %d' % (binaryParams['hostname'], binaryParams['port']), '')
+                refValues = os.path.basename(binaryParams['twobit'])
+                if os.path.isfile(binaryParams['twobit']):
+                    refValues += ':%d' % os.path.getsize(binaryParams['twobit'])
+            else:
+                # Panel-wide blast records are limited to the target sequence.
+                refValues = hashlib.sha1(utils.get_ref_seq(self.targetRefFn)).hexdigest()
+            if scope == 'genome' and self.partialFlank is not None:
+                # Partial genome records are merged with the target records.
+                cmd = 'partial %d ' % self.partialFlank + cmd
+                refValues += '\t' + self.get_cache_values('target')
+            self.cacheValues[scope] = '\t'.join([cmd, refValues])
+        return self.cacheValues[scope]
+
 
 class RealignManager:
     """
@@ -52,6 +399,7 @@ class RealignManager:
     def __init__(self, params, targetRefFns):
         self.realignment = None
         self.alignParams = AlignParams(params, targetRefFns)
+        self.cache = realign_cache.get_cache(params)
 
     def realign(self, contig):
         """
@@ -59,15 +407,27 @@ class RealignManager:
         if not contig.has_fa_fn():
             return
 
-        self.realignment = Realignment(contig)
-        if not self.realignment.align(self.alignParams.get_values('target'), 'target'):
+        self.realignment = Realignment(contig, self.cache)
+        if not self.realignment.align(self.alignParams.get_values('target'), 'target', self.get_cache_values('target')):
             return
         if not self.realignment.target_aligned():
-            self.realignment.align(self.alignParams.get_values('genome'), 'genome')
+            if self.alignParams.partnerFn is not None:
+                self.realignment.set_align_values(self.alignParams.get_values('genome'), 'genome')
+                if self.realignment.align_partners(get_partner_aligner(self.alignParams.partnerFn)):
+                    return
+            if self.alignParams.partialFlank is not None:
+                self.realignment.set_partial_query(self.alignParams.partialFlank)
+            self.realignment.align(self.alignParams.get_values('genome'), 'genome', self.get_cache_values('genome'))
         else:
             if self.realignment.targetHit and self.alignParams.get_values('target')[0] == 'blast':
                 self.realignment.check_record_merge()
 
+    def get_cache_values(self, scope):
+        """Return the realignment cache values of a scope, None if caching is off."""
+        if self.cache is None:
+            return None
+        return self.alignParams.get_cache_values(scope)
+
     def get_result_fn(self):
         resultFn = None
         if self.realignment.has_results():
@@ -93,10 +453,186 @@ class RealignManager:
         return self.realignment.results.querySize
 
 
+class BatchRealigner:
+    """Realign all the contigs of a target with a single aligner call per scope.
+
+    The contig sequences are written to one multi-fasta file and the alignment
+    records are split back into the per-contig result files by query name, so
+    the downstream parsing and calling is unchanged. Genome realignments can be
+    split over several concurrent queries to the blat server.
+    """
+
+    def __init__(self, params, targetRefFns, batchPath, batchName):
+        self.loggingName = 'breakmer.realignment.realigner'
+        self.params = params
+        self.targetRefFns = targetRefFns
+        self.path = batchPath
+        self.name = batchName
+        self.alignParams = AlignParams(params, targetRefFns)
+        self.cache = realign_cache.get_cache(params)
+        self.maxInflight = 1
+        if params.get_param('genome_realign_inflight') is not None:
+            self.maxInflight = max(1, int(params.get_param('genome_realign_inflight')))
+
+    def realign(self, contigs):
+        """Realign the contigs to the target and then the contigs without a target
+        hit to the genome.
+        Args:
+            contigs: List of Contig objects with their meta information set.
+        Return:
+            Generator of the Contig objects, in input order, each yielded once its
+            realignment is complete.
+        """
+        realignments = []
+        for contig in contigs:
+            realignManager = RealignManager(self.params, self.targetRefFns)
+            contig.set_realignment(realignManager)
+            if contig.has_fa_fn():
+                realignManager.realignment = Realignment(contig, self.cache)
+                realignments.append(realignManager.realignment)
+
+        genomeRealignments = []
+        npartner = 0
+        for realignment in self.align(realignments, 'target'):
+            if not realignment.target_aligned():
+                if self.alignParams.partnerFn is not None:
+                    realignment.set_align_values(self.alignParams.get_values('genome'), 'genome')
+                    if realignment.align_partners(get_partner_aligner(self.alignParams.partnerFn)):
+                        npartner += 1
+                        continue
+                if self.alignParams.partialFlank is not None:
+                    realignment.set_partial_query(self.alignParams.partialFlank)
+                genomeRealignments.append(realignment)
+            elif realignment.targetHit and self.alignParams.get_values('target')[0] == 'blast':
+                realignment.check_record_merge()
+
+        if self.alignParams.partnerFn is not None:
+            utils.log(self.loggingName, 'info', 'Fusion partner realignment explained %d of %d contigs without a target alignment, %d genome queries avoided' % (npartner, npartner + len(genomeRealignments), npartner))
+        genomeIds = set([x.contig.get_id() for x in genomeRealignments])
+        genomeAligned = self.align_concurrent(genomeRealignments, 'genome')
+        for contig in contigs:
+            if contig.has_fa_fn() and contig.get_id() in genomeIds:
+                # Genome realignments complete in contig order.
+                genomeAligned.next()
+            yield contig
+
+        if self.cache is not None:
+            utils.log(self.loggingName, 'info', 'Realignment cache %s, %d hits and %d misses' % (self.cache.path, self.cache.hits, self.cache.misses))
+
+    def align_concurrent(self, realignments, scope):
+        """Split the realignments into batches and run up to maxInflight batches at a time.
+        Args:
+            realignments: List of Realignment objects to align.
+            scope:        String of the realignment scope.
+        Return:
+            Generator of the Realignment objects, in input order, as their batch completes.
+        """
+        if len(realignments) == 0:
+            return
+
+        if use_native_client(self.alignParams.get_values(scope), scope):
+            batches = [[x] for x in realignments]
+        else:
+            batchSize = int(math.ceil(float(len(realignments)) / min(self.maxInflight, len(realignments))))
+            batches = [realignments[i:i + batchSize] for i in range(0, len(realignments), batchSize)]
+
+        def align_batch(batchValues):
+            batchIdx, batch = batchValues
+            self.align(batch, scope, batchIdx)
+            return batch
+
+        if self.maxInflight == 1 or len(batches) == 1:
+            for batchValues in enumerate(batches):
+                for realignment in align_batch(batchValues):
+                    yield realignment
+            return
+
+        utils.log(self.loggingName, 'info', 'Running %s realignment of %d contigs in %d batches with %d queries in flight' % (scope, len(realignments), len(batches), self.maxInflight))
+        pool = ThreadPool(min(self.maxInflight, len(batches)))
+        try:
+            for batch in pool.imap(align_batch, enumerate(batches)):
+                for realignment in batch:
+                    yield realignment
+        finally:
+            pool.close()
+            pool.join()
+
+    def align(self, realignments, scope, batchIdx=None):
+        """Run one alignment of all the contig sequences for a scope.
+        Args:
+            realignments: List of Realignment objects to align.
+            scope:        String of the realignment scope, 'target' or 'genome'.
+            batchIdx:     Integer index of the batch when a scope is split in several batches.
+        Return:
+            List of Realignment objects with a result file for the scope.
+        """
+        if len(realignments) == 0:
+            return []
+
+        alignParams = self.alignParams.get_values(scope)
+        cacheValues = None
+        if self.cache is not None:
+            cacheValues = self.alignParams.get_cache_values(scope)
+        aligned = []
+        pending = []
+        for realignment in realignments:
+            realignment.set_align_values(alignParams, scope)
+            if realignment.load_cached_results(cacheValues):
+                aligned.append(realignment)
+            else:
+                pending.append(realignment)
+
+        if len(pending) == 0:
+            pass
+        elif use_native_client(alignParams, scope):
+            # Aligned per contig in process, without intermediate files.
+            aligned.extend([x for x in pending if x.align_native()])
+        else:
+            aligned.extend(self.align_batch(pending, alignParams, scope, batchIdx))
+        # Only results of a clean aligner exit are cached, failed realignments are retried in later runs.
+        for realignment in pending:
+            if realignment in aligned:
+                realignment.cache_results()
+        return [x for x in realignments if x in aligned]
+
+    def align_batch(self, realignments, alignParams, scope, batchIdx):
+        """Write the contig sequences to a multi-fasta file, realign them with a single
+        aligner call and split the results by contig.
+        Args:
+            realignments: List of Realignment objects to align.
+            alignParams:  Tuple of aligner values from AlignParams.get_values().
+            scope:        String of the realignment scope, 'target' or 'genome'.
+            batchIdx:     Integer index of the batch when a scope is split in several batches.
+        Return:
+            List of Realignment objects with a result file for the scope.
+        """
+        alignProgram, alignExt = alignParams[0:2]
+        batchName = '%s_%s_batch' % (self.name, scope)
+        if batchIdx is not None:
+            batchName += str(batchIdx)
+        queryFn = os.path.join(self.path, batchName + '.fa')
+        resultFn = os.path.join(self.path, '%s_res.%s' % (batchName, alignExt))
+        utils.log(self.loggingName, 'info', 'Running %s realignment of %d contigs with %s, storing results in %s' % (scope, len(realignments), alignProgram, resultFn))
+
+        queryFile = open(queryFn, 'w')
+        for realignment in realignments:
+            for queryName, querySeq in realignment.get_queries():
+                queryFile.write('>' + queryName + '\n' + querySeq + '\n')
+        queryFile.close()
+
+        port = None
+        if scope == 'genome':
+            port = get_server_ports(alignParams[3])[0]
+        if not run_align_cmd(self.loggingName, get_align_cmd(alignParams, scope, queryFn, resultFn, port), resultFn):
+            return []
+        split_results(resultFn, alignProgram, realignments, use_panel_db(alignParams, scope))
+        return [x for x in realignments if x.load_results()]
+
+
 class Realignment:
     """
     """
-    def __init__(self, contig):
+    def __init__(self, contig, cache=None):
         self.loggingName = 'breakmer.realignment.realigner'
         self.scope = None
         self.results = None
@@ -104,39 +640,245 @@ class Realignment:
         self.resultFn = None
         self.alignParams = None
         self.contig = contig
+        self.cache = cache
+        self.cacheKey = None
+        self.partialQueries = None  # List of query intervals realigned to the genome, None to realign the whole contig.
+        self.partialRecords = []  # List of target psl records merged with the partial genome records.
 
-    def align(self, alignParams, scope):
-        """
+    def set_align_values(self, alignParams, scope):
+        """Set the aligner values and the result file for a realignment scope.
+        Args:
+            alignParams: Tuple of aligner values from AlignParams.get_values().
+            scope:       String of the realignment scope, 'target' or 'genome'.
+        Return: None
         """
         self.alignParams = alignParams
         alignProgram, alignExt, alignBinary, binaryParams, alignRef = self.alignParams
         self.scope = scope
-
         self.resultFn = os.path.join(self.contig.get_path(), '%s_res.%s.%s' % (alignProgram, scope, alignExt))
-        utils.log(self.loggingName, 'info', 'Running realignment with %s, storing results in %s' % (alignProgram, self.resultFn))
-
-        cmd = ''
-        if alignProgram == 'blast':
-            cmd = "%s -task 'blastn-short' -db %s -query %s -evalue 0.01 -out %s -outfmt '7 qseqid sseqid pident qlen length mismatch gapopen qstart qend sstart send evalue bitscore gaps sstrand qseq sseq'" % (alignBinary, alignRef, self.contig.meta.fa_fn, self.resultFn)
-        elif alignProgram == 'blat':
-            if scope == 'genome':
-                # all blat server
-                cmd = '%s -t=dna -q=dna -out=psl -minScore=20 -nohead %s %d %s %s %s' % (alignBinary, binaryParams['hostname'], binaryParams['port'], alignRef, self.contig.meta.fa_fn, self.resultFn)
-            elif scope == 'target':
-                # target
-                cmd = '%s -t=dna -q=dna -out=psl -minScore=20 -stepSize=10 -minMatch=2 -repeats=lower -noHead %s %s %s' % (alignBinary, alignRef, self.contig.meta.fa_fn, self.resultFn)
-
-        utils.log(self.loggingName, 'info', 'Realignment system command %s' % cmd)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        output, errors = p.communicate()
-        utils.log(self.loggingName, 'info', 'Realignment output file %s' % self.resultFn)
-        if errors != '':
-            utils.log(self.loggingName, 'info', 'Realignment errors %s' % errors)
 
+    def align(self, alignParams, scope, cacheValues=None):
+        """
+        """
+        self.set_align_values(alignParams, scope)
+        if self.load_cached_results(cacheValues):
+            return True
+        if use_native_client(self.alignParams, scope):
+            aligned = self.align_native()
+        else:
+            alignProgram = self.alignParams[0]
+            utils.log(self.loggingName, 'info', 'Running realignment with %s, storing results in %s' % (alignProgram, self.resultFn))
+            queryFn = self.get_query_fn()
+            completed = True
+            if queryFn is not None:
+                port = None
+                if scope == 'genome':
+                    port = get_server_ports(self.alignParams[3])[0]
+                if use_panel_db(self.alignParams, scope):
+                    panelResultFn = self.resultFn + '.panel'
+                    cmd = get_align_cmd(self.alignParams, scope, queryFn, panelResultFn, port)
+                    completed = run_align_cmd(self.loggingName, cmd, panelResultFn)
+                    if completed:
+                        split_results(panelResultFn, alignProgram, [self], True)
+                else:
+                    cmd = get_align_cmd(self.alignParams, scope, queryFn, self.resultFn, port)
+                    completed = run_align_cmd(self.loggingName, cmd, self.resultFn)
+            aligned = completed and self.load_results()
+        if aligned:
+            self.cache_results()
+        return aligned
+
+    def set_partial_query(self, flank, minSize=20):
+        """Limit the genome realignment to the query intervals not covered by the target
+        realignment records, each extended by flank bases on both sides. Intervals
+        shorter than minSize are not realigned. The target records are kept, in genome
+        coordinates, to merge with the genome records of the intervals.
+        Args:
+            flank:   Integer of the bases added to each side of an uncovered interval.
+            minSize: Integer of the minimum uncovered interval size to realign.
+        Return: None
+        """
+        self.partialQueries = None
+        self.partialRecords = []
+        if self.results is None or not self.results.hasResults or self.results.program != 'blat':
+            return
+        qSize = len(self.contig.seq)
+        intervals = []
+        for qStart, qEnd in get_uncovered_intervals([(x.qstart(), x.qend()) for x in self.results.results], qSize, minSize):
+            intervals.append((max(0, qStart - flank), min(qSize, qEnd + flank)))
+        self.partialQueries = intervals
+        self.partialRecords = [x.values.get_psl_values() for x in self.results.results]
+        utils.log(self.loggingName, 'info', 'Partial genome realignment of %s, %d of %d query bases in %d intervals' % (self.contig.get_id(), sum([x[1] - x[0] for x in intervals]), qSize, len(intervals)))
+
+    def get_queries(self):
+        """Return a list of tuples with the name and sequence of each query aligned for the current scope."""
+        if self.scope != 'genome' or self.partialQueries is None:
+            return [(self.contig.get_id(), self.contig.seq)]
+        return [('%s_%d_%d' % (self.contig.get_id(), start, end), self.contig.seq[start:end]) for start, end in self.partialQueries]
+
+    def get_query_fn(self):
+        """Return the fasta file of the queries for the current scope, None if there is nothing to align."""
+        if self.scope != 'genome' or self.partialQueries is None:
+            return self.contig.meta.fa_fn
+        if len(self.partialQueries) == 0:
+            return None
+        queryFn = os.path.join(self.contig.get_path(), 'genome_partial_query.fa')
+        queryFile = open(queryFn, 'w')
+        for queryName, querySeq in self.get_queries():
+            queryFile.write('>' + queryName + '\n' + querySeq + '\n')
+        queryFile.close()
+        return queryFn
+
+    def merge_partial_records(self, resultRecords):
+        """Merge the genome records of the partial queries with the target records.
+        The query coordinates of the genome records are set to the contig, and records
+        within the reference span of a target record are dropped as the flank
+        realigning to the target.
+        Args:
+            resultRecords: Iterable of lists of psl values for the partial queries.
+        Return:
+            List of lists of psl values in contig coordinates.
+        """
+        intervals = dict(zip([x[0] for x in self.get_queries()], self.partialQueries))
+        targetRecords = [blat_result.parse_psl_values(x) for x in self.partialRecords]
+        mergedRecords = [list(x) for x in self.partialRecords]
+        for values in resultRecords:
+            if values[9] not in intervals:
+                continue
+            record = blat_result.parse_psl_values(values)
+            if in_record_span(record, targetRecords):
+                continue
+            record.shift_query(self.contig.get_id(), len(self.contig.seq), intervals[values[9]][0])
+            mergedRecords.append(record.get_psl_values())
+        return mergedRecords
+
+    def align_partners(self, partnerAligner, minSize=20):
+        """Realign the contig in process to the fusion partner regions. If the target and
+        partner records leave no query interval of minSize or more bases uncovered, the
+        merged records, in genome coordinates, are set as the genome results. A contig
+        with a repeat derived, low complexity or multiple hit partner record is left for
+        the genome realignment, which reports all the places the segment aligns.
+        Args:
+            partnerAligner: RegionAligner object of the partner region sequences.
+            minSize:        Integer of the minimum uncovered interval size.
+        Return:
+            Boolean indicating whether the contig is explained without a genome realignment.
+        """
+        if self.results is None or not self.results.hasResults or self.results.program != 'blat':
+            return False
+        targetValues = [x.values.get_psl_values() for x in self.results.results]
+        targetRecords = [blat_result.parse_psl_values(x) for x in targetValues]
+        partnerRecords = []
+        for values in partnerAligner.align(self.contig.get_id(), self.contig.seq):
+            record = blat_result.parse_psl_values(values)
+            # Partner sequences are named chrom:start-end.
+            chrom, coords = record.tName.rsplit(':', 1)
+            record.adjust_values(chrom, int(coords.split('-')[0]))
+            if not in_record_span(record, targetRecords):
+                partnerRecords.append(record)
+        if len(partnerRecords) == 0:
+            return False
+        for record in partnerRecords:
+            if not is_unique_partner_record(record, targetRecords + partnerRecords, self.contig.seq):
+                utils.log(self.loggingName, 'info', 'Contig %s fusion partner record %s:%d-%d is repeat derived, low complexity or not unique, realigning to the genome' % (self.contig.get_id(), record.tName, record.tStart, record.tEnd))
+                return False
+        covered = [(x.qStart, x.qEnd) for x in targetRecords + partnerRecords]
+        if len(get_uncovered_intervals(covered, len(self.contig.seq), minSize)) > 0:
+            return False
+        utils.log(self.loggingName, 'info', 'Contig %s explained by %d target and %d fusion partner records' % (self.contig.get_id(), len(targetRecords), len(partnerRecords)))
+        alignProgram, alignExt, alignBinary, binaryParams, alignRef = self.alignParams
+        self.results = AlignResults(alignProgram, self.scope, self.resultFn, self.contig, alignRef, targetValues + [x.get_psl_values() for x in partnerRecords])
+        return True
+
+    def load_cached_results(self, cacheValues):
+        """Set the results of the current scope from the realignment cache.
+        Args:
+            cacheValues: String from AlignParams.get_cache_values(), None if caching is off.
+        Return:
+            Boolean indicating whether the results were cached.
+        """
+        self.cacheKey = None
+        if self.cache is None or cacheValues is None:
+            return False
+        alignProgram, alignExt, alignBinary, binaryParams, alignRef = self.alignParams
+        self.cacheKey = self.cache.get_key(self.contig.seq, self.scope, cacheValues)
+        resultRecords = self.cache.get(self.cacheKey, self.contig.get_id(), get_qname_idx(alignProgram))
+        if resultRecords is None:
+            return False
+        utils.log(self.loggingName, 'info', 'Using %d cached %s realignment records for %s' % (len(resultRecords), self.scope, self.contig.get_id()))
+        self.results = AlignResults(alignProgram, self.scope, self.resultFn, self.contig, alignRef, resultRecords)
+        # Not stored again.
+        self.cacheKey = None
+        return True
+
+    def cache_results(self):
+        """Store the records of the current scope results in the realignment cache."""
+        if self.cacheKey is None or self.results is None or self.results.scope != self.scope:
+            return
+        self.cache.put(self.cacheKey, self.results.get_result_records(), get_qname_idx(self.alignParams[0]))
+        self.cacheKey = None
+
+    def align_native(self):
+        """Realign the contig in process, with the seed and extend aligner for the target,
+        with the local genome index or by querying the gfServer directly for the genome.
+        Args: None
+        Return:
+            Boolean indicating the alignment was run.
+        """
+        alignProgram, alignExt, alignBinary, binaryParams, alignRef = self.alignParams
+        try:
+            if self.scope == 'target':
+                utils.log(self.loggingName, 'info', 'Running in-process realignment of %s to %s' % (self.contig.get_id(), alignRef))
+                resultRecords = get_target_aligner(alignRef).align(self.contig.get_id(), self.contig.seq)
+            elif binaryParams['index'] is not None:
+                utils.log(self.loggingName, 'info', 'Running in-process realignment of %s with genome index %s' % (self.contig.get_id(), binaryParams['index']))
+                genomeIndex = genome_index.get_genome_index(binaryParams['index'])
+                resultRecords = []
+                for queryName, querySeq in self.get_queries():
+                    resultRecords.extend(genomeIndex.align(queryName, querySeq))
+                if self.partialQueries is not None:
+                    resultRecords = self.merge_partial_records(resultRecords)
+            else:
+                resultRecords = None
+                for port in get_server_ports(binaryParams):
+                    utils.log(self.loggingName, 'info', 'Running realignment of %s with gfServer %s:%d' % (self.contig.get_id(), binaryParams['hostname'], port))
+                    client = gf_client.get_client(binaryParams['hostname'], port, binaryParams['twobit'])
+                    try:
+                        resultRecords = []
+                        for queryName, querySeq in self.get_queries():
+                            resultRecords.extend(client.align(queryName, querySeq))
+                        break
+                    except (IOError, OSError) as err:
+                        # Try the next server while this one is restarted.
+                        utils.log(self.loggingName, 'info', 'gfServer %s:%d query failed for %s, %s' % (binaryParams['hostname'], port, self.contig.get_id(), str(err)))
+                        resultRecords = None
+                if resultRecords is None:
+                    raise IOError('No gfServer completed the query')
+                if self.partialQueries is not None:
+                    resultRecords = self.merge_partial_records(resultRecords)
+        except (IOError, OSError) as err:
+            utils.log(self.loggingName, 'error', 'In-process %s realignment failed for %s, %s' % (self.scope, self.contig.get_id(), str(err)))
+            return False
+        self.results = AlignResults(alignProgram, self.scope, self.resultFn, self.contig, alignRef, resultRecords)
+        return True
+
+    def load_results(self):
+        """Parse the realignment result file for the current scope.
+        Args: None
+        Return:
+            Boolean indicating whether the result file exists.
+        """
+        alignProgram, alignExt, alignBinary, binaryParams, alignRef = self.alignParams
+        if self.scope == 'genome' and self.partialQueries is not None:
+            resultRecords = []
+            if os.path.isfile(self.resultFn):
+                resultRecords = blat_result.read_result_file(self.resultFn)
+            self.results = AlignResults(alignProgram, self.scope, self.resultFn, self.contig, alignRef, self.merge_partial_records(resultRecords))
+            return True
         if not os.path.isfile(self.resultFn):
             return False
         else:
-            self.results = AlignResults(alignProgram, scope, self.resultFn, self.contig, alignRef)
+            self.results = AlignResults(alignProgram, self.scope, self.resultFn, self.contig, alignRef)
             return True
 
     def get_result_fn(self):
@@ -192,9 +934,10 @@ class Realignment:
 
 
 class AlignResults:
-    def __init__(self, program, scope, alignResultFn, contig, alignRefFn):
+    def __init__(self, program, scope, alignResultFn, contig, alignRefFn, resultRecords=None):
         self.loggingName = 'breakmer.realignment.realigner'
         self.resultFn = alignResultFn
+        self.resultRecords = resultRecords  # List of split result lines when the results are not read from file.
         self.program = program
         self.scope = scope
         self.querySize = 0
@@ -214,11 +957,10 @@ class AlignResults:
 
     def set_values(self):
         """ """
-        if not self.resultFn:
-            self.hasResults = False
-        elif len(open(self.resultFn, 'rU').readlines()) == 0:
+        if self.resultRecords is None and not self.resultFn:
             self.hasResults = False
         else:
+            # Single pass over the records, an empty result set leaves hasResults False.
             self.parse_result_file()
 
     def modify_blat_result_file(self):
@@ -284,17 +1026,17 @@ class AlignResults:
         """ """
         refName = None
         offset = None
+        alignRefSeq = None
         if self.scope == 'target':
             # Need to reset the chrom name and coordinates for blat results.
             refName = self.contig.get_chr()
             offset = self.contig.get_target_start() - self.contig.get_target_buffer()
             # print 'Offset', offset
+            if self.program == 'blat':
+                alignRefSeq = utils.get_ref_seq(self.alignRefFn)
 
-        for line in open(self.resultFn, 'r'):
-            if line.find('#') > -1:
-                continue
-            line = line.strip()
-            parsedResult = blat_result.BlatResult(line.split('\t'), refName, offset, self.program, self.alignRefFn, self.contig.seq, self.scope)
+        for record in blat_result.parse_records(self.get_result_records(), self.program, self.contig.seq, alignRefSeq):
+            parsedResult = blat_result.BlatResult(record, refName, offset, self.program, self.alignRefFn, self.contig.seq, self.scope)
             parsedResult.in_target_region(self.contig.get_target_region_coordinates())
             # parsedBlatResult.set_gene_annotations(self.contig.get_target_region_coordinates(), self.contig.get_gene_annotations())
             # parsedBlatResult.set_repeats(self.contig.get_repeat_annotations())
@@ -309,13 +1051,19 @@ class AlignResults:
         if len(self.results) == 0:
             self.hasResults = False
 
+    def get_result_records(self):
+        """Return the split result lines from the stored records or streamed from the result file."""
+        if self.resultRecords is not None:
+            return self.resultRecords
+        return blat_result.read_result_file(self.resultFn)
+
     def merge_records(self):
         """ """
         mergedResults = []
         mapResults = {}
         for mergeIdx in self.mergedRecords:
-            lResult = self.targetSegmentsSorted[mergeIdx[0]][2].resultValues
-            rResult = self.targetSegmentsSorted[mergeIdx[1]][2].resultValues
+            lResult = self.targetSegmentsSorted[mergeIdx[0]][2].resultValues.get_value_dict()
+            rResult = self.targetSegmentsSorted[mergeIdx[1]][2].resultValues.get_value_dict()
             # print 'left', lResult
             # print 'right', rResult
             newMergedIdx = len(mergedResults)
@@ -339,7 +1087,7 @@ class AlignResults:
                     lOuts.append(self.format_to_blat_output(mergedResults[mapResults[i]]))
             else:
                 # print 'Result', self.targetSegmentsSorted[i][2].resultValues
-                lOuts.append(self.format_to_blat_output(self.targetSegmentsSorted[i][2].resultValues))
+                lOuts.append(self.format_to_blat_output(self.targetSegmentsSorted[i][2].resultValues.get_value_dict()))
         # print lOuts
         return lOuts
 
@@ -7,6 +7,7 @@ import glob
 import logging
 import time
 import math
+import collections
 from Bio import SeqIO
 import subprocess
 from pysam import *
@@ -16,6 +17,15 @@ __copyright__ = "Copyright 2015, Ryan Abo"
 __email__ = "ryanabo@gmail.com"
 __license__ = "MIT"
 
+# Per-process cache of reference sequences read from single record fasta files,
+# keyed by (file path, modification time) and evicted least recently used first.
+REF_SEQ_CACHE = collections.OrderedDict()
+REF_SEQ_CACHE_SIZE = 8
+
+# Tile count above which blat treats an 11-mer as overused, blat's implicit repMatch of
+# 1024 for tileSize 11 scaled by tileSize / stepSize for the target realignment stepSize of 10.
+BLAT_OOC_REPMATCH = 1024 * 11 / 10
+
 
 def which(program):
     """Determine the full path to a binary if it is in the system path for execution.
@@ -182,6 +192,154 @@ def stringify(fn):
     return ' '.join(str)
 
 
+def get_ref_seq(fa_fn):
+    """Return the sequence of a single record fasta file, reading the file only if
+    it is not cached or has been modified since it was cached.
+    Args:
+        fa_fn: String of the fasta file name.
+    Return:
+        String of the sequence.
+    """
+
+    key = (os.path.abspath(fa_fn), os.path.getmtime(fa_fn))
+    if key in REF_SEQ_CACHE:
+        seq = REF_SEQ_CACHE.pop(key)
+    else:
+        fa_in = open(fa_fn, "rU")
+        seq = str(SeqIO.read(fa_in, "fasta").seq)
+        fa_in.close()
+        # Drop any stale version of the same file.
+        for cacheKey in [x for x in REF_SEQ_CACHE if x[0] == key[0]]:
+            del REF_SEQ_CACHE[cacheKey]
+        while len(REF_SEQ_CACHE) >= REF_SEQ_CACHE_SIZE:
+            REF_SEQ_CACHE.popitem(last=False)
+    REF_SEQ_CACHE[key] = seq
+    return seq
+
+
+def read_fasta_seqs(fa_fn):
+    """Return a list of tuples with the name and sequence of each record in a fasta file."""
+
+    fa_in = open(fa_fn, "rU")
+    seqs = [(record.id, str(record.seq)) for record in SeqIO.parse(fa_in, "fasta")]
+    fa_in.close()
+    return seqs
+
+
+def setup_partner_regions(bed_fn, ref_fa, ref_path):
+    """Write the reference sequences of the fusion partner regions in a bed file to a
+    fasta file. Overlapping regions are merged and each sequence is named
+    chrom:start-end with the 0-based bed coordinates. The fasta is rewritten when
+    the bed file is modified.
+
+    Args:
+        bed_fn (str):   Bed file of the partner regions, chromosome, start and end columns.
+        ref_fa (str):   Genome reference fasta file.
+        ref_path (str): Directory to write the partner region fasta file.
+    Returns:
+        fa_fn (str):    Partner region fasta file name.
+    """
+
+    logger = logging.getLogger('breakmer.utils')
+    if not os.path.exists(ref_path):
+        os.makedirs(ref_path)
+    fa_fn = os.path.join(ref_path, 'partner_regions.fa')
+    marker_fn = get_marker_fn(fa_fn)
+    if os.path.isfile(marker_fn) and os.path.getmtime(marker_fn) >= os.path.getmtime(bed_fn):
+        logger.info('Partner region fasta (%s) exists already' % fa_fn)
+        return fa_fn
+
+    regions = {}
+    for line in open(bed_fn, 'rU'):
+        line = line.strip()
+        if line == '' or line.startswith('#') or line.startswith('track'):
+            continue
+        linesplit = line.split()
+        regions.setdefault(linesplit[0], []).append((int(linesplit[1]), int(linesplit[2])))
+
+    ref_d = SeqIO.index(ref_fa, 'fasta')
+    fa = open(fa_fn, 'w')
+    nregions = 0
+    for chrom in sorted(regions):
+        if chrom not in ref_d:
+            logger.info('Partner region chromosome %s is not in the reference fasta %s' % (chrom, ref_fa))
+            continue
+        merged = []
+        for start, end in sorted(regions[chrom]):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        chrom_seq = ref_d[chrom].seq
+        for start, end in merged:
+            fa.write('>%s:%d-%d\n%s\n' % (chrom, start, end, str(chrom_seq[start:end])))
+            nregions += 1
+    fa.close()
+    ref_d.close()
+    cmd = 'touch %s' % marker_fn
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    output, errors = p.communicate()
+    logger.info('Completed writing %d partner region sequences to %s, touching marker file %s' % (nregions, fa_fn, marker_fn))
+    return fa_fn
+
+
+def setup_panel_blast_db(targets, ref_fa, ref_path, blastn, region_buffer=200):
+    """Write the forward reference sequences of all the panel targets to one fasta
+    file and make a blast database from it. Each sequence is named with the target
+    name and spans the same region as the per-target reference fasta. The marker file
+    holds the reference fasta, its modification time and the region of each target,
+    and the database is rebuilt when any of these change.
+
+    Args:
+        targets (dict):      Target names with the list of target intervals.
+        ref_fa (str):        Genome reference fasta file.
+        ref_path (str):      Directory to write the panel fasta and blast database files.
+        blastn (str):        Path to the blastn binary, makeblastdb is expected beside it.
+        region_buffer (int): Base pairs added to each side of the target region.
+    Returns:
+        fa_fn (str):         Panel fasta file name, also the blast database name.
+    """
+
+    logger = logging.getLogger('breakmer.utils')
+    if not os.path.exists(ref_path):
+        os.makedirs(ref_path)
+    fa_fn = os.path.join(ref_path, 'panel_refseq.fa')
+    marker_fn = get_marker_fn(fa_fn)
+    target_names = sorted(targets.keys())
+    regions = []
+    for name in target_names:
+        chrom = targets[name][0][0]
+        start = min([int(x[1]) for x in targets[name]])
+        end = max([int(x[2]) for x in targets[name]])
+        regions.append((name, chrom, start - region_buffer, end + region_buffer))
+    marker_lines = ['\t'.join([os.path.abspath(ref_fa), repr(os.path.getmtime(ref_fa))])]
+    marker_lines.extend(['\t'.join([str(x) for x in region]) for region in regions])
+    if os.path.isfile(marker_fn) and os.path.isfile(fa_fn + '.nin') and open(marker_fn, 'r').read().splitlines() == marker_lines:
+        logger.info('Panel blast database (%s) exists already' % fa_fn)
+        return fa_fn
+
+    ref_d = SeqIO.index(ref_fa, 'fasta')
+    fa = open(fa_fn, 'w')
+    for name, chrom, start, end in regions:
+        fa.write('>' + name + '\n' + str(ref_d[chrom].seq[start:end]) + '\n')
+    fa.close()
+    ref_d.close()
+
+    makedb = os.path.join(os.path.split(blastn)[0], 'makeblastdb')
+    cmd = "%s -in %s -dbtype 'nucl' -parse_seqids -out %s" % (makedb, fa_fn, fa_fn)
+    logger.info('Creating panel blast db files for %d targets with reference file %s' % (len(target_names), fa_fn))
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    output, errors = p.communicate()
+    if p.returncode != 0:
+        logger.info('Failed to make panel blast db files using reference file %s, %s' % (fa_fn, errors))
+        return None
+    marker = open(marker_fn, 'w')
+    marker.write('\n'.join(marker_lines) + '\n')
+    marker.close()
+    logger.info('Completed panel blast db %s, writing marker file %s' % (fa_fn, marker_fn))
+    return fa_fn
+
+
 def create_ref_test_fa(target_fa_in, test_fa_out):
     """
     """
@@ -288,6 +446,21 @@ def count_nmers(seq, N):
     return nmers
 
 
+def dust_score(seq, N=3):
+    """Return a DUST-style low complexity score for a sequence. The score is
+    the sum over the distinct N-mers of c * (c - 1) / 2, where c is the N-mer count,
+    divided by the number of N-mers minus one. Higher values indicate lower complexity.
+    """
+
+    nTriplets = len(seq) - (N - 1)
+    if nTriplets < 2:
+        return 0.0
+    score = 0
+    for count in count_nmers(seq, N).values():
+        score += count * (count - 1) / 2
+    return float(score) / float(nTriplets - 1)
+
+
 def is_number(s):
     """
     """
@@ -485,6 +658,9 @@ def setup_ref_data(setup_params):
             target_fa_fn = os.path.join(gene_ref_path, name + '_' + dir + '_refseq.fa')
             ref_fn = extract_refseq_fa(gene, gene_ref_path, ref_fa, dir, target_fa_fn)
             run_jellyfish(ref_fn, jfish_path, kmer_size)
+            if dir == 'forward':
+                # The forward sequence is used for target realignment.
+                make_blat_ooc(ref_fn, blat_path)
         if altref_fa_fns:
             if not create_ref_test_fa(os.path.join(gene_ref_path, name + '_forward_refseq.fa'), os.path.join(gene_ref_path, name + '_start_end_refseq.fa')):
                 return
@@ -624,6 +800,92 @@ def get_fastq_reads_old(fn, sv_reads):
 #     return kmers
 
 
+def setup_rmask(gene_coords, ref_path, rep_mask_fn):
+    """Write the repeat mask intervals that overlap the target region, including
+    the 200 bp buffer used for the reference sequence, to a bed file in the target
+    reference directory.
+
+    Args:
+        gene_coords (tuple): Target values (chrom, start, end, name, ...).
+        ref_path (str):      Path to the target reference data directory.
+        rep_mask_fn (str):   Repeat mask bed file with chrom, start, end, name columns.
+    Returns:
+        rmask_fn (str): Path to the target repeat mask bed file.
+    """
+
+    logger = logging.getLogger('breakmer.utils')
+    chrom = gene_coords[0].replace('chr', '')
+    start = int(gene_coords[1]) - 200
+    end = int(gene_coords[2]) + 200
+    name = gene_coords[3]
+    rmask_fn = os.path.join(ref_path, name + '_rep_mask.bed')
+    marker_fn = get_marker_fn(rmask_fn)
+
+    if not os.path.isfile(marker_fn):
+        rmask_f = open(rmask_fn, 'w')
+        for line in open(rep_mask_fn, 'rU'):
+            linesplit = line.strip().split('\t')
+            if len(linesplit) < 3 or linesplit[0].replace('chr', '') != chrom:
+                continue
+            if int(linesplit[1]) <= end and int(linesplit[2]) >= start:
+                rmask_f.write('\t'.join(linesplit[0:4]) + '\n')
+        rmask_f.close()
+        cmd = 'touch %s' % marker_fn
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        output, errors = p.communicate()
+        logger.info('Completed writing repeat mask file %s, touching marker file %s' % (rmask_fn, marker_fn))
+    else:
+        logger.info('Repeat mask file (%s) exists already' % rmask_fn)
+    return rmask_fn
+
+
+def get_blat_ooc_fn(fa_fn):
+    """Return the blat overused tile file name for a target reference fasta."""
+
+    return fa_fn + '.11.ooc'
+
+
+def make_blat_ooc(fa_fn, blat, rep_match=BLAT_OOC_REPMATCH):
+    """Write the blat overused 11-mer tile file for a target reference fasta.
+
+    Tiles that occur more than rep_match times in the reference are listed in the file
+    and skipped as seeds when the file is passed to blat with -ooc, so each realignment
+    does not repeat the tile counting of the reference. The tiling matches the
+    -stepSize used for the target realignment. The marker file holds rep_match, and the
+    file is rewritten when it was made with a different value.
+    Args:
+        fa_fn:     String of the target reference fasta file.
+        blat:      String of the blat binary.
+        rep_match: Integer of the tile count above which a tile is overused.
+    Return:
+        ooc_fn: String of the ooc file name, None if it could not be written.
+    """
+
+    logger = logging.getLogger('breakmer.utils')
+    ooc_fn = get_blat_ooc_fn(fa_fn)
+    marker_fn = get_marker_fn(ooc_fn)
+    if os.path.isfile(marker_fn) and os.path.isfile(ooc_fn):
+        if open(marker_fn, 'r').read().strip() == str(rep_match):
+            logger.info('Blat ooc file (%s) exists already' % ooc_fn)
+            return ooc_fn
+        logger.info('Blat ooc file (%s) was made with a different repMatch, rewriting' % ooc_fn)
+
+    if blat is None:
+        blat = 'blat'
+    cmd = '%s %s /dev/null /dev/null -tileSize=11 -stepSize=10 -repMatch=%d -makeOoc=%s' % (blat, fa_fn, rep_match, ooc_fn)
+    logger.info('Blat ooc system command %s' % cmd)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    output, errors = p.communicate()
+    if p.returncode != 0 or not os.path.isfile(ooc_fn):
+        logger.info('Failed to write blat ooc file %s, %s' % (ooc_fn, errors))
+        return None
+    marker_f = open(marker_fn, 'w')
+    marker_f.write('%d\n' % rep_match)
+    marker_f.close()
+    logger.info('Completed writing blat ooc file %s, writing marker file %s' % (ooc_fn, marker_fn))
+    return ooc_fn
+
+
 def extract_refseq_fa(gene_coords, ref_path, ref_fa, direction, target_fa_fn):
     """
     """
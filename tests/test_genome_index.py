@@ -0,0 +1,73 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import breakmer.realignment.genome_index as genome_index
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+
+def get_random_seq(rand, size):
+    """ """
+    return ''.join([rand.choice('ACGT') for i in range(size)])
+
+
+class GenomeIndexTest(unittest.TestCase):
+    """Realign queries with a minimizer index of a small genome."""
+
+    @classmethod
+    def setUpClass(cls):
+        rand = random.Random(7)
+        cls.tmpPath = tempfile.mkdtemp()
+        cls.seqs = {'chrA': get_random_seq(rand, 30000), 'chrB': get_random_seq(rand, 20000)}
+        faFn = os.path.join(cls.tmpPath, 'ref.fa')
+        faFile = open(faFn, 'w')
+        for name in sorted(cls.seqs):
+            faFile.write('>%s\n%s\n' % (name, cls.seqs[name]))
+        faFile.close()
+        indexFn = os.path.join(cls.tmpPath, 'ref.mzi')
+        genome_index.build_index(faFn, indexFn)
+        cls.index = genome_index.GenomeIndex(indexFn)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.index.close()
+        shutil.rmtree(cls.tmpPath)
+
+    def get_record_values(self, records):
+        """Return the strand, query interval, target, target interval, block count and insert bases of psl records."""
+        return sorted([(x[8], int(x[11]), int(x[12]), x[13], int(x[15]), int(x[16]), int(x[17]), int(x[5]), int(x[7])) for x in records])
+
+    def test_align(self):
+        """ """
+        records = self.index.align('query', self.seqs['chrB'][5000:5300])
+        self.assertEqual(self.get_record_values(records), [('+', 0, 300, 'chrB', 5000, 5300, 1, 0, 0)])
+
+    def test_gapped_align(self):
+        """A deletion and a tandem duplication are each one gapped record."""
+        chrA = self.seqs['chrA']
+        records = self.index.align('deletion', chrA[3000:3150] + chrA[3450:3600])
+        self.assertEqual(self.get_record_values(records), [('+', 0, 300, 'chrA', 3000, 3600, 2, 0, 300)])
+        records = self.index.align('duplication', chrA[6000:6150] + chrA[6000:6300])
+        self.assertEqual(self.get_record_values(records), [('+', 0, 450, 'chrA', 6000, 6300, 2, 150, 0)])
+
+    def test_fusion(self):
+        """Segments on different sequences are separate records. Bases matching both
+        sides of the junction can be aligned to either record.
+        """
+        query = self.seqs['chrA'][8000:8150] + self.seqs['chrB'][12000:12150]
+        records = self.get_record_values(self.index.align('fusion', query))
+        self.assertEqual([(x[0], x[3], x[6]) for x in records], [('+', 'chrA', 1), ('+', 'chrB', 1)])
+        self.assertEqual((records[0][1], records[0][4], records[1][2], records[1][5]), (0, 8000, 300, 12150))
+        self.assertTrue(records[0][2] >= 150 and records[1][1] <= 150)
+
+
+if __name__ == '__main__':
+    unittest.main()
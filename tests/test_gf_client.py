@@ -0,0 +1,135 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import unittest
+import distutils.spawn
+import breakmer.realignment.gf_client as gf_client
+import breakmer.realignment.gf_server as gf_server
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+BINARIES = ['gfServer', 'gfClient', 'faToTwoBit']
+HOSTNAME = 'localhost'
+
+
+def get_free_port():
+    """Return a port that is free on the local host."""
+    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    conn.bind((HOSTNAME, 0))
+    port = conn.getsockname()[1]
+    conn.close()
+    return port
+
+
+def get_random_seq(rand, size):
+    """ """
+    return ''.join([rand.choice('ACGT') for i in range(size)])
+
+
+@unittest.skipIf(None in [distutils.spawn.find_executable(x) for x in BINARIES], 'gfServer, gfClient and faToTwoBit are not on PATH')
+class GfClientTest(unittest.TestCase):
+    """Compare the GfClient records with the gfClient psl output of a locally started gfServer."""
+
+    @classmethod
+    def setUpClass(cls):
+        rand = random.Random(11)
+        cls.tmpPath = tempfile.mkdtemp()
+        cls.seqs = {'chrA': get_random_seq(rand, 20000), 'chrB': get_random_seq(rand, 15000)}
+        faFn = os.path.join(cls.tmpPath, 'ref.fa')
+        faFile = open(faFn, 'w')
+        for name in sorted(cls.seqs):
+            faFile.write('>%s\n%s\n' % (name, cls.seqs[name]))
+        faFile.close()
+        cls.twoBitFn = os.path.join(cls.tmpPath, 'ref.2bit')
+        subprocess.check_call(['faToTwoBit', faFn, cls.twoBitFn])
+        cls.port = get_free_port()
+        cls.pool = gf_server.GfServerPool('gfServer', HOSTNAME, [cls.port], cls.twoBitFn, cls.tmpPath)
+        if not cls.pool.start(timeout=60, checkInterval=1):
+            cls.pool.stop()
+            shutil.rmtree(cls.tmpPath)
+            raise unittest.SkipTest('Unable to start gfServer on port %d' % cls.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.stop()
+        shutil.rmtree(cls.tmpPath)
+
+    def get_queries(self):
+        """Return contig-like queries: a plain segment, a reverse strand segment and a
+        segment joining the two reference sequences.
+        """
+        chrA = self.seqs['chrA']
+        chrB = self.seqs['chrB']
+        return [('plus', chrA[1000:1300]),
+                ('minus', gf_client.local_aligner.reverse_complement(chrB[5000:5250])),
+                ('fusion', chrA[8000:8150] + chrB[12000:12150])]
+
+    def get_gapped_queries(self):
+        """Return queries with a deletion beyond the alignment band and a tandem duplication."""
+        chrA = self.seqs['chrA']
+        return [('deletion', chrA[3000:3150] + chrA[3450:3600]),
+                ('duplication', chrA[6000:6150] + chrA[6000:6300])]
+
+    def get_gfclient_records(self, qName, qSeq):
+        """Run gfClient on a query and return its psl records."""
+        qFn = os.path.join(self.tmpPath, qName + '.fa')
+        qFile = open(qFn, 'w')
+        qFile.write('>%s\n%s\n' % (qName, qSeq))
+        qFile.close()
+        resultFn = os.path.join(self.tmpPath, qName + '.psl')
+        subprocess.check_call(['gfClient', '-t=dna', '-q=dna', '-out=psl', '-minScore=20', '-nohead', HOSTNAME, str(self.port), self.tmpPath, qFn, resultFn])
+        return [line.rstrip('\n').split('\t') for line in open(resultFn, 'r') if line.strip()]
+
+    def get_record_keys(self, records):
+        """Return the strand, query interval and target interval of psl records."""
+        return sorted([(x[8], int(x[11]), int(x[12]), x[13], int(x[15]), int(x[16])) for x in records])
+
+    def test_query(self):
+        """The server accepts the query and reports hit ranges until the end message."""
+        client = gf_client.GfClient(HOSTNAME, self.port, self.twoBitFn)
+        ranges = client.query(self.seqs['chrA'][1000:1300])
+        self.assertTrue(len(ranges) > 0)
+        for qStart, qEnd, tName, tStart, tEnd in ranges:
+            self.assertTrue(client.twoBit.has_seq(tName))
+            self.assertTrue(qStart < qEnd and tStart < tEnd)
+
+    def test_twobit_seq(self):
+        """ """
+        twoBit = gf_client.TwoBitFile(self.twoBitFn)
+        self.assertEqual(twoBit.get_size('chrB'), len(self.seqs['chrB']))
+        self.assertEqual(twoBit.get_seq('chrA', 997, 1311), self.seqs['chrA'][997:1311])
+
+    def test_align(self):
+        """The GfClient records match the gfClient psl records of each query."""
+        client = gf_client.GfClient(HOSTNAME, self.port, self.twoBitFn)
+        for qName, qSeq in self.get_queries():
+            records = client.align(qName, qSeq)
+            expected = self.get_gfclient_records(qName, qSeq)
+            self.assertEqual(self.get_record_keys(records), self.get_record_keys(expected), qName)
+            for record in records:
+                self.assertEqual(len(record), 21)
+
+    def test_gapped_align(self):
+        """A gapped genome alignment is one record with the intervals, block count and
+        gap sizes of the best gfClient record.
+        """
+        client = gf_client.GfClient(HOSTNAME, self.port, self.twoBitFn)
+        for qName, qSeq in self.get_gapped_queries():
+            records = client.align(qName, qSeq)
+            expected = max(self.get_gfclient_records(qName, qSeq), key=gf_client.local_aligner.get_psl_score)
+            self.assertEqual(len(records), 1, qName)
+            self.assertEqual(self.get_record_keys(records), self.get_record_keys([expected]), qName)
+            self.assertEqual(records[0][4:8] + records[0][17:18], expected[4:8] + expected[17:18], qName)
+
+
+if __name__ == '__main__':
+    unittest.main()
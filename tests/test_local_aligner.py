@@ -0,0 +1,72 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+import breakmer.realignment.local_aligner as local_aligner
+
+__author__ = "Ryan Abo"
+__copyright__ = "Copyright 2015, Ryan Abo"
+__email__ = "ryanabo@gmail.com"
+__license__ = "MIT"
+
+
+def get_random_seq(rand, size):
+    """ """
+    return ''.join([rand.choice('ACGT') for i in range(size)])
+
+
+def get_record_values(record):
+    """Return the strand, query interval, target interval, block count and query and target insert bases of a psl record."""
+    return (record[8], int(record[11]), int(record[12]), int(record[15]), int(record[16]), int(record[17]), int(record[5]), int(record[7]))
+
+
+class TargetAlignerTest(unittest.TestCase):
+    """Check that the target aligner reports indels as one gapped record, as blat does."""
+
+    def setUp(self):
+        rand = random.Random(5)
+        self.seq = get_random_seq(rand, 5000)
+        self.insertSeq = get_random_seq(rand, 30)
+        self.aligner = local_aligner.TargetAligner('target', self.seq)
+
+    def test_ungapped(self):
+        """ """
+        records = self.aligner.align('query', self.seq[100:400])
+        self.assertEqual([get_record_values(x) for x in records], [('+', 0, 300, 100, 400, 1, 0, 0)])
+
+    def test_deletions(self):
+        """Deletions inside and beyond the alignment band are one record with a target gap."""
+        for size in [50, 100, 140, 160, 300, 1000, 3000]:
+            query = self.seq[1000:1150] + self.seq[1150 + size:1300 + size]
+            records = self.aligner.align('query', query)
+            self.assertEqual([get_record_values(x) for x in records], [('+', 0, 300, 1000, 1300 + size, 2, 0, size)], size)
+
+    def test_reverse_deletion(self):
+        """ """
+        query = local_aligner.reverse_complement(self.seq[1000:1150] + self.seq[1450:1600])
+        records = self.aligner.align('query', query)
+        self.assertEqual([get_record_values(x) for x in records], [('-', 0, 300, 1000, 1600, 2, 0, 300)])
+
+    def test_tandem_duplications(self):
+        """Tandem duplications are one record with a query gap."""
+        for size in [60, 90, 150, 200]:
+            query = self.seq[2000:2150] + self.seq[2150 - size:2300]
+            records = self.aligner.align('query', query)
+            self.assertEqual([get_record_values(x) for x in records], [('+', 0, 300 + size, 2000, 2300, 2, size, 0)], size)
+
+    def test_insertion(self):
+        """ """
+        query = self.seq[3000:3150] + self.insertSeq + self.seq[3150:3300]
+        records = self.aligner.align('query', query)
+        self.assertEqual([get_record_values(x) for x in records], [('+', 0, 330, 3000, 3300, 2, 30, 0)])
+
+    def test_inversion(self):
+        """Segments on different strands are not chained."""
+        query = self.seq[1000:1150] + local_aligner.reverse_complement(self.seq[1150:1300])
+        records = self.aligner.align('query', query)
+        self.assertEqual(sorted([get_record_values(x) for x in records]), [('+', 0, 150, 1000, 1150, 1, 0, 0), ('-', 150, 300, 1150, 1300, 1, 0, 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()